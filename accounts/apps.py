@@ -4,3 +4,15 @@ from django.apps import AppConfig
 class AccountsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'accounts'
+
+    def ready(self):
+        from django.contrib.auth import get_user_model
+        from django.contrib.auth.signals import user_logged_out
+        from django.db.models.signals import post_delete, post_save
+
+        from .backends import evict_user
+
+        user_model = get_user_model()
+        user_logged_out.connect(evict_user, dispatch_uid='accounts.evict_user.logout')
+        post_save.connect(evict_user, sender=user_model, dispatch_uid='accounts.evict_user.save')
+        post_delete.connect(evict_user, sender=user_model, dispatch_uid='accounts.evict_user.delete')
@@ -0,0 +1,116 @@
+"""
+Authentication backend that keeps recently resolved users in process memory.
+
+Every HTTP request and every WebSocket handshake (channels' AuthMiddleware)
+resolves the session's user through ``backend.get_user(user_id)``. With
+sessions served from the cache (SESSION_ENGINE = cached_db) this backend
+removes the remaining query, so a reconnect storm is answered from memory.
+
+Entries expire after USER_CACHE_TIMEOUT seconds and the cache holds at most
+USER_CACHE_MAX_SIZE users, evicting the least recently used. Each entry also
+records the user's version stamp from the shared Django cache; logging out or
+saving the user row (a password change, deactivation, a staff flag) writes a
+new stamp, so every process drops its copy on the next lookup. A stale copy
+would be worse than a slow one: its session auth hash would no longer match
+and the session would be flushed. Checking the stamp costs one cache read,
+not a query.
+"""
+import collections
+import copy
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+
+class UserCache:
+    def __init__(self, timeout=60, max_size=1000):
+        self.timeout = timeout
+        self.max_size = max_size
+        self._users = collections.OrderedDict() # user id -> (expires_at, version, user)
+        self._lock = threading.Lock()
+
+    def get(self, user_id, version=None):
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic() or entry[1] != version:
+                del self._users[user_id]
+                return None
+            self._users.move_to_end(user_id)
+        # Callers get their own copy, so nothing a request does to its user leaks into the next one.
+        return copy.copy(entry[2])
+
+    def set(self, user_id, user, version=None):
+        if self.timeout <= 0:
+            return
+        with self._lock:
+            self._users[user_id] = (time.monotonic() + self.timeout, version, copy.copy(user))
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_size:
+                self._users.popitem(last=False)
+
+    def delete(self, user_id):
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+
+
+_user_cache = None
+
+
+def get_user_cache():
+    global _user_cache
+    if _user_cache is None:
+        _user_cache = UserCache(
+            timeout=getattr(settings, 'USER_CACHE_TIMEOUT', 60),
+            max_size=getattr(settings, 'USER_CACHE_MAX_SIZE', 1000),
+        )
+    return _user_cache
+
+
+@receiver(setting_changed)
+def reset_user_cache(*, setting, **kwargs):
+    global _user_cache
+    if setting.startswith('USER_CACHE_'):
+        _user_cache = None
+
+
+def user_version_key(user_id):
+    return f'accounts:user:{user_id}:version'
+
+
+class CachedModelBackend(ModelBackend):
+    """
+    ModelBackend whose get_user is served from the per-process UserCache.
+    """
+
+    def get_user(self, user_id):
+        user_cache = get_user_cache()
+        version = cache.get(user_version_key(user_id))
+        user = user_cache.get(user_id, version)
+        if user is None:
+            user = super().get_user(user_id)
+            if user is not None:
+                user_cache.set(user_id, user, version)
+        return user
+
+
+def evict_user(sender, user=None, instance=None, **kwargs):
+    """
+    Receiver for user_logged_out and post_save/post_delete of the user model
+    (connected in AccountsConfig.ready).
+    """
+    user = user or instance
+    if user is not None and user.pk is not None:
+        cache.set(user_version_key(user.pk), uuid.uuid4().hex, None)
+        get_user_cache().delete(user.pk)
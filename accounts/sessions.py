@@ -0,0 +1,30 @@
+"""
+Session engine: cached_db, plus moving old sessions onto CachedModelBackend.
+
+A session records the path of the backend that logged it in, and Django only
+resolves sessions whose backend is in AUTHENTICATION_BACKENDS. Sessions from
+before CachedModelBackend name ModelBackend, so as they are loaded their
+backend is rewritten to the cached one (a subclass, resolving the same users)
+instead of keeping ModelBackend listed. That keeps them logged in without
+hashing every failed login's password twice. The rewrite is stored the next
+time the session is saved.
+"""
+from django.contrib.auth import BACKEND_SESSION_KEY
+from django.contrib.sessions.backends import cached_db
+
+CACHED_BACKEND = 'accounts.backends.CachedModelBackend'
+LEGACY_BACKENDS = {'django.contrib.auth.backends.ModelBackend'}
+
+
+def upgrade_backend(session_data):
+    if session_data.get(BACKEND_SESSION_KEY) in LEGACY_BACKENDS:
+        session_data[BACKEND_SESSION_KEY] = CACHED_BACKEND
+    return session_data
+
+
+class SessionStore(cached_db.SessionStore):
+    def load(self):
+        return upgrade_backend(super().load())
+
+    async def aload(self):
+        return upgrade_backend(await super().aload())
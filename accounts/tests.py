@@ -1,3 +1,69 @@
-from django.test import TestCase
+from asgiref.sync import async_to_sync
+from channels.auth import AuthMiddlewareStack
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TransactionTestCase, override_settings
 
-# Create your tests here.
+from chat import routing
+
+from .backends import CachedModelBackend, get_user_cache
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    ROOM_REGISTRY={'BACKEND': 'chat.room_registry.InMemoryRoomRegistry'},
+    REPLAY_BUFFER={'BACKEND': 'chat.replay.InMemoryReplayBuffer'},
+)
+class CachedAuthenticationTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        get_user_cache().clear()
+        self.user = User.objects.create_user('alice', password='pw-for-tests')
+        self.client.force_login(self.user)
+        self.application = AuthMiddlewareStack(URLRouter(routing.websocket_urlpatterns))
+
+    def handshake(self, room_name):
+        # async_to_sync from this thread runs the middleware's database_sync_to_async calls
+        # back on it, so assertNumQueries sees every query the handshake makes.
+        return async_to_sync(self.ahandshake)(room_name)
+
+    async def ahandshake(self, room_name):
+        cookie = f'{settings.SESSION_COOKIE_NAME}={self.client.cookies[settings.SESSION_COOKIE_NAME].value}'
+        communicator = WebsocketCommunicator(
+            self.application, f'/ws/chat/{room_name}/?secret=s', headers=[(b'cookie', cookie.encode())],
+        )
+        connected, _ = await communicator.connect()
+        await communicator.disconnect()
+        return connected
+
+    def test_warm_handshake_makes_no_queries(self):
+        self.assertTrue(self.handshake('table_1')) # Only an authenticated creator may open a room
+        with self.assertNumQueries(0):
+            self.assertTrue(self.handshake('table_2'))
+
+    def test_saving_the_user_evicts_it(self):
+        backend = CachedModelBackend()
+        backend.get_user(self.user.pk)
+        with self.assertNumQueries(0):
+            backend.get_user(self.user.pk)
+
+        self.user.set_password('a-new-password')
+        self.user.save()
+        with self.assertNumQueries(1):
+            user = backend.get_user(self.user.pk)
+        self.assertTrue(user.check_password('a-new-password'))
+
+    def test_sessions_from_before_the_cached_backend_stay_logged_in(self):
+        session = self.client.session
+        session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+        session.save()
+        self.assertTrue(self.handshake('table_1'))
+        with self.assertNumQueries(0): # Resolved by the cached backend, the handshake's user is reused
+            self.assertTrue(self.handshake('table_2'))
+        response = self.client.get('/')
+        self.assertEqual(response.wsgi_request.user, self.user)
+        self.assertEqual(response.wsgi_request.session[BACKEND_SESSION_KEY], 'accounts.backends.CachedModelBackend')
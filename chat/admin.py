@@ -1,3 +1,11 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import Message
+
+
+@admin.register(Message)
+class MessageAdmin(admin.ModelAdmin):
+    list_display = ('room', 'seq', 'username', 'content', 'created_at')
+    list_filter = ('room',)
+    search_fields = ('room', 'username', 'content')
+    show_full_result_count = False # COUNT(*) over the whole archive gets slow
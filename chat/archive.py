@@ -0,0 +1,151 @@
+"""
+Write-behind archive of chat messages.
+
+ChatConsumer hands every broadcast line to ``get_message_archive().add(...)``,
+which only appends to an in-process list. The list is written with a single
+``bulk_create`` once MESSAGE_ARCHIVE_BATCH_SIZE messages are pending or
+MESSAGE_ARCHIVE_FLUSH_INTERVAL_MS after the first pending message, whichever
+comes first. The insert runs in the database_sync_to_async thread, never on
+the event loop, so a busy room costs one INSERT per batch instead of one
+synchronous write per line.
+
+Each message records the opening of the room it was sent in (the room's
+``created_at``), since names like "table 20" are reused. The history endpoint
+only serves the current opening, and only to someone who was in it: a member
+sends HISTORY_FRAME over its WebSocket and gets back a ``history_token``.
+"""
+import asyncio
+import atexit
+import logging
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core import signing
+from django.core.signals import setting_changed
+from django.db import connection
+from django.dispatch import receiver
+
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+HISTORY_FRAME = '{"type":"history"}'
+HISTORY_TOKEN_SALT = 'chat.history'
+
+
+class MessageArchive:
+    def __init__(self, batch_size=50, flush_interval=0.5, max_pending=5000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Upper bound on unsaved messages if the database is down; oldest are dropped first.
+        self.max_pending = max_pending
+        self.pending = []
+        self._flush_handle = None
+        self._flush_loop = None
+        self._flush_tasks = set()
+        self._flush_lock = None
+        # flush_sync skips a batch once this is no longer the database in use (a test database, torn down).
+        self.database = connection.settings_dict['NAME']
+
+    def add(self, room, opened_at, seq, username, content):
+        """
+        Queues one message. Must be called from the event loop.
+        """
+        self.pending.append(Message(room=room, opened_at=opened_at, seq=seq, username=username, content=content))
+        if len(self.pending) > self.max_pending:
+            dropped = len(self.pending) - self.max_pending
+            del self.pending[:dropped]
+            logger.warning(f"Message archive is backed up; dropped {dropped} unsaved messages.")
+
+        loop = asyncio.get_running_loop()
+        if len(self.pending) >= self.batch_size:
+            self._schedule_flush(loop, 0)
+        elif self._flush_handle is None or self._flush_loop is not loop:
+            self._schedule_flush(loop, self.flush_interval)
+
+    def _schedule_flush(self, loop, delay):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        self._flush_loop = loop
+        self._flush_handle = loop.call_later(delay, self._start_flush, loop)
+
+    def _start_flush(self, loop):
+        self._flush_handle = None
+        task = loop.create_task(self.flush())
+        # Keep a reference until it finishes so the task can't be garbage collected mid-write.
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def flush(self):
+        """
+        Writes everything pending. Flushes never overlap, so batches land in order.
+        """
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock() # Created lazily: it must belong to the running loop
+        async with self._flush_lock:
+            batch, self.pending = self.pending, []
+            if not batch:
+                return
+            try:
+                await database_sync_to_async(Message.objects.bulk_create)(batch)
+            except Exception as e:
+                logger.error(f"Failed to archive {len(batch)} messages: {e}", exc_info=True)
+
+    def flush_sync(self):
+        """
+        Writes everything pending from a thread with no running event loop (e.g. at exit).
+        """
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        if connection.settings_dict['NAME'] != self.database:
+            logger.warning(f"Not archiving {len(batch)} messages at exit: their database is gone.")
+            return
+        try:
+            Message.objects.bulk_create(batch)
+        except Exception as e:
+            logger.error(f"Failed to archive {len(batch)} messages at exit: {e}")
+
+
+def history_token(room, opened_at):
+    """
+    Signed proof that the bearer was in this opening of `room`, for the history endpoint.
+    """
+    return signing.dumps([room, opened_at], salt=HISTORY_TOKEN_SALT)
+
+
+def read_history_token(token):
+    """
+    Returns the (room, opened_at) a history_token was issued for, or None if it is not valid.
+    """
+    try:
+        room, opened_at = signing.loads(token, salt=HISTORY_TOKEN_SALT)
+    except (signing.BadSignature, TypeError, ValueError):
+        return None
+    return room, opened_at
+
+
+_message_archive = None
+
+
+def get_message_archive():
+    global _message_archive
+    if _message_archive is None:
+        _message_archive = MessageArchive(
+            batch_size=getattr(settings, 'MESSAGE_ARCHIVE_BATCH_SIZE', 50),
+            flush_interval=getattr(settings, 'MESSAGE_ARCHIVE_FLUSH_INTERVAL_MS', 500) / 1000,
+        )
+    return _message_archive
+
+
+@atexit.register
+def flush_at_exit():
+    if _message_archive is not None:
+        _message_archive.flush_sync()
+
+
+@receiver(setting_changed)
+def reset_message_archive(*, setting, **kwargs):
+    global _message_archive
+    if setting.startswith('MESSAGE_ARCHIVE_'):
+        _message_archive = None
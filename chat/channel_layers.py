@@ -0,0 +1,274 @@
+"""
+Channel layers for the chat app.
+
+HybridRedisChannelLayer is a drop-in replacement for channels_redis'
+RedisChannelLayer that short-circuits Redis for group members living in the
+current process. Redis stays the source of truth for group membership, so
+other processes keep sending to our channels through Redis as before; we just
+stop round-tripping our own messages through it.
+
+With several hosts, keys are placed by chat.sharding's consistent hash rather
+than channels_redis' CRC ranges: a room's group lands on the same shard as its
+registry record and replay buffer, and adding a host moves about 1/N of the
+groups instead of most of them.
+
+Failed operations are counted in chat_channel_layer_errors_total (see
+chat.metrics) and re-raised.
+"""
+import asyncio
+import collections
+import contextlib
+import functools
+import os
+import time
+import uuid
+import weakref
+
+from channels_redis.core import RedisChannelLayer, logger as channels_redis_logger
+
+from .metrics import CHANNEL_LAYER_ERRORS
+from .sharding import HashRing, shard_name
+
+# Same script RedisChannelLayer.group_send uses: push one message per channel key,
+# skipping keys that are at capacity.
+GROUP_SEND_LUA = """
+    local over_capacity = 0
+    local current_time = ARGV[#ARGV - 1]
+    local expiry = ARGV[#ARGV]
+    for i=1,#KEYS do
+        if redis.call('ZCOUNT', KEYS[i], '-inf', '+inf') < tonumber(ARGV[i + #KEYS]) then
+            redis.call('ZADD', KEYS[i], current_time, ARGV[i])
+            redis.call('EXPIRE', KEYS[i], expiry)
+        else
+            over_capacity = over_capacity + 1
+        end
+    end
+    return over_capacity
+"""
+
+
+@contextlib.contextmanager
+def count_errors(operation):
+    try:
+        yield
+    except Exception:
+        CHANNEL_LAYER_ERRORS.labels(operation).inc()
+        raise
+
+
+def _after_fork(layer_ref):
+    layer = layer_ref()
+    if layer is not None:
+        layer.forked()
+
+
+class HybridRedisChannelLayer(RedisChannelLayer):
+    """
+    RedisChannelLayer with a local-delivery fast path for group_send.
+
+    Members added from this process are remembered in ``local_groups``. A
+    group_send delivers to them straight into the in-process receive buffer
+    and only serializes and pushes the message to Redis for members that
+    belong to other processes. When every member is local (the common
+    single-machine case) a broadcast costs one Redis command to read the
+    group instead of four round trips, nothing is serialized, and the
+    receivers skip BRPOP and the backup-queue cleanup entirely.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # group name -> process-local channel names that joined it
+        self.local_groups = collections.defaultdict(set)
+        self.local_deliveries = 0
+        self.remote_deliveries = 0
+        self.readers = {} # Redis list of this process's channels -> task moving its messages to receive_buffer
+        self.ring = HashRing(range(self.ring_size), names=[self.host_name(host) for host in self.hosts])
+        # manage.py serve builds the layer before forking its workers (chat.lifecycle.warm_up).
+        os.register_at_fork(after_in_child=functools.partial(_after_fork, weakref.ref(self)))
+
+    def forked(self):
+        """
+        Gives a forked worker its own client prefix. With the parent's, every worker would read
+        the same Redis list and take messages meant for another worker's channels.
+        """
+        self.client_prefix = uuid.uuid4().hex
+        self.readers = {}
+        self.local_groups.clear()
+        self.receive_buffer.clear()
+
+    @staticmethod
+    def host_name(host):
+        # Same names as the registry's ring over REDIS_SHARDS, so a room's keys share a shard.
+        return shard_name(host['address']) if 'address' in host else repr(sorted(host.items()))
+
+    def consistent_hash(self, value):
+        # send() hashes a whole 'specific.<client prefix>!<id>' channel name, but the reader and
+        # group_send hash 'specific.<client prefix>!': place both by the part up to the '!'.
+        if '!' in value:
+            value = value[:value.index('!') + 1]
+        return self.ring.node(value)
+
+    def is_local_channel(self, channel):
+        return '!' in channel and self.non_local_name(channel).endswith(self.client_prefix + '!')
+
+    async def send(self, channel, message):
+        with count_errors('send'):
+            await super().send(channel, message)
+
+    async def group_add(self, group, channel):
+        with count_errors('group_add'):
+            await super().group_add(group, channel)
+        if self.is_local_channel(channel):
+            self.local_groups[group].add(channel)
+
+    async def group_discard(self, group, channel):
+        local_members = self.local_groups.get(group)
+        if local_members is not None:
+            local_members.discard(channel)
+            if not local_members:
+                del self.local_groups[group]
+        with count_errors('group_discard'):
+            await super().group_discard(group, channel)
+
+    async def group_refresh(self, group, channels):
+        """
+        Renews the membership timestamps of channels that are still in the group, in one
+        round trip. Channels that have been discarded are not re-added.
+        """
+        assert self.valid_group_name(group), "Group name not valid"
+        key = self._group_key(group)
+        connection = self.connection(self.consistent_hash(group))
+        now = time.time()
+        with count_errors('group_refresh'):
+            pipe = connection.pipeline(transaction=False)
+            pipe.zadd(key, {channel: now for channel in channels}, xx=True)
+            pipe.expire(key, self.group_expiry)
+            await pipe.execute()
+
+    async def group_delete(self, group):
+        """
+        Removes every member of a group at once, on all processes. Messages already
+        queued for its channels are still delivered.
+        """
+        assert self.valid_group_name(group), "Group name not valid"
+        self.local_groups.pop(group, None)
+        connection = self.connection(self.consistent_hash(group))
+        with count_errors('group_delete'):
+            await connection.delete(self._group_key(group))
+
+    async def receive(self, channel):
+        """
+        Waits on the channel's receive buffer, which a background reader fills from Redis.
+
+        The parent has whichever receiver holds its lock block in BZPOPMIN for up to
+        brpop_timeout, so a message put straight into that receiver's own buffer by a
+        local group_send would wait for the timeout. Here no receiver reads Redis itself.
+        """
+        if '!' not in channel:
+            return await super().receive(channel)
+        assert self.valid_channel_name(channel)
+        self.start_reader(self.non_local_name(channel))
+        queue = self.receive_buffer[channel]
+        try:
+            message = await queue.get()
+        except asyncio.CancelledError:
+            self.receive_buffer.pop(channel, None) # The consumer is gone; like the parent, drop what's left
+            raise
+        if queue.empty() and self.receive_buffer.get(channel) is queue:
+            del self.receive_buffer[channel]
+        return message
+
+    def start_reader(self, real_channel):
+        loop = asyncio.get_running_loop()
+        reader = self.readers.get(real_channel)
+        # A reader left on the loop of a finished test (or one that died) never wakes up again.
+        if reader is None or reader.done() or reader.get_loop() is not loop:
+            self.readers[real_channel] = loop.create_task(self.read_local_channels(real_channel))
+
+    async def read_local_channels(self, real_channel):
+        while True:
+            try:
+                message_channel, message = await self.receive_single(real_channel)
+            except Exception as e:
+                CHANNEL_LAYER_ERRORS.labels('receive').inc()
+                channels_redis_logger.warning("Receiving on %s failed, retrying: %s", real_channel, e)
+                await asyncio.sleep(1)
+                continue
+            for channel in message_channel if isinstance(message_channel, list) else [message_channel]:
+                self.receive_buffer[channel].put_nowait(message)
+
+    async def stop_readers(self):
+        loop = asyncio.get_running_loop()
+        readers, self.readers = list(self.readers.values()), {}
+        for reader in readers:
+            reader.cancel()
+        await asyncio.gather(*(reader for reader in readers if reader.get_loop() is loop), return_exceptions=True)
+
+    async def flush(self):
+        self.local_groups.clear()
+        await self.stop_readers()
+        await super().flush()
+
+    async def close_pools(self):
+        await self.stop_readers()
+        await super().close_pools()
+
+    async def group_send(self, group, message):
+        with count_errors('group_send'):
+            await self._group_send(group, message)
+
+    async def _group_send(self, group, message):
+        assert self.valid_group_name(group), "Group name not valid"
+        key = self._group_key(group)
+        connection = self.connection(self.consistent_hash(group))
+
+        # One read that already skips members older than group_expiry. Unlike the parent we
+        # don't delete them here; they go when the group key itself expires.
+        members = await connection.zrangebyscore(key, min=int(time.time()) - self.group_expiry, max='+inf')
+        channel_names = [member.decode('utf8') for member in members]
+
+        local_members = self.local_groups.get(group, ())
+        remote_names = []
+        for channel in channel_names:
+            if channel in local_members:
+                # Each receiver gets its own copy, as it would after a Redis round trip.
+                self.receive_buffer[channel].put_nowait(dict(message))
+                self.local_deliveries += 1
+            else:
+                remote_names.append(channel)
+
+        if remote_names:
+            self.remote_deliveries += len(remote_names)
+            await self._send_to_remote_channels(group, remote_names, message, len(channel_names))
+
+    async def _send_to_remote_channels(self, group, channel_names, message, group_size):
+        """
+        The Redis half of RedisChannelLayer.group_send, restricted to channel_names.
+        """
+        (
+            connection_to_channel_keys,
+            channel_keys_to_message,
+            channel_keys_to_capacity,
+        ) = self._map_channel_keys_to_connection(channel_names, message)
+
+        for connection_index, channel_redis_keys in connection_to_channel_keys.items():
+            connection = self.connection(connection_index)
+            now = time.time()
+            pipe = connection.pipeline()
+            for key in channel_redis_keys:
+                pipe.zremrangebyscore(key, min=0, max=int(now) - int(self.expiry))
+            await pipe.execute()
+
+            args = [channel_keys_to_message[channel_key] for channel_key in channel_redis_keys]
+            args += [channel_keys_to_capacity[channel_key] for channel_key in channel_redis_keys]
+            args += [now, self.expiry]
+            channels_over_capacity = await connection.eval(
+                GROUP_SEND_LUA, len(channel_redis_keys), *channel_redis_keys, *args
+            )
+            if channels_over_capacity > 0:
+                channels_redis_logger.info(
+                    "%s of %s channels over capacity in group %s",
+                    channels_over_capacity,
+                    group_size,
+                    group,
+                )
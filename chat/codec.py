@@ -0,0 +1,99 @@
+"""
+Encoding of WebSocket frames.
+
+Frames are JSON text by default. JSON uses orjson when it is installed and
+falls back to the standard library otherwise. Both produce compact,
+non-ASCII-escaped JSON text, so the wire format does not change with the
+codec.
+
+Clients that offer the MSGPACK_SUBPROTOCOL get binary MessagePack frames
+instead, from the same events. A chat line is packed as a
+``[seq, username, message]`` array, so the keys are not repeated in every
+frame; ``seq`` is nil when the line has none. Any other frame (errors,
+``closed`` notices) is the JSON object packed as a map. Heartbeat pings stay
+JSON text in both protocols, and pongs are always text.
+"""
+import json
+
+import msgpack
+
+try:
+    import orjson
+except ImportError: # orjson is optional
+    orjson = None
+
+if orjson is not None:
+    CODEC_NAME = 'orjson'
+
+    def dumps(obj):
+        return orjson.dumps(obj).decode()
+
+    # orjson.JSONDecodeError subclasses json.JSONDecodeError, so callers only catch the latter.
+    loads = orjson.loads
+else:
+    CODEC_NAME = 'json'
+
+    def dumps(obj):
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
+
+    loads = json.loads
+
+
+MSGPACK_SUBPROTOCOL = 'grego.msgpack.v1'
+JSON_SUBPROTOCOL = 'grego.json.v1' # Same frames as no subprotocol; lets a client offer both
+
+CHAT_FRAME_KEYS = {'seq', 'message', 'username'}
+
+
+def encode_chat_frame(message, username):
+    """
+    Returns the text frame sent to every member of a room for one chat line.
+    Encode it once at group_send time and pass it through the channel layer.
+    """
+    return dumps({'message': message, 'username': username})
+
+
+def pack_chat_frame(message, username, seq=None):
+    """
+    The MessagePack form of encode_chat_frame(), with the room's sequence number.
+    """
+    return msgpack.packb([seq, username, message])
+
+
+def pack(frame):
+    """
+    Converts an encoded JSON frame to its MessagePack form.
+    """
+    obj = loads(frame)
+    if 'message' in obj and obj.keys() <= CHAT_FRAME_KEYS:
+        return pack_chat_frame(obj['message'], obj.get('username'), obj.get('seq'))
+    return msgpack.packb(obj)
+
+
+def unpack(data):
+    """
+    Decodes a binary frame sent by a MessagePack client. Raises ValueError if it is not MessagePack.
+    """
+    return msgpack.unpackb(data)
+
+
+def with_seq(frame, seq):
+    """
+    Adds a leading "seq" key to an encoded frame. Frames are always JSON
+    objects, so the key is spliced in rather than decoding and re-encoding.
+    """
+    return f'{{"seq":{seq},{frame[1:]}'
+
+
+def with_room(frame, room):
+    """
+    Adds a leading "room" key to an encoded frame, like with_seq().
+    """
+    return f'{{"room":{dumps(room)},{frame[1:]}'
+
+
+def encode_batch(frames):
+    """
+    Joins encoded frames into one {"batch": [...]} frame without re-encoding them.
+    """
+    return f'{{"batch":[{",".join(frames)}]}}'
@@ -1,26 +1,64 @@
-import json
 from channels.generic.websocket import AsyncWebsocketConsumer
 from django.conf import settings # Import settings
-import redis # Import redis
+import asyncio
 import logging
+import time
+from urllib.parse import unquote
+
+from . import codec, heartbeat, lifecycle, limits, lobby, logs, metrics, presence, teardown
+from .archive import HISTORY_FRAME, get_message_archive, history_token
+from .replay import RESET_FRAME, get_replay_buffer
+from .room_registry import get_room_registry, invalidate_active_rooms, room_display_name, room_group_name
 
 logger = logging.getLogger(__name__)
 
-# Module-level storage for room secrets and creators (NOT SUITABLE FOR MULTI-SERVER PRODUCTION)
-room_secrets_and_creators = {}
+def event_frame(event, default_username=None):
+    """
+    Returns the pre-encoded text frame of a broadcast event.
+    Events without a 'frame' (sent by workers running older code) are encoded here.
+    """
+    if 'frame' in event:
+        return event['frame']
+    return codec.encode_chat_frame(event['message'], event.get('username', default_username))
+
+def negotiate_subprotocol(offered):
+    """
+    Picks the wire format from the client's Sec-WebSocket-Protocol offer: MessagePack
+    if offered (and CHAT_MSGPACK_ENABLED), else JSON. Returns (subprotocol, binary).
+    """
+    if codec.MSGPACK_SUBPROTOCOL in offered and getattr(settings, 'CHAT_MSGPACK_ENABLED', True):
+        return codec.MSGPACK_SUBPROTOCOL, True
+    if codec.JSON_SUBPROTOCOL in offered:
+        return codec.JSON_SUBPROTOCOL, False
+    return None, False # No offer, or nothing we speak: plain JSON, as before subprotocols
 
 class ChatConsumer(AsyncWebsocketConsumer):
+    binary = False # MessagePack frames instead of JSON text (see chat.codec)
+
     async def connect(self):
+        connect_started = time.perf_counter()
         # Extract room name from the URL
         url_room_name = self.scope['url_route']['kwargs']['room_name']
         self.room_name = url_room_name # Keep original room name for display or other logic
         
-        # Sanitize the room name for use in the group name (replace spaces with underscores)
-        safe_room_name_for_group = url_room_name.replace(" ", "_")
-        # Create a Channels group name specific to the room
-        self.room_group_name = f'chat_{safe_room_name_for_group}'
+        # Create a Channels group name specific to the room (spaces become underscores)
+        self.room_group_name = room_group_name(url_room_name)
+        self.is_room_member = False # Set once this channel is counted in the room's occupancy
+        self.is_closing = False # Set when we close the socket ourselves; later events are ignored
+        self.rate_limiter = limits.connection_bucket()
+        self.heartbeat = False # Whether the page answers pings (see chat.heartbeat)
+        self.last_seen = time.monotonic()
+        subprotocol, self.binary = negotiate_subprotocol(self.scope.get('subprotocols', []))
 
-        logger.info(f"[CONSUMER CONNECT] Scope user: {self.scope.get('user', 'N/A')}, Authenticated: {self.scope.get('user', type('obj', (object,), {'is_authenticated': False})()).is_authenticated}")
+        if lifecycle.is_draining():
+            await self.reject_connection(lifecycle.SERVICE_RESTART) # Retry on a worker that is staying up
+            return
+
+        if logger.isEnabledFor(logging.INFO) and (extra := logs.sample('chat.connect')):
+            logger.info(
+                "[CONSUMER CONNECT] Scope user: %s, Authenticated: %s",
+                self.scope['user'], self.scope['user'].is_authenticated, extra=extra,
+            )
 
         # Extract secret phrase if present in the scope (passed from URL via view to WebSocket scope)
         # This requires modifying asgi.py or using a custom middleware to pass query params to scope if not already there.
@@ -31,30 +69,44 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
         query_string = self.scope.get('query_string', b'').decode()
         initial_secret = None
+        resume_since = None # Last sequence number a reconnecting client saw
+        guest_name = ''
         if query_string:
             params = dict(s.split('=', 1) for s in query_string.split('&') if '=' in s)
             initial_secret = params.get('secret')
+            if params.get('since', '').isdigit():
+                resume_since = int(params['since'])
+            self.heartbeat = params.get('heartbeat') == '1'
+            guest_name = unquote(params.get('name', '')).strip()[:presence.MAX_NAME_LENGTH]
+        # Shown in the room's presence. A guest's is the name they picked, until they chat under another.
+        self.presence_name = self.scope['user'].username if self.scope['user'].is_authenticated else guest_name or None
 
-        logger.debug(f"Connecting to room: '{self.room_name}', group: '{self.room_group_name}', channel: '{self.channel_name}', initial_secret: '{initial_secret}'")
+        if logger.isEnabledFor(logging.DEBUG) and (extra := logs.sample('chat.connect')):
+            logger.debug(
+                "Connecting to room: '%s', group: '%s', channel: '%s', with secret: %s",
+                self.room_name, self.room_group_name, self.channel_name, initial_secret is not None, extra=extra,
+            )
 
+        registry = get_room_registry()
         is_authenticated_user = self.scope['user'].is_authenticated
         is_creating_or_rejoining_with_secret = is_authenticated_user and initial_secret
-        is_room_already_active_with_secret = self.room_group_name in room_secrets_and_creators
+        room_data = await registry.aget(self.room_group_name)
+        is_room_already_active_with_secret = room_data is not None
 
         if is_room_already_active_with_secret:
             # Room exists in our controlled list.
             if is_creating_or_rejoining_with_secret:
                 # Authenticated user trying to connect with a secret. Validate if they are the creator and secret matches.
-                if room_secrets_and_creators[self.room_group_name]['creator_username'] != self.scope['user'].username or \
-                   room_secrets_and_creators[self.room_group_name]['secret'] != initial_secret:
+                if room_data['creator_username'] != self.scope['user'].username or \
+                   room_data['secret'] != initial_secret:
                     logger.warning(f"Auth user '{self.scope['user'].username}' attempted to join room '{self.room_name}' with incorrect secret or as non-creator. Rejecting.")
-                    await self.close(code=4003) # Access denied / wrong secret
+                    await self.reject_connection(4003) # Access denied / wrong secret
                     return
             # If not trying to join with a secret, allow connection (auth or anon can join an active room)
         elif not is_creating_or_rejoining_with_secret:
             # Room is NOT active with a secret, AND the current user is NOT an authenticated user trying to create it with a secret.
             logger.info(f"WebSocket connection rejected for room '{self.room_name}'. Room not active or not being created with secret by authenticated user.")
-            await self.close(code=4004) # Room not found/active or invalid creation attempt
+            await self.reject_connection(4004) # Room not found/active or invalid creation attempt
             return
        
         # Join room group
@@ -68,118 +120,519 @@ class ChatConsumer(AsyncWebsocketConsumer):
             logger.debug(f"Successfully executed group_add for '{self.room_group_name}'")
 
             if is_creating_or_rejoining_with_secret and not is_room_already_active_with_secret:
-                # This is a new room being created with a secret by an authenticated user
-                room_secrets_and_creators[self.room_group_name] = {
-                    'secret': initial_secret,
-                    'creator_username': self.scope['user'].username,
-                    # 'creator_channel_name' is less critical if creator can reconnect from any channel
-                }
-                logger.info(f"Room '{self.room_name}' CREATED by '{self.scope['user'].username}' with secret '{initial_secret}'.")
-            elif is_room_already_active_with_secret and is_authenticated_user and room_secrets_and_creators[self.room_group_name]['creator_username'] == self.scope['user'].username:
+                # This is a new room being created with a secret by an authenticated user.
+                # acreate is atomic, so if another worker registered the room first we lose the race.
+                created = await registry.acreate(self.room_group_name, initial_secret, self.scope['user'].username)
+                if not created:
+                    logger.warning(f"Room '{self.room_name}' was created concurrently by another connection. Rejecting.")
+                    await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+                    await self.reject_connection(4003)
+                    return
+                if logger.isEnabledFor(logging.INFO) and (extra := logs.sample('chat.room')):
+                    logger.info(
+                        "Room '%s' CREATED by '%s'.", self.room_name, self.scope['user'].username,
+                        extra={**extra, 'room': self.room_name},
+                    )
+                room_data = await registry.aget(self.room_group_name)
+            elif is_room_already_active_with_secret and is_authenticated_user and room_data['creator_username'] == self.scope['user'].username:
                  logger.info(f"Creator '{self.scope['user'].username}' (re)connected to room '{self.room_name}'.")
 
+            # Track occupancy so list_active_rooms never has to scan the channel layer's keys.
+            member_count = await registry.aadd_member(self.room_group_name, self.channel_name)
+            if member_count < 0:
+                # The room was closed between the lookup above and now.
+                await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+                await self.reject_connection(4004)
+                return
+            self.is_room_member = True
+            self.room_opened_at = room_data['created_at'] if room_data is not None else None # Tells apart reuses of the name
+            if member_count == 1:
+                await invalidate_active_rooms()
+            lobby.room_changed(self.room_group_name, member_count)
+
 
         except Exception as e:
             logger.error(f"Failed group_add for '{self.room_group_name}'. Error: {e}, Type: {type(e)}")
             # Depending on the severity, you might want to close the connection if group_add fails
-            await self.close() # Close connection if group_add fails
+            await self.reject_connection(None) # Close connection if group_add fails
             return # Prevent self.accept()
 
-        await self.accept() # Accept the WebSocket connection
+        await self.accept(subprotocol=subprotocol) # Accept the WebSocket connection
         logger.debug(f"WebSocket connection accepted for room: '{self.room_name}'")
+        accepted_at = time.perf_counter()
+        metrics.CONNECT_SECONDS.observe(accepted_at - connect_started)
+        if 'handshake_started' in self.scope:
+            metrics.HANDSHAKE_SECONDS.observe(accepted_at - self.scope['handshake_started'])
+        metrics.ACTIVE_CONNECTIONS.inc()
+        lifecycle.live_consumers.add(self)
+        heartbeat.heartbeat.ensure_running()
+        teardown.sweeper.ensure_running()
+        presence.join(self.room_group_name, self.channel_name, self.presence_name)
+
+        if resume_since is not None:
+            # Live broadcasts queue behind connect(), so the replayed frames always go out first.
+            # Anything sent both ways is dropped by the client, which ignores seq it has already seen.
+            await self.replay_missed_frames(resume_since)
+        room_presence = presence.current(self.room_group_name)
+        if room_presence is not None:
+            await self.send_frame(*room_presence) # Who was here before us; we show up in the next snapshot
+
+    async def reject_connection(self, code):
+        metrics.REJECTED_CONNECTS.labels(str(code or 'error')).inc()
+        if code is None:
+            await self.close()
+        else:
+            await self.close(code=code)
+
+    async def replay_missed_frames(self, since):
+        frames, truncated, reset = await get_replay_buffer().asince(self.room_group_name, since)
+        logger.debug(
+            "Replaying %d frames after seq %s to %s (truncated: %s, reset: %s)",
+            len(frames), 0 if reset else since, self.channel_name, truncated, reset,
+        )
+        if reset:
+            await self.send_frame(RESET_FRAME) # Its seqs are from an earlier opening of this room
+        if truncated:
+            await self.send_frame(codec.encode_chat_frame("Some messages sent while you were away are no longer available.", "System"))
+        for frame in frames:
+            await self.send_frame(frame)
+
+    async def send_frame(self, frame, packed=None):
+        """
+        Sends an encoded JSON frame in this client's wire format. Pass `packed` if the
+        MessagePack form is already at hand.
+        """
+        if self.binary:
+            await self.send(bytes_data=packed if packed is not None else codec.pack(frame))
+        else:
+            await self.send(text_data=frame)
 
     async def disconnect(self, close_code):
+        lifecycle.live_consumers.discard(self)
         logger.debug(f"Disconnecting from room: '{self.room_name}', group: '{self.room_group_name}', channel: '{self.channel_name}', code: {close_code}")
-        # Optional: Clean up room_secrets_and_creators if room becomes empty.
-        # This requires checking group size, which is tricky without direct Redis SCARD here.
-        # For now, secrets persist until server restart or manual cleanup.
+        # Secrets persist until the creator closes the room; only occupancy is updated here.
+        await self.leave_room()
 
-        # Leave room group
+    async def leave_room(self):
+        """
+        Leaves the room group and occupancy. Safe to call more than once.
+        """
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
+        if self.is_room_member:
+            self.is_room_member = False
+            presence.leave(self.room_group_name, self.channel_name)
+            metrics.ACTIVE_CONNECTIONS.dec()
+            remaining = await get_room_registry().aremove_member(self.room_group_name, self.channel_name)
+            if remaining == 0:
+                await invalidate_active_rooms()
+            lobby.room_changed(self.room_group_name, remaining)
+
     # Receive message from WebSocket client
-    async def receive(self, text_data):
-        logger.debug(f"Raw text_data received: {text_data} from channel {self.channel_name}")
+    async def receive(self, text_data=None, bytes_data=None):
+        received_at = time.perf_counter()
+        self.last_seen = time.monotonic()
+        # Binary frames are only accepted from MessagePack clients; JSON text is accepted from all.
+        data = text_data if text_data is not None else (bytes_data if self.binary else None)
+        # Cheap checks first: oversized and too-frequent frames are dropped before being parsed.
+        if data is None or len(data) > limits.max_frame_size():
+            limits.reject('frame_rejected')
+            logger.warning(f"Rejected {'binary' if data is None else 'oversized'} frame from {self.channel_name}")
+            await self.send_frame(codec.dumps({'error': 'Message too large.'}))
+            return
+        if text_data == heartbeat.PONG_FRAME:
+            return # Only needed to update last_seen
+        if text_data in presence.TYPING_FRAMES:
+            # Ephemeral: no rate-limit tokens, no I/O; coalesced into the room's next presence snapshot.
+            presence.typing(self.room_group_name, self.channel_name, presence.TYPING_FRAMES[text_data])
+            return
+        if self.rate_limiter is not None and not self.rate_limiter.consume():
+            limits.reject('rate_limited_connection')
+            await self.send_frame(codec.dumps({'error': 'You are sending messages too quickly.'}))
+            return
+        if text_data == HISTORY_FRAME:
+            # Proof of membership for the history endpoint, for this opening of the room only.
+            token = history_token(self.room_group_name, self.room_opened_at)
+            await self.send_frame(codec.dumps({'history_token': token}))
+            return
+
+        logger.debug("Frame received: %d bytes from channel %s", len(data), self.channel_name)
         try:
-            text_data_json = json.loads(text_data)
+            text_data_json = codec.loads(text_data) if text_data is not None else codec.unpack(bytes_data)
             message = text_data_json['message']
             # Attempt to get the username sent by the client
             client_sent_username = text_data_json.get('username')
-        except (json.JSONDecodeError, KeyError) as e:
-            logger.warning(f"Invalid message format from {self.channel_name}: {text_data}, error: {e}")
-            await self.send(text_data=json.dumps({'error': 'Invalid message format.'}))
+        except (ValueError, KeyError, TypeError) as e: # JSONDecodeError and msgpack's errors are ValueErrors
+            logger.warning("Invalid message format from %s (%d bytes), error: %s", self.channel_name, len(data), e)
+            await self.send_frame(codec.dumps({'error': 'Invalid message format.'}))
+            return
+        if not isinstance(message, str) or not isinstance(client_sent_username, (str, type(None))):
+            await self.send_frame(codec.dumps({'error': 'Invalid message format.'}))
             return
 
         final_username = 'Anonymous' # Default username
         if self.scope['user'].is_authenticated:
             final_username = self.scope['user'].username
-            logger.debug(f"User is authenticated. Using Django username: {final_username}")
+            logger.debug("User is authenticated. Using Django username: %s", final_username)
         
         # Check for secret phrase
-            room_data = room_secrets_and_creators.get(self.room_group_name)
+            registry = get_room_registry()
+            room_data = await registry.aget(self.room_group_name)
             if room_data and \
                room_data['creator_username'] == final_username and \
                message == room_data['secret']:
                 
-                logger.info(f"Secret phrase '{message}' used by creator '{final_username}' in room '{self.room_name}'. Initiating shutdown.")
-                # Send shutdown message to all clients in the group
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'chat.room_shutdown',
-                        'message': f"Room '{self.room_name}' is being closed by the creator."
-                    }
-                )
-                # Clean up the secret storage
-                if self.room_group_name in room_secrets_and_creators:
-                    del room_secrets_and_creators[self.room_group_name]
-                
-                # Note: group_discard for all members happens when they disconnect after receiving shutdown.
-                # Or we could try to iterate and close connections, but that's more complex.
+                if logger.isEnabledFor(logging.INFO) and (extra := logs.sample('chat.room')):
+                    logger.info(
+                        "Secret phrase used by creator '%s' in room '%s'. Initiating shutdown.",
+                        final_username, self.room_name, extra={**extra, 'room': self.room_name},
+                    )
+                # Closes every member's socket and frees the group, secret, members and replay buffer.
+                await teardown.close_room(self.room_group_name, f"Room '{self.room_name}' is being closed by the creator.")
                 return # Stop further processing of this message
         else:
-            logger.debug(f"User is anonymous. Client sent username: '{client_sent_username}'")
+            logger.debug("User is anonymous. Client sent username: '%s'", client_sent_username)
             if client_sent_username and client_sent_username.strip(): # Check if a non-empty name was sent
                 final_username = client_sent_username.strip()
             else:
-                logger.warning(f"Anonymous user did not send a valid username or it was empty. Defaulting to 'Anonymous'. Payload was: {text_data_json}")
+                if logger.isEnabledFor(logging.WARNING) and (extra := logs.sample('chat.anonymous')):
+                    logger.warning(
+                        "Anonymous user did not send a valid username or it was empty. Defaulting to 'Anonymous' in room '%s'.",
+                        self.room_name, extra={**extra, 'room': self.room_name},
+                    )
                 
 
 
-        logger.info(f"Message from '{final_username}': '{message}' in room '{self.room_name}'")
+        # Sampled and rate-capped per process (see chat.logs); the text itself is not logged.
+        if logger.isEnabledFor(logging.INFO) and (extra := logs.sample('chat.message')):
+            logger.info(
+                "Message from '%s' in room '%s' (%d chars)", final_username, self.room_name, len(message),
+                extra={**extra, 'room': self.room_name, 'username': final_username},
+            )
 
-        # Send message to room group
+        room_limiter = limits.room_bucket(self.room_group_name)
+        if room_limiter is not None and not room_limiter.consume():
+            limits.reject('rate_limited_room')
+            await self.send_frame(codec.dumps({'error': 'This room is busy. Please try again in a moment.'}))
+            return
+
+        # Stamp the frame with the room's next sequence number and keep it for reconnecting clients.
+        seq, frame = await get_replay_buffer().aappend(self.room_group_name, codec.encode_chat_frame(message, final_username))
+        # Persisted in batches off the event loop (see chat.archive).
+        get_message_archive().add(self.room_group_name, self.room_opened_at, seq, final_username, message)
+
+        # Send message to room group.
+        # The frame is encoded once here, in both wire formats; every member's chat_message just forwards one.
         await self.channel_layer.group_send(
             self.room_group_name,
             {
                 'type': 'chat.message', # Corresponds to chat_message method name
-                'message': message,
-                'username': final_username
+                'frame': frame,
+                'packed': codec.pack_chat_frame(message, final_username, seq),
+                'group': self.room_group_name, # Lets StaffMonitorConsumer tell rooms apart
+                'sent_at': time.time(), # Wall clock, since members may be on other machines
             }
         )
+        metrics.RECEIVE_TO_GROUP_SEND_SECONDS.observe(time.perf_counter() - received_at)
+        metrics.MESSAGES.inc()
+        presence.message_sent(self.room_group_name, self.channel_name, final_username)
 
     async def chat_message(self, event):
-        message = event['message']
-        username = event['username']
-        logger.debug(f"Broadcasting message to {self.channel_name}: User '{username}', Msg '{message}'")
+        if self.is_closing:
+            return
+        if limits.is_slow_consumer(self):
+            # This client can't keep up with the room; don't let its backlog grow without bound.
+            if limits.slow_consumer_policy() == limits.SLOW_CONSUMER_DISCONNECT:
+                limits.reject('slow_consumer_disconnected')
+                logger.warning(f"Disconnecting slow consumer {self.channel_name} in room '{self.room_name}'")
+                self.is_closing = True
+                await self.close(code=1013) # Try again later: the client reconnects and catches up via replay
+            else:
+                limits.reject('slow_consumer_dropped')
+            return
+        frame = event_frame(event)
+        if logger.isEnabledFor(logging.DEBUG) and (extra := logs.sample('chat.delivery')):
+            logger.debug("Broadcasting %d byte frame to %s", len(frame), self.channel_name, extra=extra)
 
         # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'message': message,
-            'username': username
-        }))
+        await self.send_frame(frame, event.get('packed'))
+        if 'sent_at' in event:
+            metrics.FANOUT_SECONDS.observe(max(time.time() - event['sent_at'], 0))
+
+    async def presence_update(self, event):
+        frames = presence.received(event) # Merged even if we skip it, for the other members here
+        if frames is None or self.is_closing:
+            return
+        if limits.is_slow_consumer(self, presence.BACKLOG_SHARE):
+            limits.reject('presence_dropped') # Superseded by the next snapshot anyway
+            return
+        await self.send_frame(*frames)
 
     async def chat_room_shutdown(self, event):
         """
         Handler for the room_shutdown message. Sends a final message and closes the WebSocket.
         """
-        message = event['message']
-        logger.info(f"Sending shutdown event to client {self.channel_name}: {message}")
+        frame = event_frame(event, default_username="System")
+        if logger.isEnabledFor(logging.INFO) and (extra := logs.sample('chat.shutdown')):
+            logger.info("Sending shutdown event to client %s", self.channel_name, extra=extra)
+        lifecycle.live_consumers.discard(self) # No more heartbeats for a closing socket
+        self.is_closing = True
         # Send shutdown message to WebSocket client
-        await self.send(text_data=json.dumps({
-            'message': message,
-            'username': "System" # Or from event if specified, e.g., event.get('sender_username')
-        }))
-        await self.close(code=1000) # Graceful shutdown from server side
\ No newline at end of file
+        await self.send_frame(frame)
+        await self.close(code=1000) # Graceful shutdown from server side
+
+    async def close_stale(self):
+        """
+        Called by chat.heartbeat when the client went quiet or this member was pruned.
+        Leaves the room right away rather than waiting for disconnect, which a dead
+        socket may not deliver for minutes.
+        """
+        lifecycle.live_consumers.discard(self)
+        self.is_closing = True
+        await self.leave_room()
+        await self.close(code=heartbeat.STALE)
+
+    async def close_for_restart(self):
+        """
+        Called by chat.lifecycle.drain when this worker shuts down; the client reconnects elsewhere.
+        """
+        self.is_closing = True
+        await self.close(code=lifecycle.SERVICE_RESTART)
+
+
+
+class StaffMonitorConsumer(AsyncWebsocketConsumer):
+    """
+    One socket, at ws/staff/, for staff watching many rooms at once.
+
+    The client sends {"subscribe": ["table 1", ...]} or {"subscribe": "*"} (every
+    active room) and {"unsubscribe": [...]}; each is answered with
+    {"watching": [...]}, the rooms now watched, and "unknown" for names that are
+    not active rooms. Frames from watched rooms are the ones room members get,
+    tagged with "room" and sent in batches:
+
+        {"batch": [{"room": "table 1", "seq": 4, "message": "hi", "username": "Bob"}, ...]}
+
+    A batch goes out CHAT_MONITOR_BATCH_MS after its first frame, or as soon as it
+    holds CHAT_MONITOR_BATCH_SIZE frames. A room's closing frame (with "closed")
+    also ends its subscription. The monitor never counts towards a room's occupancy.
+    """
+
+    async def connect(self):
+        self.subscriptions = set() # Group names
+        self.pending = [] # Tagged frames waiting for the next batch
+        self.flusher = None
+        self.is_closing = False
+        self.heartbeat = False # Whether the client answers pings (see chat.heartbeat)
+        self.last_seen = time.monotonic()
+        user = self.scope.get('user')
+        if lifecycle.is_draining():
+            await self.reject_connection(lifecycle.SERVICE_RESTART)
+            return
+        if user is None or not user.is_staff:
+            await self.reject_connection(4003)
+            return
+        self.heartbeat = b'heartbeat=1' in self.scope.get('query_string', b'').split(b'&')
+        await self.accept()
+        lifecycle.live_monitors.add(self)
+        heartbeat.heartbeat.ensure_running()
+        logger.info(f"Staff monitor connected for '{user.username}' on {self.channel_name}")
+
+    async def reject_connection(self, code):
+        metrics.REJECTED_CONNECTS.labels(str(code)).inc()
+        await self.close(code=code)
+
+    async def disconnect(self, close_code):
+        lifecycle.live_monitors.discard(self)
+        self.is_closing = True
+        if self.flusher is not None:
+            self.flusher.cancel()
+        await self.set_subscriptions(set())
+
+    async def receive(self, text_data=None, bytes_data=None):
+        self.last_seen = time.monotonic()
+        if text_data is None or len(text_data) > limits.max_frame_size() * 4: # Room lists can be long
+            limits.reject('frame_rejected')
+            await self.send(text_data=codec.dumps({'error': 'Message too large.'}))
+            return
+        if text_data == heartbeat.PONG_FRAME:
+            return
+        try:
+            request = codec.loads(text_data)
+            subscribe = request.get('subscribe', [])
+            unsubscribe = request.get('unsubscribe', [])
+            if not isinstance(subscribe, list) and subscribe != '*' or not isinstance(unsubscribe, list):
+                raise TypeError('room lists expected')
+        except (ValueError, AttributeError, TypeError) as e:
+            logger.warning(f"Invalid monitor request from {self.channel_name}: {text_data}, error: {e}")
+            await self.send(text_data=codec.dumps({'error': 'Invalid request.'}))
+            return
+
+        # One read of the room index answers for every name, however many are asked for.
+        active = set(await get_room_registry().aactive_rooms())
+        if subscribe == '*':
+            wanted = set(active)
+            unknown = []
+        else:
+            wanted = {room_group_name(str(name)) for name in subscribe}
+            unknown = sorted(room_display_name(name) for name in wanted - active)
+            wanted &= active
+        wanted = (self.subscriptions | wanted) - {room_group_name(str(name)) for name in unsubscribe}
+        limit = getattr(settings, 'CHAT_MONITOR_MAX_ROOMS', 500)
+        if len(wanted) > limit:
+            await self.send(text_data=codec.dumps({'error': f'You can watch at most {limit} rooms.'}))
+            return
+        await self.set_subscriptions(wanted)
+        reply = {'watching': sorted(room_display_name(name) for name in self.subscriptions)}
+        if unknown:
+            reply['unknown'] = unknown
+        await self.send(text_data=codec.dumps(reply))
+
+    async def set_subscriptions(self, wanted):
+        """
+        Joins and leaves only the groups that changed, concurrently.
+        """
+        added, removed = wanted - self.subscriptions, self.subscriptions - wanted
+        self.subscriptions = set(wanted)
+        await asyncio.gather(
+            *(self.channel_layer.group_add(name, self.channel_name) for name in added),
+            *(self.channel_layer.group_discard(name, self.channel_name) for name in removed),
+        )
+
+    async def chat_message(self, event):
+        if self.is_closing:
+            return
+        if limits.is_slow_consumer(self):
+            limits.reject('slow_consumer_dropped')
+            return
+        await self.queue(event)
+
+    async def presence_update(self, event):
+        pass # Monitors follow the conversation, not who is typing
+
+    async def chat_room_shutdown(self, event):
+        if self.is_closing:
+            return
+        self.subscriptions.discard(event.get('group'))
+        await self.queue(event, default_username='System')
+
+    async def queue(self, event, default_username=None):
+        group = event.get('group') # Absent from events sent by workers running older code
+        room = room_display_name(group) if group else None
+        self.pending.append(codec.with_room(event_frame(event, default_username), room))
+        if len(self.pending) >= getattr(settings, 'CHAT_MONITOR_BATCH_SIZE', 50):
+            await self.flush()
+        elif self.flusher is None:
+            self.flusher = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(getattr(settings, 'CHAT_MONITOR_BATCH_MS', 100) / 1000)
+        self.flusher = None
+        await self.flush()
+
+    async def flush(self):
+        if self.flusher is not None and self.flusher is not asyncio.current_task():
+            self.flusher.cancel()
+            self.flusher = None
+        frames, self.pending = self.pending, []
+        if frames and not self.is_closing:
+            await self.send(text_data=codec.encode_batch(frames))
+
+    async def close_stale(self):
+        """
+        Called by chat.heartbeat when the client went quiet.
+        """
+        lifecycle.live_monitors.discard(self)
+        self.is_closing = True
+        await self.close(code=heartbeat.STALE)
+
+    async def close_for_restart(self):
+        self.is_closing = True
+        await self.close(code=lifecycle.SERVICE_RESTART)
+
+
+
+class LobbyConsumer(AsyncWebsocketConsumer):
+    """
+    Live room list, at ws/lobby/, for logged-in users.
+
+    Sends {"rooms": {"table 1": 3, ...}} (occupied rooms and their member
+    counts) once, then only what changed, at most once per CHAT_LOBBY_WINDOW_MS:
+
+        {"added": {"table 2": 1}, "changed": {"table 1": 4}, "removed": ["table 3"]}
+
+    See chat.lobby for where the changes come from.
+    """
+
+    async def connect(self):
+        self.subscriptions = {lobby.LOBBY_GROUP} # For chat.heartbeat
+        self.is_closing = False
+        self.heartbeat = False
+        self.last_seen = time.monotonic()
+        self.rooms = {} # Display name -> members, as last sent
+        self.updated_at = {} # Display name -> time of the newest count seen
+        self.pending = {}
+        self.flusher = None
+        user = self.scope.get('user')
+        if lifecycle.is_draining():
+            await self.reject_connection(lifecycle.SERVICE_RESTART)
+            return
+        if user is None or not user.is_authenticated:
+            await self.reject_connection(4003)
+            return
+        self.heartbeat = b'heartbeat=1' in self.scope.get('query_string', b'').split(b'&')
+        # Join first, so nothing that changes while the snapshot is read is missed.
+        await self.channel_layer.group_add(lobby.LOBBY_GROUP, self.channel_name)
+        self.snapshot_at = time.time()
+        occupied = await get_room_registry().aoccupied_rooms()
+        self.rooms = {room_display_name(name): members for name, members in occupied.items()}
+        await self.accept()
+        await self.send(text_data=codec.dumps({'rooms': self.rooms}))
+        lifecycle.live_monitors.add(self)
+        heartbeat.heartbeat.ensure_running()
+
+    async def reject_connection(self, code):
+        metrics.REJECTED_CONNECTS.labels(str(code)).inc()
+        await self.close(code=code)
+
+    async def disconnect(self, close_code):
+        lifecycle.live_monitors.discard(self)
+        self.is_closing = True
+        if self.flusher is not None:
+            self.flusher.cancel()
+        await self.channel_layer.group_discard(lobby.LOBBY_GROUP, self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        self.last_seen = time.monotonic() # Pongs; the lobby takes no other input
+
+    async def lobby_update(self, event):
+        if self.is_closing:
+            return
+        for group_name, (members, read_at) in event['rooms'].items():
+            name = room_display_name(group_name)
+            # Counts read before the snapshot, or older than one already seen, are stale.
+            if read_at < self.updated_at.get(name, self.snapshot_at):
+                continue
+            self.updated_at[name] = read_at
+            self.pending[name] = members
+        if self.pending and self.flusher is None:
+            self.flusher = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(lobby.window())
+        self.flusher = None
+        updates, self.pending = self.pending, {}
+        changes = lobby.delta(self.rooms, updates)
+        if changes and not self.is_closing:
+            await self.send(text_data=codec.dumps(changes))
+
+    async def close_stale(self):
+        lifecycle.live_monitors.discard(self)
+        self.is_closing = True
+        await self.close(code=heartbeat.STALE)
+
+    async def close_for_restart(self):
+        self.is_closing = True
+        await self.close(code=lifecycle.SERVICE_RESTART)
@@ -0,0 +1,171 @@
+"""
+Event-loop health monitoring and on-demand profiling for the ASGI process.
+
+LoopMonitorMiddleware (installed in chat_project/asgi.py) starts two watchers
+the first time the application is called:
+
+- a lag sampler on the event loop that sleeps LOOP_LAG_SAMPLE_INTERVAL_MS and
+  records how late it woke up in chat_event_loop_lag_seconds. Lag is the time
+  every other coroutine on the loop (handshakes, group_send, Redis replies)
+  was kept waiting.
+- a watchdog thread that notices when the loop has not ticked for
+  LOOP_LAG_WARN_MS and logs the loop thread's stack *while it is stuck*, so
+  the log names the slow callback (a synchronous DB query, a CPU-heavy
+  encode, ...) rather than only reporting that something was slow.
+
+profile_cpu and snapshot_memory back the staff-only /debug/profile/ view.
+Both run in a helper thread while the loop keeps serving traffic, so the
+profile shows what the live process is doing.
+"""
+import asyncio
+import collections
+import logging
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+
+from django.conf import settings
+
+from .metrics import LOOP_LAG_SECONDS, LOOP_STALLS
+
+logger = logging.getLogger(__name__)
+
+
+class LoopMonitor:
+    def __init__(self, interval=0.5, warn_after=0.1):
+        self.interval = interval
+        self.warn_after = warn_after
+        self.loop = None
+        self.loop_thread_id = None
+        self.last_tick = time.monotonic()
+        self._task = None
+
+    def start(self, loop):
+        self.loop = loop
+        self.loop_thread_id = threading.get_ident()
+        self.last_tick = time.monotonic()
+        self._task = loop.create_task(self._sample())
+        threading.Thread(target=self._watch, name='loop-watchdog', daemon=True).start()
+
+    async def _sample(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.last_tick = now
+            lag = max(now - expected, 0)
+            LOOP_LAG_SECONDS.observe(lag)
+            if lag >= self.warn_after:
+                logger.warning(f"Event loop lag: {lag * 1000:.0f} ms")
+
+    def _watch(self):
+        reported_tick = None
+        while not self.loop.is_closed():
+            time.sleep(self.warn_after / 2)
+            tick = self.last_tick
+            stalled_for = time.monotonic() - tick - self.interval
+            if stalled_for < self.warn_after or tick == reported_tick:
+                continue
+            reported_tick = tick # One report per stall
+            LOOP_STALLS.inc()
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame, limit=30)) if frame is not None else '(unavailable)\n'
+            logger.warning(f"Event loop blocked for {stalled_for * 1000:.0f} ms; loop thread is at:\n{stack}")
+
+
+_loop_monitor = None
+
+
+def get_loop_monitor():
+    """
+    Returns the running process's LoopMonitor, or None if it is disabled or not started yet.
+    """
+    return _loop_monitor
+
+
+class LoopMonitorMiddleware:
+    """
+    Starts the LoopMonitor on the server's event loop the first time a
+    connection arrives; every call after that is a single attribute check.
+    LOOP_LAG_WARN_MS = 0 disables it.
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.started = False
+
+    async def __call__(self, scope, receive, send):
+        if not self.started:
+            self.started = True
+            self.start_monitor()
+        return await self.inner(scope, receive, send)
+
+    def start_monitor(self):
+        global _loop_monitor
+        warn_after = getattr(settings, 'LOOP_LAG_WARN_MS', 100)
+        if not warn_after:
+            return
+        _loop_monitor = LoopMonitor(
+            interval=getattr(settings, 'LOOP_LAG_SAMPLE_INTERVAL_MS', 500) / 1000,
+            warn_after=warn_after / 1000,
+        )
+        _loop_monitor.start(asyncio.get_running_loop())
+
+
+# Only one profile may run at a time: two samplers would distort each other,
+# and tracemalloc is process-global.
+profile_lock = threading.Lock()
+
+
+def profile_cpu(seconds, thread_id=None, interval=0.005, limit=40):
+    """
+    Statistical profile: samples the stack of thread_id (default: the event
+    loop thread if the monitor is running, else every thread) every `interval`
+    seconds. Returns collapsed stacks ("outer;inner;leaf count"), hottest
+    first, which flamegraph.pl and speedscope read directly.
+    """
+    if thread_id is None and _loop_monitor is not None:
+        thread_id = _loop_monitor.loop_thread_id
+    own_id = threading.get_ident()
+    stacks = collections.Counter()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == own_id or (thread_id is not None and ident != thread_id):
+                continue
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f'{code.co_name} ({code.co_filename}:{frame.f_lineno})')
+                frame = frame.f_back
+            stacks[';'.join(reversed(names))] += 1
+        samples += 1
+        time.sleep(interval)
+    lines = [f'# {samples} samples over {seconds}s every {interval * 1000:.0f} ms']
+    lines += [f'{stack} {count}' for stack, count in stacks.most_common(limit)]
+    return '\n'.join(lines) + '\n'
+
+
+def snapshot_memory(seconds, limit=25):
+    """
+    Traces allocations for `seconds` and returns the top allocation sites by
+    size still alive at the end. If tracemalloc was already running its
+    earlier history is included and it is left running.
+    """
+    already_tracing = tracemalloc.is_tracing()
+    if not already_tracing:
+        tracemalloc.start(10)
+    try:
+        time.sleep(seconds)
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        if not already_tracing:
+            tracemalloc.stop()
+    snapshot = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+    lines = [f'# traced: current {current / 1024:.0f} KiB, peak {peak / 1024:.0f} KiB']
+    lines += [str(stat) for stat in snapshot.statistics('lineno')[:limit]]
+    return '\n'.join(lines) + '\n'
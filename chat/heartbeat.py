@@ -0,0 +1,129 @@
+"""
+Server-driven heartbeats for chat WebSockets.
+
+Every CHAT_HEARTBEAT_INTERVAL seconds each worker, for the ChatConsumers it
+holds:
+
+- sends ``{"type": "ping"}`` to sockets whose page answers pings (it connects
+  with ``?heartbeat=1`` and replies ``{"type": "pong"}``). Any frame from the
+  client counts as a sign of life; a socket silent for CHAT_HEARTBEAT_TIMEOUT
+  seconds is taken out of its room at once and closed with 4008, so a phone
+  that died without a close frame stops costing fan-out right away instead of
+  when TCP finally gives up.
+- renews the membership of every live consumer in the room registry and the
+  channel layer group, and the group subscriptions of staff monitor sockets. Members are only kept while some worker renews them,
+  so when a worker crashes its channels are pruned from the group and from
+  occupancy by the next worker to beat, rather than lingering until the
+  channel layer's group_expiry.
+- resends this worker's presence snapshots (see chat.presence), which other
+  workers forget once they are older than CHAT_HEARTBEAT_TIMEOUT.
+
+Pruning scans the occupied rooms, so every worker does it and a room whose
+last worker died is still cleaned up. Member timestamps are wall-clock times
+shared between machines; keep CHAT_HEARTBEAT_TIMEOUT well above the interval
+plus any clock skew.
+"""
+import collections
+import logging
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import lifecycle, lobby, metrics, presence
+from .room_registry import get_room_registry, invalidate_active_rooms
+
+logger = logging.getLogger(__name__)
+
+# Close code for "you went quiet (or were pruned); reconnect".
+STALE = 4008
+
+PING_FRAME = '{"type":"ping"}'
+PONG_FRAME = '{"type":"pong"}'
+
+
+def interval():
+    return getattr(settings, 'CHAT_HEARTBEAT_INTERVAL', 20)
+
+
+def timeout():
+    return getattr(settings, 'CHAT_HEARTBEAT_TIMEOUT', 45)
+
+
+async def beat():
+    """
+    One heartbeat for this process: ping, close silent sockets, renew, prune.
+    """
+    now = time.monotonic()
+    rooms = collections.defaultdict(list) # group name -> consumers still alive
+    for consumer in list(lifecycle.live_consumers):
+        if await check_alive(consumer, now):
+            rooms[consumer.room_group_name].append(consumer)
+    watched = collections.defaultdict(list) # group name -> monitor channels still alive
+    for monitor in list(lifecycle.live_monitors):
+        if await check_alive(monitor, now):
+            for group_name in monitor.subscriptions:
+                watched[group_name].append(monitor.channel_name)
+
+    registry = get_room_registry()
+    layer = get_channel_layer()
+    for group_name, consumers in rooms.items():
+        channels = [consumer.channel_name for consumer in consumers]
+        missing = set(await registry.atouch_members(group_name, channels))
+        for consumer in consumers:
+            if consumer.channel_name in missing:
+                # Another worker pruned us (this loop was stalled?) or the room is gone.
+                await consumer.close_stale()
+        channels = [name for name in channels if name not in missing] + watched.pop(group_name, [])
+        await refresh_group(layer, group_name, channels)
+    for group_name, channels in watched.items():
+        await refresh_group(layer, group_name, channels)
+
+    await prune_members(registry, layer, time.time() - timeout())
+    presence.refresh()
+
+
+async def check_alive(consumer, now):
+    """
+    Pings a socket that answers pings, or closes it if it has gone silent.
+    Returns whether it is still open.
+    """
+    if consumer.is_closing:
+        return False
+    if consumer.heartbeat and now - consumer.last_seen > timeout():
+        metrics.HEARTBEAT_PRUNED.labels('silent').inc()
+        logger.info(f"Closing {consumer.channel_name}: no frame for {now - consumer.last_seen:.0f}s")
+        await consumer.close_stale()
+        return False
+    if consumer.heartbeat:
+        await consumer.send(text_data=PING_FRAME)
+    return True
+
+
+async def refresh_group(layer, group_name, channels):
+    if not channels:
+        return
+    if hasattr(layer, 'group_refresh'):
+        await layer.group_refresh(group_name, channels)
+    else:
+        for channel in channels:
+            await layer.group_add(group_name, channel)
+
+
+async def prune_members(registry, layer, cutoff):
+    """
+    Removes members of every occupied room not renewed since `cutoff`.
+    """
+    for group_name, members in (await registry.aoccupied_rooms()).items():
+        stale = await registry.aprune_members(group_name, cutoff)
+        if not stale:
+            continue
+        metrics.HEARTBEAT_PRUNED.labels('expired').inc(len(stale))
+        logger.info(f"Pruned {len(stale)} stale members from '{group_name}'")
+        for channel in stale:
+            await layer.group_discard(group_name, channel)
+        await invalidate_active_rooms()
+        lobby.room_changed(group_name, members - len(stale))
+
+
+heartbeat = lifecycle.Periodic(beat, interval)
@@ -0,0 +1,128 @@
+"""
+Worker start-up and graceful shutdown.
+
+``warm_up()`` runs in ``manage.py serve`` before the workers are forked: it
+imports the URLconf and views, compiles the project's templates into the
+cached loader, builds the channel layer and renders the QR codes, so each forked worker starts
+with all of that already in (copy-on-write) memory and the first request
+pays for none of it.
+
+On SIGTERM the worker started by ``manage.py serve`` stops listening and
+calls ``drain()``. New handshakes that still reach this process are refused
+with close code 4012, and every open ChatConsumer (and staff or lobby socket)
+is closed with 4012 at a random moment within CHAT_DRAIN_SECONDS, so a full
+room does not reconnect in one burst. The page reconnects with jittered
+backoff and resumes from the replay buffer on a worker that is still up.
+"""
+import asyncio
+import logging
+import random
+import time
+import weakref
+from pathlib import Path
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Close code for "this worker is restarting, reconnect". The standard 1012 is reserved for
+# the server itself and applications may not send it, so use the 4000+ range like 4003/4004.
+SERVICE_RESTART = 4012
+
+# Accepted ChatConsumers, and the StaffMonitorConsumers and LobbyConsumers (monitors) in this process.
+live_consumers = weakref.WeakSet()
+live_monitors = weakref.WeakSet()
+
+draining = False
+
+# Seconds warm_up() took, or None if this process was not warmed up.
+warm_up_seconds = None
+
+
+def is_draining():
+    return draining
+
+
+class Periodic:
+    """
+    Runs the coroutine function `job` every `interval()` seconds on the event
+    loop ensure_running() was called from. An interval of 0 or less stops it.
+
+    Scheduled with call_later rather than a long-lived task, so an event loop
+    that is closed (a finished test, a worker shutting down) just drops it. A
+    run that outlasts the interval is never started twice at once.
+    """
+
+    def __init__(self, job, interval):
+        self.job = job
+        self.interval = interval
+        self.loop = None
+        self._running = None
+
+    def ensure_running(self):
+        loop = asyncio.get_running_loop()
+        if self.interval() <= 0 or self.loop is loop:
+            return
+        self.loop = loop
+        self._running = None
+        loop.call_later(self.interval(), self._tick)
+
+    def _tick(self):
+        if self.interval() <= 0:
+            self.loop = None
+            return
+        if self._running is None or self._running.done():
+            self._running = self.loop.create_task(self.run_once())
+        self.loop.call_later(self.interval(), self._tick)
+
+    async def run_once(self):
+        try:
+            await self.job()
+        except Exception as e:
+            logger.error(f"{self.job.__qualname__} failed: {e}", exc_info=True)
+
+
+def warm_up():
+    global warm_up_seconds
+    from channels.layers import get_channel_layer
+    from django.template import engines
+    from django.urls import get_resolver
+
+    from . import qr
+
+    started = time.perf_counter()
+    get_resolver().url_patterns # Imports every urls.py and the views they reference
+    base_dir = Path(settings.BASE_DIR).resolve()
+    for engine in engines.all():
+        for template_dir in engine.template_dirs:
+            template_dir = Path(template_dir).resolve()
+            if not template_dir.is_relative_to(base_dir):
+                continue # Only our own templates, not every admin template
+            for path in template_dir.rglob('*.html'):
+                engine.get_template(path.relative_to(template_dir).as_posix())
+    get_channel_layer() # Imports channels_redis and redis
+    qr.precompute() # Every worker inherits the rendered codes
+    warm_up_seconds = time.perf_counter() - started
+    logger.info(f"Warmed up in {warm_up_seconds * 1000:.0f} ms")
+
+
+async def drain(window=None):
+    """
+    Closes every live consumer at a random time within `window` seconds
+    (default CHAT_DRAIN_SECONDS) and returns once they have all been closed.
+    """
+    global draining
+    draining = True
+    if window is None:
+        window = getattr(settings, 'CHAT_DRAIN_SECONDS', 10)
+    consumers = list(live_consumers) + list(live_monitors)
+    logger.info(f"Draining {len(consumers)} WebSocket connections over {window}s")
+
+    async def close_later(consumer):
+        await asyncio.sleep(random.uniform(0, window))
+        try:
+            await consumer.close_for_restart()
+        except Exception as e:
+            logger.warning(f"Failed to close {consumer.channel_name} while draining: {e}")
+
+    await asyncio.gather(*(close_later(consumer) for consumer in consumers))
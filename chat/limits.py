@@ -0,0 +1,129 @@
+"""
+Abuse and overload protection for ChatConsumer.
+
+- Token buckets limit how fast one connection, and one room, may broadcast.
+- Frames larger than CHAT_MAX_FRAME_BYTES are rejected before being parsed.
+- A member is a slow consumer when its channel-layer queue backs up past
+  CHAT_SLOW_CONSUMER_QUEUE_SIZE (the consumer itself is behind) or its
+  socket holds more than CHAT_SLOW_CONSUMER_BUFFER_BYTES it could not send
+  yet (the client is not reading fast enough); depending on
+  CHAT_SLOW_CONSUMER_POLICY its frames are dropped or it is disconnected
+  (it then reconnects and catches up from the replay buffer). Presence
+  frames are dropped earlier, at half that backlog (see chat.presence).
+
+Every rejection is recorded with ``reject(reason)``.
+
+Room buckets live in the process, so with several workers each one enforces
+the room limit separately; members of one room normally share a worker, and
+the per-connection limit applies everywhere.
+"""
+import collections
+import time
+
+from django.conf import settings
+
+from .metrics import LIMIT_REJECTIONS
+
+# Rejection counters for this process; also exported as chat_limit_rejections_total.
+counters = collections.Counter()
+
+SLOW_CONSUMER_DROP = 'drop'
+SLOW_CONSUMER_DISCONNECT = 'disconnect'
+
+
+def reject(reason):
+    counters[reason] += 1
+    LIMIT_REJECTIONS.labels(reason).inc()
+
+
+class TokenBucket:
+    """
+    Allows `rate` events per second on average and bursts of up to `capacity`.
+    """
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def consume(self, tokens=1):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+
+def connection_bucket():
+    """
+    Returns a fresh bucket for one WebSocket connection, or None if unlimited.
+    """
+    rate = getattr(settings, 'CHAT_CONNECTION_RATE', 0)
+    if not rate:
+        return None
+    return TokenBucket(rate, getattr(settings, 'CHAT_CONNECTION_BURST', rate))
+
+
+_room_buckets = {}
+
+
+def room_bucket(group_name):
+    """
+    Returns this process's bucket for a room, or None if unlimited.
+    """
+    rate = getattr(settings, 'CHAT_ROOM_RATE', 0)
+    if not rate:
+        return None
+    bucket = _room_buckets.get(group_name)
+    if bucket is None:
+        bucket = _room_buckets[group_name] = TokenBucket(rate, getattr(settings, 'CHAT_ROOM_BURST', rate))
+    return bucket
+
+
+def discard_room_bucket(group_name):
+    _room_buckets.pop(group_name, None)
+
+
+def retain_room_buckets(group_names):
+    """
+    Drops the buckets of rooms not in `group_names`. A dropped bucket starts full
+    again if the room comes back, so only rooms without local members should go.
+    """
+    for group_name in list(_room_buckets):
+        if group_name not in group_names:
+            del _room_buckets[group_name]
+
+
+def max_frame_size():
+    return getattr(settings, 'CHAT_MAX_FRAME_BYTES', 4096)
+
+
+def is_slow_consumer(consumer, share=1):
+    """
+    True if the consumer has fallen behind the room, either way (limits times `share`):
+
+    - more than CHAT_SLOW_CONSUMER_QUEUE_SIZE messages wait in its channel's
+      in-process receive buffer: the consumer coroutine is not keeping up.
+      Layers without a receive buffer never count.
+    - more than CHAT_SLOW_CONSUMER_BUFFER_BYTES of frames it already sent wait
+      in the socket's write buffer: the client, or its network, is not reading.
+      daphne never applies backpressure to the app, so only ``manage.py serve``,
+      which puts ``write_buffer_size`` in the scope, measures this.
+    """
+    queue_size = getattr(settings, 'CHAT_SLOW_CONSUMER_QUEUE_SIZE', 0)
+    receive_buffer = getattr(consumer.channel_layer, 'receive_buffer', None)
+    if queue_size and receive_buffer is not None:
+        queue = receive_buffer.get(consumer.channel_name)
+        if queue is not None and queue.qsize() > queue_size * share:
+            return True
+    buffer_bytes = getattr(settings, 'CHAT_SLOW_CONSUMER_BUFFER_BYTES', 0)
+    write_buffer_size = consumer.scope.get('write_buffer_size')
+    return bool(buffer_bytes and write_buffer_size and write_buffer_size() > buffer_bytes * share)
+
+
+def slow_consumer_policy():
+    return getattr(settings, 'CHAT_SLOW_CONSUMER_POLICY', SLOW_CONSUMER_DROP)
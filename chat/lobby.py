@@ -0,0 +1,75 @@
+"""
+Live room list for the lobby (ws/lobby/, chat.consumers.LobbyConsumer).
+
+Whenever a room's occupancy changes, the code that changed it calls
+``room_changed(group_name, members)`` with the new count (0 once the room is
+empty or closed). Each process collects these for CHAT_LOBBY_WINDOW_MS and
+then sends a single ``lobby.update`` event to the lobby group carrying the
+latest count per room, so a burst of joins costs one group_send. Counts are
+stamped with the wall-clock time they were read, and a lobby socket keeps
+the newest count it has seen for each room, whichever worker it came from.
+"""
+import asyncio
+import logging
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+LOBBY_GROUP = 'lobby'
+
+_pending = {} # group name -> [members, time read]
+_flusher = None
+
+
+def window():
+    return getattr(settings, 'CHAT_LOBBY_WINDOW_MS', 500) / 1000
+
+
+def room_changed(group_name, members):
+    """
+    Queues the new member count of a room for the lobby feed.
+    """
+    global _flusher
+    _pending[group_name] = [max(members, 0), time.time()]
+    loop = asyncio.get_running_loop()
+    # A task left on the loop of a finished test (or one that died) never completes.
+    if _flusher is None or _flusher.done() or _flusher.get_loop() is not loop:
+        _flusher = loop.create_task(publish_later())
+
+
+async def publish_later():
+    await asyncio.sleep(window())
+    await publish()
+
+
+async def publish():
+    global _pending
+    rooms, _pending = _pending, {}
+    if not rooms:
+        return
+    try:
+        await get_channel_layer().group_send(LOBBY_GROUP, {'type': 'lobby.update', 'rooms': rooms})
+    except Exception as e: # The lobby is best effort; rooms work without it
+        logger.warning(f"Failed to publish {len(rooms)} lobby updates: {e}")
+
+
+def delta(known, updates):
+    """
+    Applies {room: members} updates to `known` in place and returns the
+    change as a frame payload: rooms added, member counts changed, rooms removed.
+    """
+    added, changed, removed = {}, {}, []
+    for room, members in updates.items():
+        before = known.get(room)
+        if members <= 0:
+            if before is not None:
+                removed.append(room)
+                del known[room]
+        elif before is None:
+            added[room] = known[room] = members
+        elif before != members:
+            changed[room] = known[room] = members
+    return {name: value for name, value in (('added', added), ('changed', changed), ('removed', removed)) if value}
@@ -0,0 +1,154 @@
+"""
+Logging that stays off the event loop (wired up in settings.LOGGING).
+
+``BackgroundHandler`` puts each record on a bounded queue and returns; a
+thread formats and writes it. Records are queued unformatted, so the message
+and its %-style arguments are only turned into text on that thread. When the
+queue is full the record is dropped and counted in
+chat_log_records_dropped_total, rather than blocking the loop on a slow
+stderr. The thread is restarted in every forked worker.
+
+``JSONFormatter`` writes one JSON object per line, with the ``extra`` fields
+of the call (``event``, ``room``...) as keys.
+
+``EventSampler`` thins out the records that carry an ``event`` in their
+extra: each event type is kept with probability LOG_SAMPLE_RATES[event] and
+at most LOG_MAX_PER_SECOND[event] times a second per process. A kept record
+says how many were skipped before it (``sample_rate``, ``suppressed``).
+Records without an event are never sampled.
+
+Hot-path call sites pass %-style arguments rather than f-strings, and ask
+``sample()`` before logging, so a disabled level or a sampled-out record
+costs neither a LogRecord nor any formatting.
+"""
+import collections
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+
+# Attributes every LogRecord has; anything else came from `extra`.
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+
+class Listener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel) # Wait for room rather than lose the records queued before it
+
+
+class BackgroundHandler(logging.handlers.QueueHandler):
+    """
+    Writes records to `stream` (stderr by default) from a background thread.
+    """
+
+    def __init__(self, stream=None, max_queue=10000):
+        self.target = logging.StreamHandler(stream or sys.stderr)
+        self.max_queue = max_queue
+        super().__init__(queue.Queue(max_queue))
+        self.start()
+        os.register_at_fork(after_in_child=self.start) # Threads do not survive a fork
+
+    def start(self):
+        # A new queue in a forked child: the parent's records are the parent's to write.
+        self.queue = queue.Queue(self.max_queue)
+        self.writer = Listener(self.queue, self.target)
+        self.writer.start()
+
+    def setFormatter(self, fmt):
+        self.target.setFormatter(fmt) # Formatting happens on the listener thread
+
+    def prepare(self, record):
+        return record # Unlike QueueHandler, don't format here
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            from .metrics import LOG_RECORDS_DROPPED # Not at import: settings.LOGGING is read first
+
+            LOG_RECORDS_DROPPED.inc()
+
+    def flush(self):
+        self.queue.join() # Until the thread has written everything queued so far
+        self.target.flush()
+
+    def close(self):
+        if self.writer._thread is not None:
+            self.writer.stop()
+        self.target.close()
+        super().close()
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in RECORD_ATTRIBUTES)
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False, separators=(',', ':'))
+
+
+class EventSampler(logging.Filter):
+    installed = None # The one settings.LOGGING configured, for sample()
+
+    def __init__(self, rates=None, max_per_second=None):
+        super().__init__()
+        self.rates = rates or {}
+        self.max_per_second = max_per_second or {}
+        self.windows = {} # event -> [second, records kept in it]
+        self.suppressed = collections.Counter()
+        EventSampler.installed = self
+
+    def filter(self, record):
+        event = getattr(record, 'event', None)
+        if event is None or getattr(record, 'sampled', False):
+            return True
+        extra = self.sample(event)
+        if extra is None:
+            return False
+        record.__dict__.update(extra)
+        return True
+
+    def sample(self, event):
+        """
+        Decides whether to keep one record of `event`. Returns None to drop it, else its extra fields.
+        """
+        rate = self.rates.get(event, 1)
+        if rate < 1 and random.random() >= rate:
+            return None # Sampled out; not counted as suppressed, since sample_rate accounts for it
+        limit = self.max_per_second.get(event)
+        if limit is not None:
+            second = int(time.monotonic())
+            window = self.windows.get(event)
+            if window is None or window[0] != second:
+                window = self.windows[event] = [second, 0]
+            if window[1] >= limit:
+                self.suppressed[event] += 1
+                return None
+            window[1] += 1
+        extra = {'event': event, 'sampled': True}
+        if rate < 1:
+            extra['sample_rate'] = rate
+        suppressed = self.suppressed.pop(event, 0)
+        if suppressed:
+            extra['suppressed'] = suppressed
+        return extra
+
+
+def sample(event):
+    """
+    Asks the configured EventSampler about one record of `event` before it is built:
+    log it with extra=sample(event) unless that is None. Hot paths use this so that
+    records the sampler would drop cost neither a LogRecord nor a formatted message.
+    """
+    sampler = EventSampler.installed
+    return {'event': event, 'sampled': True} if sampler is None else sampler.sample(event)
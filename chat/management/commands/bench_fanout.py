@@ -0,0 +1,177 @@
+import asyncio
+import json
+import logging
+import statistics
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat import codec, logs
+from chat.channel_layers import HybridRedisChannelLayer
+from chat.consumers import ChatConsumer
+
+
+async def discard_frame(text_data=None, bytes_data=None, close=False):
+    pass
+
+
+def make_recipients(count):
+    recipients = []
+    for i in range(count):
+        consumer = ChatConsumer()
+        consumer.channel_name = f'specific.bench!{i}'
+        consumer.channel_layer = None
+        consumer.scope = {} # No socket behind it, so no write buffer to measure
+        consumer.is_closing = False
+        consumer.send = discard_frame
+        recipients.append(consumer)
+    return recipients
+
+
+async def per_recipient_encoding(recipients, message, username):
+    # What every chat_message handler did before: json.dumps the event for its own socket.
+    event = {'type': 'chat.message', 'message': message, 'username': username}
+    for consumer in recipients:
+        await consumer.send(text_data=json.dumps({'message': event['message'], 'username': event['username']}))
+
+
+async def encode_once(recipients, message, username):
+    event = {'type': 'chat.message', 'frame': codec.encode_chat_frame(message, username)}
+    for consumer in recipients:
+        await consumer.chat_message(event)
+
+
+async def eager_logging(recipients, message, username):
+    # What receive and chat_message logged before: f-strings with the full text, per message and per recipient.
+    logger = logging.getLogger('chat.consumers')
+    logger.info(f"Message from '{username}': '{message}' in room 'bench'")
+    frame = codec.encode_chat_frame(message, username)
+    for consumer in recipients:
+        logger.debug(f"Broadcasting frame to {consumer.channel_name}: {frame}")
+        await consumer.send(text_data=frame)
+
+
+async def sampled_logging(recipients, message, username):
+    logger = logging.getLogger('chat.consumers')
+    if logger.isEnabledFor(logging.INFO) and (extra := logs.sample('chat.message')):
+        logger.info(
+            "Message from '%s' in room '%s' (%d chars)", username, 'bench', len(message),
+            extra={**extra, 'room': 'bench', 'username': username},
+        )
+    await encode_once(recipients, message, username)
+
+
+def logging_handlers(stream):
+    sync = logging.StreamHandler(stream)
+    sync.setFormatter(logging.Formatter('{levelname} {name}: {message}', style='{'))
+    background = logs.BackgroundHandler(stream)
+    background.setFormatter(logs.JSONFormatter())
+    background.addFilter(logs.EventSampler(settings.LOG_SAMPLE_RATES, settings.LOG_MAX_PER_SECOND))
+    return (
+        ('StreamHandler, eager f-strings', sync, eager_logging),
+        ('BackgroundHandler, sampled', background, sampled_logging),
+    )
+
+
+async def group_send_latencies(layer, recipients, messages):
+    """
+    Times group_send until every (process-local) member has received the message.
+    """
+    group = 'chat_bench_fanout'
+    channels = [await layer.new_channel() for _ in range(recipients)]
+    for channel in channels:
+        await layer.group_add(group, channel)
+    frame = codec.encode_chat_frame('bench', 'Bench Guest')
+    latencies = []
+    try:
+        for _ in range(messages):
+            started = time.perf_counter()
+            await layer.group_send(group, {'type': 'chat.message', 'frame': frame})
+            await asyncio.gather(*(layer.receive(channel) for channel in channels))
+            latencies.append(time.perf_counter() - started)
+    finally:
+        for channel in channels:
+            await layer.group_discard(group, channel)
+        await layer.flush()
+    return latencies
+
+
+class Command(BaseCommand):
+    help = "Measures per-message CPU of broadcasting one chat line to every member of a room."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipients', type=int, default=200)
+        parser.add_argument('--messages', type=int, default=2000)
+        parser.add_argument('--message-bytes', type=int, default=120)
+        parser.add_argument(
+            '--redis-url',
+            help="Also compare group_send latency of RedisChannelLayer and HybridRedisChannelLayer on this Redis.",
+        )
+        parser.add_argument(
+            '--logging', action='store_true',
+            help="Also compare event loop CPU with DEBUG logging on the hot path, written to a temporary file.",
+        )
+
+    def handle(self, *args, **options):
+        recipients = make_recipients(options['recipients'])
+        message = ('Table 12 would like more water, gracias! ' * 10)[:options['message_bytes']]
+        results = {}
+        for label, strategy in (('encode per recipient', per_recipient_encoding), ('encode once', encode_once)):
+            results[label] = asyncio.run(self._run(strategy, recipients, message, options['messages']))
+
+        self.stdout.write(
+            f"{options['messages']} messages x {options['recipients']} recipients, codec={codec.CODEC_NAME}"
+        )
+        for label, cpu_seconds in results.items():
+            per_message_us = cpu_seconds / options['messages'] * 1_000_000
+            self.stdout.write(f"  {label:<22} {per_message_us:10.1f} us CPU per message")
+        saved = results['encode per recipient'] - results['encode once']
+        self.stdout.write(f"  saved                  {saved / options['messages'] * 1_000_000:10.1f} us CPU per message")
+
+        if options['redis_url']:
+            self._compare_channel_layers(options['redis_url'], options['recipients'], min(options['messages'], 200))
+        if options['logging']:
+            self._compare_logging(recipients, message, options['messages'])
+
+    def _compare_channel_layers(self, redis_url, recipients, messages):
+        from channels_redis.core import RedisChannelLayer
+
+        self.stdout.write(f"group_send -> all received, {recipients} local members, {messages} messages")
+        for layer_class in (RedisChannelLayer, HybridRedisChannelLayer):
+            latencies = asyncio.run(group_send_latencies(layer_class(hosts=[redis_url]), recipients, messages))
+            self.stdout.write(
+                f"  {layer_class.__name__:<24} median {statistics.median(latencies) * 1000:8.2f} ms"
+                f"   max {max(latencies) * 1000:8.2f} ms"
+            )
+
+    def _compare_logging(self, recipients, message, messages):
+        logger = logging.getLogger('chat.consumers')
+        saved_state = logger.level, logger.handlers, logger.propagate
+        installed_sampler = logs.EventSampler.installed
+        self.stdout.write(f"DEBUG logging, event loop thread CPU ({len(recipients)} recipients, {messages} messages)")
+        results = {}
+        with tempfile.TemporaryFile('w') as stream:
+            for label, handler, strategy in logging_handlers(stream):
+                logger.setLevel(logging.DEBUG)
+                logger.handlers, logger.propagate = [handler], False
+                try:
+                    # thread_time: only what the loop thread spent, not the background writer.
+                    results[label] = asyncio.run(self._run(strategy, recipients, message, messages, time.thread_time))
+                finally:
+                    handler.flush()
+                    handler.close()
+                    logger.setLevel(saved_state[0])
+                    logger.handlers, logger.propagate = saved_state[1], saved_state[2]
+                self.stdout.write(f"  {label:<32} {results[label] / messages * 1_000_000:10.1f} us per message")
+            self.stdout.write(f"  wrote {stream.tell() / 1024:.0f} KB of logs")
+        logs.EventSampler.installed = installed_sampler
+        eager, sampled = results.values()
+        self.stdout.write(f"  {'saved':<32} {(eager - sampled) / messages * 1_000_000:10.1f} us per message")
+
+    async def _run(self, strategy, recipients, message, messages, clock=time.process_time):
+        started = clock()
+        for _ in range(messages):
+            await strategy(recipients, message, 'Bench Guest')
+        return clock() - started
@@ -0,0 +1,113 @@
+import statistics
+import time
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.redis_pool import get_redis
+from chat.room_registry import ACTIVE_ROOMS_CACHE_KEY, RedisRoomRegistry, room_display_name
+
+BENCH_PREFIX = 'bench:'
+LEGACY_GROUP_PREFIX = 'bench:asgi:group:'
+
+
+def legacy_scan_listing(client, registry):
+    """
+    The list_active_rooms implementation this benchmark replaces: SCAN the whole
+    keyspace for group keys, then TYPE + SCARD (plus a registry check) per room.
+    """
+    active_rooms = []
+    for group_key in client.scan_iter(match=f'{LEGACY_GROUP_PREFIX}chat_*'):
+        group_name = group_key[len(LEGACY_GROUP_PREFIX):]
+        if client.type(group_key) != 'set':
+            continue
+        if not registry.exists(group_name):
+            continue
+        if client.scard(group_key) > 0:
+            active_rooms.append(room_display_name(group_name))
+    return sorted(set(active_rooms))
+
+
+def indexed_listing(registry):
+    return sorted(room_display_name(group_name) for group_name in registry.occupied_rooms())
+
+
+class Command(BaseCommand):
+    help = "Benchmarks the room list: legacy keyspace SCAN vs the occupancy index vs the cached list."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=10000)
+        parser.add_argument('--members', type=int, default=3, help="Connected channels per room.")
+        parser.add_argument('--repeat', type=int, default=10)
+        parser.add_argument(
+            '--redis-url',
+            help="Redis to benchmark against. Defaults to fakeredis when it is installed.",
+        )
+
+    def handle(self, *args, **options):
+        client = self._client(options['redis_url'])
+        registry = RedisRoomRegistry(url=options['redis_url'] or 'redis://unused', prefix=BENCH_PREFIX)
+        registry._client = lambda url: client
+
+        self._cleanup(client)
+        try:
+            self._populate(client, registry, options['rooms'], options['members'])
+            expected = indexed_listing(registry)
+            if legacy_scan_listing(client, registry) != expected:
+                raise CommandError("Legacy and indexed listings disagree.")
+
+            results = [
+                ('legacy SCAN + TYPE/SCARD', self._time(lambda: legacy_scan_listing(client, registry), options['repeat'])),
+                ('occupancy index', self._time(lambda: indexed_listing(registry), options['repeat'])),
+            ]
+            cache.set(ACTIVE_ROOMS_CACHE_KEY, expected, 60)
+            results.append(('cached list', self._time(lambda: cache.get(ACTIVE_ROOMS_CACHE_KEY), options['repeat'])))
+            cache.delete(ACTIVE_ROOMS_CACHE_KEY)
+        finally:
+            self._cleanup(client)
+
+        self.stdout.write(f"{options['rooms']} rooms x {options['members']} members, {options['repeat']} runs")
+        for label, timings in results:
+            self.stdout.write(
+                f"  {label:<26} median {statistics.median(timings) * 1000:9.2f} ms"
+                f"   max {max(timings) * 1000:9.2f} ms"
+            )
+
+    def _client(self, redis_url):
+        if redis_url:
+            return get_redis(redis_url)
+        try:
+            import fakeredis
+        except ImportError:
+            raise CommandError("Pass --redis-url or install fakeredis[lua].")
+        return fakeredis.FakeRedis(decode_responses=True)
+
+    def _populate(self, client, registry, rooms, members):
+        now = time.time()
+        pipe = client.pipeline(transaction=False)
+        for i in range(rooms):
+            group_name = f'chat_table_{i}'
+            channels = [f'specific.bench!{i}.{m}' for m in range(members)]
+            pipe.hset(registry.room_key(group_name), mapping={
+                'secret': 's', 'creator_username': 'bench', 'created_at': now + i,
+            })
+            pipe.zadd(registry.index_key, {group_name: now + i})
+            pipe.zadd(registry.members_key(group_name), {channel: now for channel in channels})
+            pipe.zadd(registry.occupancy_key, {group_name: members})
+            pipe.sadd(f'{LEGACY_GROUP_PREFIX}{group_name}', *channels)
+            if i % 1000 == 999:
+                pipe.execute()
+        pipe.execute()
+
+    def _cleanup(self, client):
+        keys = list(client.scan_iter(match=f'{BENCH_PREFIX}*'))
+        for start in range(0, len(keys), 1000):
+            client.delete(*keys[start:start + 1000])
+
+    def _time(self, func, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - started)
+        return timings
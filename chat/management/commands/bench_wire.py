@@ -0,0 +1,110 @@
+import random
+import time
+import zlib
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat import codec
+
+# Lines are built from random words, so deflate can't just find whole repeated messages.
+SAMPLE_WORDS = (
+    "table water bill please more bread coffee café con leche two three four ready to order kitchen open "
+    "thanks gracias is the still can we get a for with without ice sugar menu dessert wine beer salad "
+    "soup chicken fish vegan gluten free allergy napkins spoon fork knife sauce spicy hot cold check "
+    "card cash tip outside inside window high chair birthday cake candles waiter here now sorry late 🙏 👍"
+).split()
+SAMPLE_NAMES = ['Ana', 'Bob', 'Anonymous', 'Table 7', 'María José', 'Guest 12', 'alice']
+
+
+def sample_frames(count, message_bytes):
+    rng = random.Random(12) # Same sample on every run
+    frames = []
+    for seq in range(1, count + 1):
+        words = []
+        while len(' '.join(words).encode()) < message_bytes:
+            words.append(rng.choice(SAMPLE_WORDS))
+        frames.append((seq, rng.choice(SAMPLE_NAMES), ' '.join(words).capitalize()))
+    return frames
+
+
+def encode_json(seq, username, message):
+    return codec.with_seq(codec.encode_chat_frame(message, username), seq).encode()
+
+
+def encode_msgpack(seq, username, message):
+    return codec.pack_chat_frame(message, username, seq)
+
+
+def websocket_header_bytes(payload_bytes):
+    # Server frames are unmasked: 2 bytes, plus 2 or 8 for the extended length.
+    if payload_bytes < 126:
+        return 2
+    return 4 if payload_bytes < 65536 else 10
+
+
+def deflated_sizes(payloads, window_bits, context_takeover):
+    """
+    Payload sizes after permessage-deflate, as autobahn compresses them in "manage.py serve".
+    """
+    sizes = []
+    compressor = None
+    for payload in payloads:
+        if compressor is None or not context_takeover:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -window_bits, 4)
+        data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        sizes.append(len(data) - 4) # The trailing 00 00 ff ff is not sent
+    return sizes
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the JSON and MessagePack chat frame formats: bytes on the wire (raw and with "
+        "permessage-deflate) and CPU to encode and decode a frame."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=20000)
+        parser.add_argument('--message-bytes', type=int, default=40, help="Minimum length of each chat line.")
+        parser.add_argument(
+            '--window-bits', type=int, default=getattr(settings, 'CHAT_WS_COMPRESSION_WINDOW_BITS', 11),
+        )
+
+    def handle(self, *args, **options):
+        frames = sample_frames(options['messages'], options['message_bytes'])
+        formats = (
+            ('json', encode_json, codec.loads),
+            ('msgpack', encode_msgpack, codec.unpack),
+        )
+        self.stdout.write(
+            f"{len(frames)} chat frames, json codec={codec.CODEC_NAME}, deflate window 2**{options['window_bits']}"
+        )
+        self.stdout.write(
+            f"  {'format':<8} {'raw B':>7} {'deflate B':>10} {'no ctx B':>9} {'encode us':>10} {'decode us':>10}"
+            f" {'deflate us':>11}"
+        )
+        for name, encode, decode in formats:
+            started = time.process_time()
+            payloads = [encode(*frame) for frame in frames]
+            encode_seconds = time.process_time() - started
+            started = time.process_time()
+            for payload in payloads:
+                decode(payload)
+            decode_seconds = time.process_time() - started
+
+            raw = [len(payload) for payload in payloads]
+            started = time.process_time()
+            deflated = deflated_sizes(payloads, options['window_bits'], context_takeover=True)
+            deflate_seconds = time.process_time() - started
+            no_context = deflated_sizes(payloads, options['window_bits'], context_takeover=False)
+            on_wire = lambda sizes: sum(size + websocket_header_bytes(size) for size in sizes) / len(sizes)
+            self.stdout.write(
+                f"  {name:<8} {on_wire(raw):7.1f} {on_wire(deflated):10.1f} {on_wire(no_context):9.1f}"
+                f" {encode_seconds / len(frames) * 1e6:10.2f} {decode_seconds / len(frames) * 1e6:10.2f}"
+                f" {deflate_seconds / len(frames) * 1e6:11.2f}"
+            )
+        self.stdout.write(
+            "  Bytes are per frame including the WebSocket header; \"no ctx\" is deflate without context "
+            "takeover. Encoding happens once per message; deflate runs once per recipient socket. Decode is "
+            "what a client does; json decodes bytes here, as a browser decodes text."
+        )
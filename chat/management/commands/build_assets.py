@@ -0,0 +1,105 @@
+import gzip
+import subprocess
+from html.parser import HTMLParser
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.template.loader import render_to_string
+
+from chat.templatetags.assets import STYLESHEET
+
+
+class HeadParser(HTMLParser):
+    """
+    Collects the URLs of the render-blocking scripts and stylesheets in <head>.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.in_head = False
+        self.blocking = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'head':
+            self.in_head = True
+        elif not self.in_head:
+            return
+        elif tag == 'script' and attrs.get('src') and not {'async', 'defer'} & attrs.keys() and attrs.get('type') != 'module':
+            self.blocking.append(attrs['src'])
+        elif tag == 'link' and attrs.get('rel') == 'stylesheet' and attrs.get('media', 'all') in ('all', 'screen'):
+            self.blocking.append(attrs['href'])
+
+    def handle_endtag(self, tag):
+        if tag == 'head':
+            self.in_head = False
+
+
+def render_blocking(html):
+    parser = HeadParser()
+    parser.feed(html)
+    return parser.blocking
+
+
+class Command(BaseCommand):
+    help = (
+        "Compiles assets/app.css with Tailwind, keeping only the classes the templates use, runs collectstatic "
+        "(hashed names plus gzip and brotli copies) and fails if the result is over ASSET_CSS_BUDGET_BYTES "
+        "or base.html has render-blocking files beyond ASSET_RENDER_BLOCKING_MAX."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tailwind', default='tailwindcss', help="Tailwind CLI (pip install tailwindcss-bin).")
+        parser.add_argument('--clear', action='store_true', help="Passed on to collectstatic.")
+        parser.add_argument('--check', action='store_true', help="Only check the budgets of the collected files.")
+
+    def handle(self, *args, **options):
+        if not options['check']:
+            self.compile(options['tailwind'])
+            call_command('collectstatic', interactive=False, clear=options['clear'], verbosity=0)
+        self.check_budgets()
+
+    def compile(self, tailwind):
+        base_dir = Path(settings.BASE_DIR)
+        output = base_dir / 'assets' / 'build' / STYLESHEET
+        try:
+            subprocess.run(
+                [tailwind, '--input', 'assets/app.css', '--output', str(output.relative_to(base_dir)), '--minify'],
+                cwd=base_dir, check=True, capture_output=True, text=True,
+            )
+        except FileNotFoundError:
+            raise CommandError(f"Tailwind CLI not found: {tailwind}")
+        except subprocess.CalledProcessError as e:
+            raise CommandError(f"Tailwind failed:\n{e.stderr}")
+        self.stdout.write(f"Compiled {output.relative_to(base_dir)}")
+
+    def check_budgets(self):
+        try:
+            path = Path(staticfiles_storage.path(staticfiles_storage.stored_name(STYLESHEET)))
+        except ValueError:
+            raise CommandError(f"{STYLESHEET} has not been built and collected; run build_assets without --check.")
+        raw = path.read_bytes()
+        sizes = {'raw': len(raw), 'gzip': len(gzip.compress(raw, 9))}
+        for suffix, encoding in (('.gz', 'gzip'), ('.br', 'brotli')):
+            compressed = path.with_name(path.name + suffix)
+            if compressed.exists(): # What WhiteNoise will actually send
+                sizes[encoding] = compressed.stat().st_size
+        self.stdout.write(f"{path.name}: " + ', '.join(f"{size / 1024:.1f} KB {encoding}" for encoding, size in sizes.items()))
+
+        problems = []
+        css_bytes = min(sizes.values())
+        if css_bytes > settings.ASSET_CSS_BUDGET_BYTES:
+            problems.append(f"{STYLESHEET} is {css_bytes} bytes compressed, over the {settings.ASSET_CSS_BUDGET_BYTES} byte budget")
+
+        blocking = render_blocking(render_to_string('base.html'))
+        self.stdout.write(f"Render-blocking in base.html: {', '.join(blocking) or 'nothing'}")
+        if len(blocking) > settings.ASSET_RENDER_BLOCKING_MAX:
+            problems.append(f"base.html loads {len(blocking)} render-blocking files (budget {settings.ASSET_RENDER_BLOCKING_MAX})")
+        problems += [f"base.html blocks rendering on another origin: {url}" for url in blocking if '//' in url]
+
+        if problems:
+            raise CommandError('Over budget:\n' + '\n'.join(problems))
+        self.stdout.write("Within budget")
@@ -0,0 +1,50 @@
+import asyncio
+import time
+
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand, CommandError
+
+from chat import redis_pool, teardown
+from chat.room_registry import get_room_registry, room_group_name
+
+
+class Command(BaseCommand):
+    help = (
+        "Closes chat rooms for everyone in them and frees their state (see chat.teardown). "
+        "Pass room names, or --idle to close the rooms empty for longer than CHAT_EMPTY_ROOM_TTL."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('rooms', nargs='*', help="Room names as shown on /rooms/.")
+        parser.add_argument('--idle', action='store_true', help="Close every room idle for longer than the TTL.")
+
+    def handle(self, *args, **options):
+        if not options['rooms'] and not options['idle']:
+            raise CommandError("Pass room names or --idle.")
+        closed = asyncio.run(self.close(options['rooms'], options['idle']))
+        for group_name in closed:
+            self.stdout.write(f"Closed {group_name}")
+        self.stdout.write(f"{len(closed)} rooms closed")
+
+    async def close(self, rooms, idle):
+        try:
+            return await self.close_rooms(rooms, idle)
+        finally:
+            layer = get_channel_layer()
+            if hasattr(layer, 'close_pools'):
+                await layer.close_pools()
+            await redis_pool.aclose_loop_clients()
+
+    async def close_rooms(self, rooms, idle):
+        closed = []
+        for room_name in rooms:
+            group_name = room_group_name(room_name)
+            await teardown.close_room(group_name, f"Room '{room_name}' was closed by staff.", reason='command')
+            closed.append(group_name)
+        if idle:
+            # Whatever the sweeper's interval, the TTL still applies.
+            cutoff = time.time() - teardown.empty_room_ttl()
+            for group_name in await get_room_registry().aidle_rooms(cutoff):
+                await teardown.close_room(group_name, "This room was closed after being empty for a while.", reason='idle')
+                closed.append(group_name)
+        return closed
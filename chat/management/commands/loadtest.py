@@ -0,0 +1,271 @@
+import asyncio
+import json
+import resource
+import time
+from pathlib import Path
+
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings, setup_databases, teardown_databases
+
+from chat.room_registry import get_room_registry, room_group_name
+
+BENCH_PREFIX = 'bench:'
+BENCH_MARKER = 'bench:'
+
+# Result keys compared against a baseline, and whether a larger value is better.
+BASELINE_METRICS = {
+    'connects_per_second': True,
+    'messages_per_second': True,
+    'deliveries_per_second': True,
+    'p50_ms': False,
+    'p95_ms': False,
+    'p99_ms': False,
+    'rss_mb': False,
+}
+
+
+def layer_settings(layer, redis_url, with_limits):
+    overrides = {}
+    if layer == 'memory':
+        overrides.update(
+            CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+            ROOM_REGISTRY={'BACKEND': 'chat.room_registry.InMemoryRoomRegistry'},
+            REPLAY_BUFFER={'BACKEND': 'chat.replay.InMemoryReplayBuffer'},
+        )
+    else:
+        overrides.update(
+            CHANNEL_LAYERS={'default': {
+                'BACKEND': 'chat.channel_layers.HybridRedisChannelLayer',
+                'CONFIG': {'hosts': [redis_url], 'prefix': 'bench-asgi'},
+            }},
+            ROOM_REGISTRY={
+                'BACKEND': 'chat.room_registry.RedisRoomRegistry',
+                'CONFIG': {'url': redis_url, 'prefix': BENCH_PREFIX},
+            },
+            REPLAY_BUFFER={
+                'BACKEND': 'chat.replay.RedisReplayBuffer',
+                'CONFIG': {'url': redis_url, 'prefix': BENCH_PREFIX},
+            },
+        )
+    if not with_limits:
+        overrides.update(CHAT_CONNECTION_RATE=0, CHAT_ROOM_RATE=0)
+    return overrides
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+def rss_mb():
+    """
+    (current, peak) resident set size of this process in MiB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # KiB on Linux
+    try:
+        with open('/proc/self/statm') as statm:
+            current = int(statm.read().split()[1]) * resource.getpagesize() / 1024 / 1024
+    except OSError:
+        current = peak
+    return current, peak
+
+
+class LoadTest:
+    """
+    Drives chat_project.asgi.application in-process: every client is a
+    WebsocketCommunicator going through the full middleware stack and
+    ChatConsumer, and each room's first client sends at a fixed rate.
+    Latency is measured from just before a sender's frame enters the app to
+    each member's socket receiving the broadcast.
+    """
+
+    def __init__(self, clients, rooms, rate, duration, connect_concurrency):
+        self.clients = clients
+        self.rooms = [f'bench_{i}' for i in range(rooms)]
+        self.rate = rate
+        self.duration = duration
+        self.connect_concurrency = connect_concurrency
+        self.latencies = []
+        self.sent = 0
+        self.sent_per_room = {}
+
+    async def run(self):
+        from chat_project.asgi import application
+
+        registry = get_room_registry()
+        for room in self.rooms:
+            await registry.acreate(room_group_name(room), 'bench-secret', 'bench')
+        host = next((h.lstrip('.') for h in settings.ALLOWED_HOSTS if h != '*'), 'localhost')
+        headers = [(b'origin', f'http://{host}'.encode()), (b'host', host.encode())]
+
+        members = {room: [] for room in self.rooms}
+        semaphore = asyncio.Semaphore(self.connect_concurrency)
+
+        async def connect(i):
+            room = self.rooms[i % len(self.rooms)]
+            communicator = WebsocketCommunicator(application, f'/ws/chat/{room}/', headers=headers)
+            async with semaphore:
+                connected, code = await communicator.connect(timeout=10)
+            if not connected:
+                raise CommandError(f"Client {i} was rejected from {room} with code {code}.")
+            members[room].append(communicator)
+
+        try:
+            started = time.perf_counter()
+            await asyncio.gather(*(connect(i) for i in range(self.clients)))
+            connect_seconds = time.perf_counter() - started
+
+            readers = [asyncio.create_task(self.read(c)) for room in self.rooms for c in members[room]]
+            started = time.perf_counter()
+            await asyncio.gather(*(self.drive(room, members[room][0]) for room in self.rooms if members[room]))
+            send_seconds = time.perf_counter() - started
+            expected = sum(self.sent_per_room.get(room, 0) * len(members[room]) for room in self.rooms)
+            drain_deadline = time.perf_counter() + 5
+            while len(self.latencies) < expected and time.perf_counter() < drain_deadline:
+                await asyncio.sleep(0.05)
+            for reader in readers:
+                reader.cancel()
+            await asyncio.gather(*readers, return_exceptions=True)
+            current_rss, peak_rss = rss_mb()
+        finally:
+            await asyncio.gather(
+                *(c.disconnect() for room in self.rooms for c in members[room]), return_exceptions=True
+            )
+            for room in self.rooms:
+                await registry.adelete(room_group_name(room))
+
+        latencies = sorted(self.latencies)
+        return {
+            'clients': self.clients,
+            'rooms': len(self.rooms),
+            'connects_per_second': round(self.clients / connect_seconds, 1),
+            'messages_sent': self.sent,
+            'deliveries': len(latencies),
+            'deliveries_expected': expected,
+            'messages_per_second': round(self.sent / send_seconds, 1),
+            'deliveries_per_second': round(len(latencies) / send_seconds, 1),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+            'rss_mb': round(current_rss, 1),
+            'peak_rss_mb': round(peak_rss, 1),
+        }
+
+    async def drive(self, room, sender):
+        interval = 1 / self.rate
+        next_send = time.perf_counter()
+        deadline = next_send + self.duration
+        while next_send < deadline:
+            await sender.send_to(text_data=json.dumps({
+                'message': f'{BENCH_MARKER}{time.perf_counter()}', 'username': 'Bench Guest',
+            }))
+            self.sent += 1
+            self.sent_per_room[room] = self.sent_per_room.get(room, 0) + 1
+            next_send += interval # Fixed schedule, so a slow send doesn't lower the offered rate
+            await asyncio.sleep(max(next_send - time.perf_counter(), 0))
+
+    async def read(self, communicator):
+        while True:
+            try:
+                frame = json.loads(await communicator.receive_from(timeout=30))
+            except AssertionError: # The consumer closed the socket
+                return
+            message = frame.get('message', '')
+            if message.startswith(BENCH_MARKER):
+                self.latencies.append(time.perf_counter() - float(message[len(BENCH_MARKER):]))
+
+
+class Command(BaseCommand):
+    help = (
+        "Load-tests the ASGI app in-process: N WebSocket clients across M rooms. Reports connect "
+        "throughput, end-to-end fan-out latency percentiles, message rates and RSS."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=200)
+        parser.add_argument('--rooms', type=int, default=20)
+        parser.add_argument('--rate', type=float, default=2, help="Messages per second sent to each room.")
+        parser.add_argument('--duration', type=float, default=10, help="Seconds to send for.")
+        parser.add_argument('--connect-concurrency', type=int, default=50)
+        parser.add_argument('--layer', choices=('memory', 'redis'), default='memory')
+        parser.add_argument('--redis-url', default='redis://localhost:6379')
+        parser.add_argument(
+            '--with-limits', action='store_true', help="Keep the configured per-connection and per-room rate limits.",
+        )
+        parser.add_argument(
+            '--current-db', action='store_true',
+            help="Archive into the configured database instead of a throwaway test database.",
+        )
+        parser.add_argument('--json', action='store_true', help="Print the results as JSON.")
+        parser.add_argument('--save-baseline', metavar='PATH')
+        parser.add_argument('--baseline', metavar='PATH', help="Fail if results regress past this baseline.")
+        parser.add_argument(
+            '--tolerance', type=float, default=0.25, help="Allowed regression as a fraction (default 0.25).",
+        )
+
+    def handle(self, *args, **options):
+        if options['clients'] < 1 or options['rooms'] < 1 or options['rate'] <= 0:
+            raise CommandError("--clients, --rooms and --rate must be positive.")
+        load_test = LoadTest(
+            options['clients'], options['rooms'], options['rate'], options['duration'],
+            options['connect_concurrency'],
+        )
+        old_config = None
+        if not options['current_db']:
+            old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            with override_settings(**layer_settings(options['layer'], options['redis_url'], options['with_limits'])):
+                results = asyncio.run(load_test.run())
+        finally:
+            if old_config is not None:
+                teardown_databases(old_config, verbosity=0)
+        results['layer'] = options['layer']
+        results['rate'] = options['rate']
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+        else:
+            self.stdout.write(
+                f"{results['clients']} clients in {results['rooms']} rooms, {options['rate']:g} msg/s per room, "
+                f"{options['layer']} layer"
+            )
+            self.stdout.write(f"  connect         {results['connects_per_second']:10.1f} connects/s")
+            self.stdout.write(
+                f"  fan-out         p50 {results['p50_ms']:.2f} ms   p95 {results['p95_ms']:.2f} ms"
+                f"   p99 {results['p99_ms']:.2f} ms"
+            )
+            self.stdout.write(
+                f"  throughput      {results['messages_per_second']:10.1f} msg/s in, "
+                f"{results['deliveries_per_second']:.1f} frames/s out "
+                f"({results['deliveries']}/{results['deliveries_expected']} delivered)"
+            )
+            self.stdout.write(f"  rss             {results['rss_mb']:10.1f} MiB (peak {results['peak_rss_mb']:.1f})")
+
+        if options['save_baseline']:
+            Path(options['save_baseline']).write_text(json.dumps(results, indent=2) + '\n')
+        if options['baseline']:
+            self.check_baseline(results, json.loads(Path(options['baseline']).read_text()), options['tolerance'])
+
+    def check_baseline(self, results, baseline, tolerance):
+        scenario = ('clients', 'rooms', 'rate', 'layer')
+        if any(results[key] != baseline.get(key) for key in scenario):
+            raise CommandError(
+                "Baseline was recorded for a different scenario: "
+                + ', '.join(f"{key}={baseline.get(key)}" for key in scenario)
+            )
+        regressions = []
+        for key, higher_is_better in BASELINE_METRICS.items():
+            expected, actual = baseline.get(key), results[key]
+            if not expected:
+                continue
+            limit = expected * (1 - tolerance) if higher_is_better else expected * (1 + tolerance)
+            if (actual < limit) if higher_is_better else (actual > limit):
+                regressions.append(f"{key}: {actual} vs baseline {expected}")
+        if results['deliveries'] < results['deliveries_expected']:
+            regressions.append(f"lost frames: {results['deliveries']}/{results['deliveries_expected']} delivered")
+        if regressions:
+            raise CommandError("Regressed past baseline:\n  " + '\n  '.join(regressions))
+        self.stdout.write(self.style.SUCCESS(f"Within {tolerance:.0%} of baseline."))
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.replay import RedisReplayBuffer, get_replay_buffer
+from chat.room_registry import RedisRoomRegistry, get_room_registry
+from chat.sharding import fan_out
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves every room whose shard changed after REDIS_SHARD_URLS was edited to its new shard: "
+        "registry record, members and replay buffer. Rooms that stay put are not touched. Run it with the "
+        "workers stopped, before they start on the new shard list; channel layer groups are not moved, "
+        "the consumers rejoin them as clients reconnect."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--from', dest='removed', action='append', default=[], metavar='URL',
+            help="A shard that was removed from REDIS_SHARD_URLS, to move all its rooms off. Repeatable.",
+        )
+        parser.add_argument('--dry-run', action='store_true', help="Only count the rooms that would move.")
+
+    def handle(self, *args, **options):
+        registry = get_room_registry()
+        if not isinstance(registry, RedisRoomRegistry):
+            raise CommandError("ROOM_REGISTRY is not a RedisRoomRegistry; there is nothing to reshard.")
+        replay = get_replay_buffer()
+        if isinstance(replay, RedisReplayBuffer) and replay.urls != registry.urls:
+            raise CommandError("REPLAY_BUFFER and ROOM_REGISTRY must use the same shards (settings.REDIS_SHARDS).")
+
+        sources = registry.urls + [url for url in options['removed'] if url not in registry.urls]
+        # Listed up front, so a room moved onto a shard is not found there again.
+        placements = [
+            (source, group_name)
+            for source, rooms in zip(sources, fan_out(registry.shard_rooms, sources))
+            for group_name in rooms
+        ]
+        moved = keys = 0
+        for source, group_name in placements:
+            target = registry.shard(group_name)
+            if target == source:
+                continue
+            moved += 1
+            if not options['dry_run']:
+                extra_keys = replay.room_keys(group_name) if isinstance(replay, RedisReplayBuffer) else []
+                keys += registry.move_room(group_name, source, target, extra_keys)
+            if options['verbosity'] > 1:
+                self.stdout.write(f"{group_name}: {source} -> {target}")
+
+        action = "would move" if options['dry_run'] else f"moved ({keys} keys)"
+        self.stdout.write(f"{moved} of {len(placements)} rooms {action} across {len(registry.urls)} shards")
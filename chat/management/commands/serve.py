@@ -0,0 +1,233 @@
+import functools
+import logging
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+# Seconds a worker gets beyond CHAT_DRAIN_SECONDS before it is killed.
+SHUTDOWN_GRACE = 5
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs several daphne worker processes on one listening socket. The app is imported and warmed "
+        "up once, then the workers are forked from it. On SIGTERM or SIGINT the socket is closed and "
+        "every worker drains its WebSockets (see chat.lifecycle) before exiting."
+    )
+    # Run by Supervisor.run instead: they import the views, and with them prometheus_client.
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bind', default='0.0.0.0')
+        parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 8000)))
+        parser.add_argument(
+            '--workers', type=int, default=int(os.environ.get('WEB_CONCURRENCY', 0)) or os.cpu_count() or 1,
+            help="Worker processes (default $WEB_CONCURRENCY or the number of CPUs).",
+        )
+
+    def handle(self, *args, **options):
+        Supervisor(self, options['bind'], options['port'], options['workers']).run()
+
+
+class Supervisor:
+    """
+    Owns the listening socket; the kernel hands each new connection to
+    whichever worker accepts it first. Workers that die are restarted.
+
+    Workers are forked after the ASGI app is imported and warmed up, so a
+    new worker is serving in the time it takes to import daphne. Nothing
+    that holds a connection or an event loop may be created before the fork:
+    Django's DB connections, Redis clients and the Twisted reactor are all
+    opened lazily in the worker.
+    """
+
+    def __init__(self, command, bind, port, workers):
+        self.command = command
+        self.bind = bind
+        self.port = port
+        self.worker_count = workers
+        self.workers = {} # pid -> Popen
+        self.stopping = False
+        self.sock = None
+
+    def run(self):
+        metrics_dir = self.prepare_metrics_dir() # Must be set before prometheus_client is imported
+        self.command.check()
+        from chat import lifecycle
+        import chat_project.asgi # noqa: F401
+        lifecycle.warm_up()
+
+        self.sock = socket.create_server((self.bind, self.port), backlog=2048)
+        signal.signal(signal.SIGTERM, self.begin_shutdown)
+        signal.signal(signal.SIGINT, self.begin_shutdown)
+        self.command.stdout.write(f"Listening on {self.bind}:{self.port} with {self.worker_count} workers")
+        try:
+            for _ in range(self.worker_count):
+                self.spawn()
+            while not self.stopping:
+                self.reap(restart=True)
+                time.sleep(0.1)
+            self.shutdown()
+        finally:
+            if metrics_dir is not None:
+                shutil.rmtree(metrics_dir, ignore_errors=True)
+
+    def prepare_metrics_dir(self):
+        """
+        Gives the workers a shared PROMETHEUS_MULTIPROC_DIR so /metrics on any of them reports all.
+        """
+        if self.worker_count < 2 or os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+            return None
+        metrics_dir = tempfile.mkdtemp(prefix='grego-metrics-')
+        os.environ['PROMETHEUS_MULTIPROC_DIR'] = metrics_dir
+        return metrics_dir
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            status = 1
+            try:
+                run_worker(self.sock.fileno())
+                status = 0
+            finally:
+                logging.shutdown() # os._exit skips it, and the log thread may still have records queued
+                os._exit(status)
+        self.workers[pid] = time.monotonic()
+
+    def reap(self, restart):
+        for pid, started in list(self.workers.items()):
+            reaped, status = os.waitpid(pid, os.WNOHANG)
+            if not reaped:
+                continue
+            del self.workers[pid]
+            mark_metrics_process_dead(pid)
+            if restart and not self.stopping:
+                self.command.stderr.write(f"Worker {pid} exited with status {status}; restarting")
+                if time.monotonic() - started < 1:
+                    time.sleep(1) # Don't spin if the worker dies on start-up
+                self.spawn()
+
+    def begin_shutdown(self, signum, frame):
+        self.stopping = True
+
+    def shutdown(self):
+        # Refuse new connections right away so the proxy retries them on another machine.
+        self.sock.close()
+        for pid in self.workers:
+            os.kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + getattr(settings, 'CHAT_DRAIN_SECONDS', 10) + SHUTDOWN_GRACE
+        while self.workers and time.monotonic() < deadline:
+            self.reap(restart=False)
+            time.sleep(0.2)
+        for pid in self.workers:
+            os.kill(pid, signal.SIGKILL)
+
+
+def mark_metrics_process_dead(pid):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(pid)
+
+
+def accept_permessage_deflate(offers):
+    """
+    Accepts a client's permessage-deflate offer, if it made one.
+
+    The compression context is kept between messages, so the keys and names
+    repeated in every frame cost a few bytes after the first. Both directions use
+    a 2**CHAT_WS_COMPRESSION_WINDOW_BITS byte window (when the client allows it)
+    and a low memLevel, so each socket holds about 16 KB of zlib state rather than
+    the ~300 KB of zlib's defaults.
+    """
+    from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflateOfferAccept
+
+    bits = getattr(settings, 'CHAT_WS_COMPRESSION_WINDOW_BITS', 11)
+    for offer in offers:
+        if isinstance(offer, PerMessageDeflateOffer):
+            return PerMessageDeflateOfferAccept(
+                offer,
+                request_max_window_bits=bits if offer.accept_max_window_bits else 0,
+                window_bits=min(bits, offer.request_max_window_bits or bits),
+                mem_level=4,
+            )
+    return None
+
+
+def unsent_bytes(protocol):
+    """
+    Bytes written to the protocol's TCP transport that the kernel has not taken yet:
+    how far a client on a slow network is behind. 0 for other kinds of transport.
+    """
+    transport = getattr(protocol, 'transport', None)
+    try:
+        return len(transport.dataBuffer) - transport.offset + transport._tempDataLen
+    except AttributeError:
+        return 0
+
+
+def run_worker(fd):
+    """
+    Serves the ASGI app with daphne on the supervisor's socket. SIGTERM, or
+    the supervisor going away, stops listening, drains the WebSockets, then
+    stops the reactor.
+    """
+    import asyncio
+
+    from daphne.server import Server # Installs the asyncio reactor, so only ever in the worker
+    from twisted.internet import reactor
+
+    from chat import lifecycle
+    from chat_project.asgi import application
+
+    class DrainingServer(Server):
+        def listen_success(self, port):
+            super().listen_success(port)
+            self.ports = getattr(self, 'ports', []) + [port]
+
+        def create_application(self, protocol, scope):
+            # daphne never pauses the app for a client that reads slowly; chat.limits checks this instead.
+            scope['write_buffer_size'] = functools.partial(unsent_bytes, protocol)
+            return super().create_application(protocol, scope)
+
+        async def drain_and_stop(self):
+            for port in getattr(self, 'ports', []):
+                port.stopListening()
+            await lifecycle.drain()
+            reactor.callLater(0.5, reactor.stop) # Let the final close frames flush
+
+    supervisor_pid = os.getppid()
+
+    def on_ready():
+        # Called after daphne builds its WebSocket factory and before the reactor accepts anything.
+        if getattr(settings, 'CHAT_WS_COMPRESSION', True):
+            server.ws_factory.setProtocolOptions(perMessageCompressionAccept=accept_permessage_deflate)
+        loop = asyncio.get_event_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, start_drain)
+        loop.call_later(1, watch_supervisor, loop)
+
+    def watch_supervisor(loop):
+        if os.getppid() != supervisor_pid: # Supervisor was killed; don't linger on the port
+            start_drain()
+        else:
+            loop.call_later(1, watch_supervisor, loop)
+
+    def start_drain():
+        if not lifecycle.is_draining():
+            asyncio.ensure_future(server.drain_and_stop())
+
+    server = DrainingServer(
+        application=application,
+        endpoints=[f'fd:fileno={fd}'], # daphne's own endpoint parser; AF_INET by default
+        signal_handlers=False,
+        ready_callable=on_ready,
+    )
+    server.run()
@@ -0,0 +1,83 @@
+import collections
+import json
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Runs in a fresh interpreter so nothing is already imported. Prints phase timings as JSON.
+BOOT_SCRIPT = """
+import json, os, time
+started = time.perf_counter()
+phases = {}
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', %(settings_module)r)
+import django
+django.setup()
+phases['django.setup'] = time.perf_counter() - started
+mark = time.perf_counter()
+import chat_project.asgi
+phases['import chat_project.asgi'] = time.perf_counter() - mark
+mark = time.perf_counter()
+from chat import lifecycle
+lifecycle.warm_up()
+phases['warm_up (urls, views, templates, channel layer)'] = time.perf_counter() - mark
+mark = time.perf_counter()
+import daphne.server
+phases['import daphne.server (worker only)'] = time.perf_counter() - mark
+print(json.dumps(phases))
+"""
+
+
+def parse_importtime(stderr):
+    """
+    Returns [(module, self_us, cumulative_us, depth)] from `python -X importtime` output.
+    """
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        modules.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return modules
+
+
+class Command(BaseCommand):
+    help = (
+        "Boots the app in a fresh interpreter with -X importtime and reports where start-up time goes: "
+        "per phase, per top-level package and the slowest modules."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=15)
+
+    def handle(self, *args, **options):
+        script = BOOT_SCRIPT % {'settings_module': os.environ.get('DJANGO_SETTINGS_MODULE', 'chat_project.settings')}
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', script],
+            cwd=settings.BASE_DIR, capture_output=True, text=True,
+        )
+        if result.returncode != 0:
+            raise CommandError(f"Boot failed:\n{result.stderr[-2000:]}")
+        phases = json.loads(result.stdout.strip().splitlines()[-1])
+        modules = parse_importtime(result.stderr)
+
+        self.stdout.write("Phases")
+        for phase, seconds in phases.items():
+            self.stdout.write(f"  {seconds * 1000:8.1f} ms  {phase}")
+        self.stdout.write(f"  {sum(phases.values()) * 1000:8.1f} ms  total")
+
+        by_package = collections.Counter()
+        for name, self_us, _, _ in modules:
+            by_package[name.split('.', 1)[0]] += self_us
+        self.stdout.write(f"\nImport time by top-level package (self time, {len(modules)} modules)")
+        for package, self_us in by_package.most_common(options['top']):
+            self.stdout.write(f"  {self_us / 1000:8.1f} ms  {package}")
+
+        self.stdout.write("\nSlowest imports (cumulative, as first imported)")
+        # Only modules imported directly by our code or the bootstrap, so nested imports aren't counted twice.
+        outermost = [m for m in modules if m[3] == 0 or m[0].split('.', 1)[0] in ('chat', 'chat_project', 'accounts')]
+        for name, _, cumulative_us, _ in sorted(outermost, key=lambda m: -m[2])[:options['top']]:
+            self.stdout.write(f"  {cumulative_us / 1000:8.1f} ms  {name}")
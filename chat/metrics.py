@@ -0,0 +1,145 @@
+"""
+Prometheus metrics for the WebSocket hot path, served at /metrics.
+
+Metrics are pre-aggregated in process by prometheus_client (a counter
+increment or histogram observation is a few hundred nanoseconds), so the
+instrumentation stays on in production. Messages per second is
+``rate(chat_messages_total[1m])``.
+
+With several ASGI worker processes on one machine, start every worker with
+PROMETHEUS_MULTIPROC_DIR pointing at the same empty directory. prometheus_client
+then keeps each process's values in its own mmap'd file and /metrics merges
+them; connection gauges are reported per live process (a ``pid`` label).
+
+Connections per room are not kept as a labelled gauge: rooms come and go all
+shift, and a series per room ever opened would pile up in every process and
+mmap file. ``RoomConnectionsCollector`` reads them from the room registry's
+occupancy index at scrape time instead, so only occupied rooms are reported,
+already summed across processes and machines.
+"""
+import logging
+import os
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+ACTIVE_CONNECTIONS = Gauge(
+    'chat_active_connections', 'Accepted chat WebSocket connections in this process.',
+    multiprocess_mode='liveall',
+)
+HANDSHAKE_SECONDS = Histogram(
+    'chat_handshake_seconds',
+    'From the WebSocket reaching the ASGI app (before session/user lookup) to accept.',
+    buckets=LATENCY_BUCKETS,
+)
+CONNECT_SECONDS = Histogram(
+    'chat_connect_seconds', 'Time spent in ChatConsumer.connect up to accept.', buckets=LATENCY_BUCKETS,
+)
+RECEIVE_TO_GROUP_SEND_SECONDS = Histogram(
+    'chat_receive_to_group_send_seconds', 'From a frame arriving in receive to group_send returning.',
+    buckets=LATENCY_BUCKETS,
+)
+FANOUT_SECONDS = Histogram(
+    'chat_fanout_delivery_seconds', 'From group_send to the frame being handed to a member socket.',
+    buckets=LATENCY_BUCKETS,
+)
+MESSAGES = Counter('chat_messages', 'Chat messages broadcast to rooms.')
+REJECTED_CONNECTS = Counter('chat_rejected_connects', 'Connections closed by ChatConsumer.connect.', ['code'])
+CHANNEL_LAYER_ERRORS = Counter('chat_channel_layer_errors', 'Channel layer operations that raised.', ['operation'])
+LIMIT_REJECTIONS = Counter('chat_limit_rejections', 'Frames or deliveries refused by chat.limits.', ['reason'])
+LOOP_LAG_SECONDS = Histogram(
+    'chat_event_loop_lag_seconds', 'How late the event loop woke a sleeping coroutine (see chat.diagnostics).',
+    buckets=LATENCY_BUCKETS,
+)
+LOOP_STALLS = Counter('chat_event_loop_stalls', 'Times the event loop was blocked longer than LOOP_LAG_WARN_MS.')
+HEARTBEAT_PRUNED = Counter(
+    'chat_heartbeat_pruned', 'Members removed by chat.heartbeat: silent sockets closed here, '
+    'or members no worker renewed.', ['reason'],
+)
+ROOMS_CLOSED = Counter(
+    'chat_rooms_closed', 'Rooms torn down by chat.teardown, by who closed them.', ['reason'],
+)
+LOG_RECORDS_DROPPED = Counter(
+    'chat_log_records_dropped', 'Log records dropped because the background log writer fell behind (see chat.logs).',
+)
+PRESENCE_SNAPSHOTS = Counter(
+    'chat_presence_snapshots', 'Room presence snapshots sent to the channel layer (see chat.presence).',
+)
+QR_RENDERS = Counter(
+    'chat_qr_renders', 'QR images encoded by chat.qr, i.e. cache misses.', ['kind'],
+)
+REDIS_POOL_CONNECTIONS_CREATED = Counter(
+    'chat_redis_pool_connections_created', 'Connections opened by the shared Redis pools (see chat.redis_pool).', ['pool'],
+)
+REDIS_POOL_IN_USE = Gauge(
+    'chat_redis_pool_in_use', 'Connections checked out of the shared Redis pools.', ['pool'],
+    multiprocess_mode='livesum',
+)
+REDIS_POOL_WAIT_SECONDS = Histogram(
+    'chat_redis_pool_wait_seconds', 'Time to check a connection out of the shared Redis pools.', ['pool'],
+    buckets=LATENCY_BUCKETS,
+)
+
+
+class RoomConnectionsCollector:
+    """
+    chat_room_connections{room}: members of every occupied room, from the room registry.
+    """
+
+    def family(self):
+        return GaugeMetricFamily('chat_room_connections', 'Chat WebSocket connections per occupied room.', labels=['room'])
+
+    def describe(self):
+        yield self.family() # Registering must not query the registry
+
+    def collect(self):
+        from .room_registry import get_room_registry
+
+        family = self.family()
+        try:
+            occupied = get_room_registry().occupied_rooms()
+        except Exception as e: # Redis unreachable: the other metrics are still worth scraping
+            logger.warning(f"Could not read room occupancy for /metrics: {e}")
+            occupied = {}
+        for group_name, members in sorted(occupied.items()):
+            family.add_metric([group_name], members)
+        yield family
+
+
+# Rendered by /metrics only, so collecting REGISTRY in process never touches the room registry.
+SCRAPE_REGISTRY = CollectorRegistry()
+SCRAPE_REGISTRY.register(RoomConnectionsCollector())
+
+
+class HandshakeTimerMiddleware:
+    """
+    Outermost ASGI middleware for WebSockets: stamps the scope with the time
+    the connection reached the app so ChatConsumer can report handshake latency.
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'websocket':
+            scope = dict(scope, handshake_started=time.perf_counter())
+        return await self.inner(scope, receive, send)
+
+
+def render_latest():
+    """
+    Returns (body, content_type) for the metrics endpoint.
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry) + generate_latest(SCRAPE_REGISTRY), CONTENT_TYPE_LATEST
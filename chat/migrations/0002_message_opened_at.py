@@ -0,0 +1,26 @@
+# Generated by Django 5.2.1 on 2026-10-18 16:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='message',
+            name='chat_message_room_id_idx',
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='opened_at',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', 'opened_at', '-id'], name='chat_message_opening_id_idx'),
+        ),
+    ]
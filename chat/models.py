@@ -1,3 +1,25 @@
 from django.db import models
+from django.utils import timezone
 
-# Create your models here.
+
+class Message(models.Model):
+    """
+    A chat line as broadcast to a room. Written in batches by chat.archive,
+    read newest-first by the room history endpoint. Room names are reused, so
+    `opened_at` tells apart the parties that had the same room.
+    """
+    room = models.CharField(max_length=255) # Channels group name, e.g. 'chat_table_20'
+    opened_at = models.FloatField(null=True, blank=True) # The room's created_at in the registry
+    seq = models.PositiveBigIntegerField(null=True, blank=True) # Per-room sequence number from chat.replay
+    username = models.CharField(max_length=150)
+    content = models.TextField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # Keyset pagination: WHERE room = %s AND opened_at = %s AND id < %s ORDER BY id DESC
+            models.Index(fields=['room', 'opened_at', '-id'], name='chat_message_opening_id_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.room} #{self.seq}: {self.username}'
@@ -0,0 +1,214 @@
+"""
+Typing indicators and "who is here" for chat rooms, on an ephemeral fast lane.
+
+Clients send the fixed text frames ``{"typing":true}`` and ``{"typing":false}``.
+Like pongs they are matched as strings rather than parsed, and they cost no
+tokens from the message rate limits. They are never archived, stamped with a
+seq or replayed. A member counts as typing until it says otherwise, sends a
+message, leaves, or CHAT_TYPING_TIMEOUT seconds pass without another typing
+frame, so a client only needs to repeat it every few seconds.
+
+Nothing goes to the channel layer per keystroke. Each process keeps the
+presence of its own members (``join``, ``typing``, ``message_sent``,
+``leave`` only touch a dict) and, at most once per CHAT_PRESENCE_INTERVAL_MS
+per room, sends the room one ``presence.update`` with its snapshot if it
+changed. Flips within an interval cancel out, so each member is debounced to
+its latest state. Every heartbeat the snapshots are resent unchanged, and a
+snapshot older than CHAT_HEARTBEAT_TIMEOUT is forgotten, which is how the
+members of a worker that died disappear. A process's first snapshot for a
+room says ``hello``, and the others answer with theirs.
+
+The receiving process merges the newest snapshot of every process (its
+``origin``) once per event. Each member's ChatConsumer then forwards the same
+encoded frame:
+
+    {"presence": {"here": ["Ana", "alice"], "typing": ["Ana"], "count": 3}}
+
+``here`` holds the distinct names, and ``count`` counts connections,
+including guests who have not given a name. A room therefore sees at most
+one presence message per interval from each process with members in it,
+however many people type. Presence is the first thing dropped for a member
+that falls behind: presence frames are skipped at half the slow-consumer
+limits (see chat.limits.is_slow_consumer), and the next snapshot supersedes
+them anyway.
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import codec, heartbeat, metrics
+
+logger = logging.getLogger(__name__)
+
+TYPING_FRAMES = {'{"typing":true}': True, '{"typing":false}': False}
+MAX_NAME_LENGTH = 50
+BACKLOG_SHARE = 0.5 # Of the slow-consumer limits, beyond which presence frames are skipped
+
+_members = {} # group name -> {channel name: [name, typing until (monotonic)]}
+_dirty = set() # Groups whose snapshot may have changed since it was last sent
+_sent = {} # group name -> snapshot last sent
+_flusher = None
+_views = {} # group name -> {origin: [time.time() of its snapshot, snapshot]}
+_frames = {} # group name -> (frame, packed) merged from _views
+
+
+def interval():
+    return getattr(settings, 'CHAT_PRESENCE_INTERVAL_MS', 1000) / 1000
+
+
+def typing_timeout():
+    return getattr(settings, 'CHAT_TYPING_TIMEOUT', 6)
+
+
+def origin():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def join(group_name, channel_name, name):
+    _members.setdefault(group_name, {})[channel_name] = [name, 0]
+    changed(group_name)
+
+
+def leave(group_name, channel_name):
+    members = _members.get(group_name)
+    if members is None or members.pop(channel_name, None) is None:
+        return
+    changed(group_name) # An empty snapshot tells the other processes we are gone
+    if not members:
+        # Out of the group now, so no more updates would reach this view.
+        _views.pop(group_name, None)
+        _frames.pop(group_name, None)
+
+
+def typing(group_name, channel_name, is_typing):
+    member = _members.get(group_name, {}).get(channel_name)
+    if member is None:
+        return
+    now = time.monotonic()
+    was_typing = member[1] > now
+    member[1] = now + typing_timeout() if is_typing else 0
+    if was_typing != is_typing:
+        changed(group_name)
+
+
+def message_sent(group_name, channel_name, name):
+    """
+    Sending a message ends typing, and gives a guest the name they chat under.
+    """
+    member = _members.get(group_name, {}).get(channel_name)
+    if member is None:
+        return
+    if member[0] != name or member[1]:
+        member[0] = name
+        member[1] = 0
+        changed(group_name)
+
+
+def changed(group_name):
+    global _flusher
+    _dirty.add(group_name)
+    loop = asyncio.get_running_loop()
+    if _flusher is None or _flusher.done() or _flusher.get_loop() is not loop:
+        _flusher = loop.create_task(publish_later())
+
+
+def refresh():
+    """
+    Resends every local snapshot, from chat.heartbeat, so other processes don't expire them.
+    """
+    for group_name in list(_members):
+        _sent.pop(group_name, None)
+        changed(group_name)
+
+
+def snapshot(members, now):
+    names = {name for name, typing_until in members.values() if name}
+    typing = {name for name, typing_until in members.values() if name and typing_until > now}
+    return {'here': sorted(names), 'typing': sorted(typing), 'count': len(members)}
+
+
+async def publish_later():
+    global _flusher
+    await asyncio.sleep(interval())
+    _flusher = None # Changes from here on need another round
+    await publish()
+
+
+async def publish():
+    global _dirty
+    groups, _dirty = _dirty, set()
+    now = time.monotonic()
+    layer = get_channel_layer()
+    for group_name in groups:
+        members = _members.get(group_name, {})
+        current = snapshot(members, now)
+        if any(typing_until > now for name, typing_until in members.values()):
+            changed(group_name) # Look again next interval, for typing that times out
+        if not members:
+            _members.pop(group_name, None)
+            if group_name not in _sent:
+                continue # Never announced, nothing to take back
+        if current == _sent.get(group_name):
+            continue
+        hello = group_name not in _sent
+        if members:
+            _sent[group_name] = current
+        else:
+            _sent.pop(group_name, None)
+        try:
+            await layer.group_send(group_name, {
+                'type': 'presence.update',
+                'group': group_name,
+                'origin': origin(),
+                'at': time.time(),
+                'presence': current,
+                'hello': hello and bool(members), # New here: the others answer with their snapshots
+            })
+            metrics.PRESENCE_SNAPSHOTS.inc()
+        except Exception as e: # Presence is best effort; chat works without it
+            logger.warning(f"Failed to publish presence for '{group_name}': {e}")
+
+
+def received(event):
+    """
+    Merges a presence.update into this process's view of the room. Returns the
+    room's (frame, packed) to forward, or None if the event was superseded.
+    The first consumer to handle an event merges it, the others reuse the result.
+    """
+    group_name = event['group']
+    views = _views.setdefault(group_name, {})
+    known = views.get(event['origin'])
+    if known is not None and known[0] >= event['at']:
+        return _frames.get(group_name) if known[0] == event['at'] else None
+    if event['presence']['count']:
+        views[event['origin']] = [event['at'], event['presence']]
+    else:
+        views.pop(event['origin'], None) # Its last member left
+    if event.get('hello') and event['origin'] != origin() and _members.get(group_name):
+        _sent.pop(group_name, None)
+        changed(group_name)
+    if heartbeat.interval() > 0:
+        cutoff = time.time() - heartbeat.timeout()
+        for key in [key for key, (at, view) in views.items() if at < cutoff]:
+            del views[key]
+    merged = {'here': set(), 'typing': set(), 'count': 0}
+    for at, view in views.values():
+        merged['here'].update(view['here'])
+        merged['typing'].update(view['typing'])
+        merged['count'] += view['count']
+    frame = codec.dumps({'presence': {
+        'here': sorted(merged['here']), 'typing': sorted(merged['typing']), 'count': merged['count'],
+    }})
+    _frames[group_name] = frames = (frame, codec.pack(frame))
+    return frames
+
+
+def current(group_name):
+    """The room's latest merged (frame, packed), for a member who just joined, or None."""
+    return _frames.get(group_name)
+
@@ -0,0 +1,131 @@
+"""
+QR codes rendered on the server.
+
+``render(data, kind, scale)`` encodes `data` with segno (pure Python, no
+Pillow needed for PNG) and returns an ``Image`` holding the SVG or PNG bytes
+and a strong ETag computed from them. Images are kept in a per-process cache
+of at most CHAT_QR_CACHE_SIZE entries, keyed by (data, kind, scale), with the
+least recently used evicted first, so each code is encoded once per worker.
+
+The fixed codes (CHAT_QR_CODES, e.g. the review and menu links) are served at
+/chat/qr/<name>.svg|.png and rendered by ``warm_up()`` before the workers
+fork. Pages link to them with ``?v=<version>``, so the URL changes whenever
+the destination does and the response can be cached for CHAT_QR_MAX_AGE as
+immutable. A request without the current version is answered with the ETag
+and no-cache instead, so a revalidation costs a 304 and no encoding.
+"""
+import collections
+import hashlib
+import io
+import logging
+import threading
+
+import segno
+from segno import DataOverflowError # Raised by render() for data no QR code can hold
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPES = {'svg': 'image/svg+xml', 'png': 'image/png'}
+MAX_SCALE = 40 # Pixels per module; a 40-module code at 40 is already 1920px wide
+
+Image = collections.namedtuple('Image', 'body content_type etag')
+
+
+def destinations():
+    return getattr(settings, 'CHAT_QR_CODES', {})
+
+
+def default_scale():
+    return getattr(settings, 'CHAT_QR_SCALE', 8)
+
+
+def encode(data, kind, scale):
+    code = segno.make(data, error='h', micro=False) # High error correction, like the old pages
+    out = io.BytesIO()
+    if kind == 'svg':
+        code.save(out, kind='svg', scale=scale, border=4, xmldecl=False)
+    else:
+        code.save(out, kind='png', scale=scale, border=4)
+    body = out.getvalue()
+    return Image(body, CONTENT_TYPES[kind], f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"')
+
+
+class ImageCache:
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self._images = collections.OrderedDict() # (data, kind, scale) -> Image
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+            return image
+
+    def set(self, key, image):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._images[key] = image
+            self._images.move_to_end(key)
+            while len(self._images) > self.max_size:
+                self._images.popitem(last=False)
+
+    def __len__(self):
+        return len(self._images)
+
+
+_image_cache = None
+
+
+def get_image_cache():
+    global _image_cache
+    if _image_cache is None:
+        _image_cache = ImageCache(max_size=getattr(settings, 'CHAT_QR_CACHE_SIZE', 256))
+    return _image_cache
+
+
+@receiver(setting_changed)
+def reset_image_cache(*, setting, **kwargs):
+    global _image_cache
+    if setting.startswith('CHAT_QR_'):
+        _image_cache = None
+
+
+def render(data, kind='svg', scale=None):
+    """
+    Returns the cached Image of `data` as a QR code, encoding it on a miss.
+    """
+    if kind not in CONTENT_TYPES:
+        raise ValueError(f"Unknown QR image kind: {kind}")
+    key = (data, kind, scale or default_scale())
+    image_cache = get_image_cache()
+    image = image_cache.get(key)
+    if image is None:
+        metrics.QR_RENDERS.labels(kind).inc()
+        image = encode(*key)
+        image_cache.set(key, image)
+    return image
+
+
+def version(data, kind='svg', scale=None):
+    """
+    The ?v= token for an image's URL: changes whenever its bytes do.
+    """
+    return render(data, kind, scale).etag.strip('"')[:12]
+
+
+def precompute():
+    """
+    Renders every CHAT_QR_CODES destination in both formats at the default scale.
+    """
+    for name, data in destinations().items():
+        for kind in CONTENT_TYPES:
+            render(data, kind)
+    logger.debug(f"Rendered {len(destinations())} QR codes")
@@ -0,0 +1,181 @@
+"""
+Shared Redis connection pools for everything in ``chat`` that talks to Redis
+directly (the room registry, the replay buffer, views).
+
+    from chat.redis_pool import get_redis, get_async_redis
+
+    get_redis().get('key')              # sync, for views and commands
+    await get_async_redis().get('key')  # coroutine, for consumers
+
+Each process keeps one blocking pool per URL for sync clients, and one per
+URL and event loop for async clients (redis.asyncio connections belong to
+the loop that opened them). Pools are created on first use, so nothing is
+connected before ``manage.py serve`` forks its workers. Once warm, a request
+borrows an open connection and returns it; new connections are only opened
+when more requests are in flight at once than ever before, up to
+REDIS_POOL_MAX_CONNECTIONS per pool. Beyond that callers wait up to
+REDIS_POOL_TIMEOUT seconds for a connection to be returned.
+
+The channel layer keeps its own pools: channels_redis parks connections in
+blocking BZPOPMIN calls, which would starve short request-path commands if
+they shared a pool, and it reads bytes where these clients decode to str.
+
+Metrics: ``chat_redis_pool_connections_created_total`` (new TCP connections;
+flat under steady load), ``chat_redis_pool_in_use`` and
+``chat_redis_pool_wait_seconds``, each labelled by pool kind (sync/async).
+"""
+import asyncio
+import functools
+import threading
+import time
+import weakref
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from . import metrics
+
+_sync_clients = {} # url -> redis.Redis
+_async_clients = weakref.WeakKeyDictionary() # loop -> {url: redis.asyncio.Redis}
+_lock = threading.Lock()
+
+
+def default_url():
+    """
+    REDIS_URL if set, otherwise the first CHANNEL_LAYERS host.
+    """
+    url = getattr(settings, 'REDIS_URL', None)
+    if url:
+        return url
+    return settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0]
+
+
+def pool_options():
+    return {
+        'max_connections': getattr(settings, 'REDIS_POOL_MAX_CONNECTIONS', 50),
+        'timeout': getattr(settings, 'REDIS_POOL_TIMEOUT', 5),
+    }
+
+
+def get_redis(url=None):
+    """
+    Returns the process-wide sync client for `url` (default: default_url()).
+    """
+    url = url or default_url()
+    client = _sync_clients.get(url)
+    if client is None:
+        with _lock:
+            client = _sync_clients.get(url)
+            if client is None:
+                import redis
+                pool = instrumented_pool_class(redis.BlockingConnectionPool).from_url(
+                    url, decode_responses=True, **pool_options(),
+                )
+                client = redis.Redis(connection_pool=pool)
+                _sync_clients[url] = client
+    return client
+
+
+def get_async_redis(url=None):
+    """
+    Returns the async client for `url` bound to the running event loop.
+    """
+    url = url or default_url()
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    client = clients.get(url)
+    if client is None:
+        import redis.asyncio
+        pool = instrumented_async_pool_class(redis.asyncio.BlockingConnectionPool).from_url(
+            url, decode_responses=True, **pool_options(),
+        )
+        client = redis.asyncio.Redis(connection_pool=pool)
+        clients[url] = client
+    return client
+
+
+async def aclose_loop_clients():
+    """
+    Disconnects the async clients of the running event loop, for scripts that
+    start and stop their own loop (asyncio.run) before exiting.
+    """
+    clients = _async_clients.pop(asyncio.get_running_loop(), {})
+    for client in clients.values():
+        await client.aclose(close_connection_pool=True)
+
+
+@functools.cache
+def instrumented_pool_class(pool_class):
+    """
+    Subclasses a redis-py blocking pool to report connections created,
+    connections checked out and time spent waiting for one.
+    """
+
+    class InstrumentedBlockingConnectionPool(pool_class):
+        kind = 'sync'
+
+        def reset(self):
+            self._checked_out = set()
+            super().reset()
+
+        def make_connection(self):
+            metrics.REDIS_POOL_CONNECTIONS_CREATED.labels(self.kind).inc()
+            return super().make_connection()
+
+        def get_connection(self, *args, **kwargs):
+            started = time.perf_counter()
+            connection = super().get_connection(*args, **kwargs)
+            metrics.REDIS_POOL_WAIT_SECONDS.labels(self.kind).observe(time.perf_counter() - started)
+            self._checked_out.add(connection)
+            metrics.REDIS_POOL_IN_USE.labels(self.kind).inc()
+            return connection
+
+        def release(self, connection):
+            # get_connection() also releases connections it failed to hand out.
+            if connection in self._checked_out:
+                self._checked_out.discard(connection)
+                metrics.REDIS_POOL_IN_USE.labels(self.kind).dec()
+            super().release(connection)
+
+    return InstrumentedBlockingConnectionPool
+
+
+@functools.cache
+def instrumented_async_pool_class(pool_class):
+    """
+    instrumented_pool_class() for redis.asyncio pools.
+    """
+
+    class InstrumentedAsyncBlockingConnectionPool(pool_class):
+        kind = 'async'
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self._checked_out = set()
+
+        def make_connection(self):
+            metrics.REDIS_POOL_CONNECTIONS_CREATED.labels(self.kind).inc()
+            return super().make_connection()
+
+        async def get_connection(self, *args, **kwargs):
+            started = time.perf_counter()
+            connection = await super().get_connection(*args, **kwargs)
+            metrics.REDIS_POOL_WAIT_SECONDS.labels(self.kind).observe(time.perf_counter() - started)
+            self._checked_out.add(connection)
+            metrics.REDIS_POOL_IN_USE.labels(self.kind).inc()
+            return connection
+
+        async def release(self, connection):
+            if connection in self._checked_out:
+                self._checked_out.discard(connection)
+                metrics.REDIS_POOL_IN_USE.labels(self.kind).dec()
+            await super().release(connection)
+
+    return InstrumentedAsyncBlockingConnectionPool
+
+
+@receiver(setting_changed)
+def reset_redis_pools(*, setting, **kwargs):
+    if setting in ('REDIS_URL', 'REDIS_POOL_MAX_CONNECTIONS', 'REDIS_POOL_TIMEOUT', 'CHANNEL_LAYERS'):
+        _sync_clients.clear()
+        _async_clients.clear()
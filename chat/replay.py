@@ -0,0 +1,219 @@
+"""
+Per-room message sequencing and replay buffers.
+
+Every chat frame broadcast to a room is stamped with a per-room, monotonically
+increasing ``seq`` and kept in a bounded buffer, so a client that reconnects
+with ``?since=<seq>`` can be sent just the frames it missed. A ``since`` past
+the room's last seq was counted in an earlier buffer (the room was closed and
+its name reused), so that client is sent every stored frame and told to reset.
+
+Configured like ROOM_REGISTRY:
+
+    REPLAY_BUFFER = {
+        'BACKEND': 'chat.replay.RedisReplayBuffer',
+        'CONFIG': {'url': 'redis://localhost:6379', 'maxlen': 200},
+    }
+
+RedisReplayBuffer keeps an INCR counter and a stream trimmed with
+MAXLEN ~ maxlen per room; both are written by one Lua script so sequence
+numbers and stream IDs can never disagree across workers. Both live on the
+room's shard (chat.sharding), next to its registry record.
+"""
+import collections
+import threading
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .codec import with_seq
+from .redis_pool import get_async_redis, get_redis
+from .sharding import HashRing
+
+DEFAULT_REPLAY_BUFFER = {
+    'BACKEND': 'chat.replay.InMemoryReplayBuffer',
+    'CONFIG': {},
+}
+
+RESET_FRAME = '{"type":"reset"}' # Sent before a replay from seq 0: forget the seqs seen so far
+
+
+class BaseReplayBuffer:
+    """
+    Interface shared by all replay buffer backends.
+
+    Frames are pre-encoded JSON objects (see chat.codec); aappend returns the
+    assigned seq and the frame with its "seq" key added.
+    """
+
+    def __init__(self, maxlen=200, **config):
+        self.maxlen = maxlen
+        self.config = config
+
+    async def aappend(self, group_name, frame):
+        """Assigns the next sequence number to frame, stores it and returns (seq, stamped_frame)."""
+        raise NotImplementedError
+
+    async def asince(self, group_name, since):
+        """
+        Returns (frames, truncated, reset): the stored frames with seq > since,
+        oldest first, whether frames the client needs have already been trimmed,
+        and whether since was past the last seq, in which case the frames are
+        those with seq > 0.
+        """
+        raise NotImplementedError
+
+    async def aclear(self, group_name):
+        raise NotImplementedError
+
+    def clear(self, group_name):
+        raise NotImplementedError
+
+
+class InMemoryReplayBuffer(BaseReplayBuffer):
+    """
+    Process-local replay buffer (NOT SUITABLE FOR MULTI-SERVER PRODUCTION).
+    """
+
+    def __init__(self, maxlen=200, **config):
+        super().__init__(maxlen=maxlen, **config)
+        self.last_seq = {}
+        self.frames = {}
+        self._lock = threading.Lock()
+
+    async def aappend(self, group_name, frame):
+        with self._lock:
+            seq = self.last_seq.get(group_name, 0) + 1
+            self.last_seq[group_name] = seq
+            stamped = with_seq(frame, seq)
+            self.frames.setdefault(group_name, collections.deque(maxlen=self.maxlen)).append((seq, stamped))
+            return seq, stamped
+
+    async def asince(self, group_name, since):
+        with self._lock:
+            last_seq = self.last_seq.get(group_name, 0)
+            reset = since > last_seq
+            if reset:
+                since = 0
+            frames = [(seq, frame) for seq, frame in self.frames.get(group_name, ()) if seq > since]
+        return (*missing_frames(frames, since, last_seq), reset)
+
+    def clear(self, group_name):
+        with self._lock:
+            self.last_seq.pop(group_name, None)
+            self.frames.pop(group_name, None)
+
+    async def aclear(self, group_name):
+        self.clear(group_name)
+
+
+def missing_frames(frames, since, last_seq):
+    """
+    frames is [(seq, frame)] with seq > since. Works out whether anything
+    between since and the first retained frame was trimmed away.
+    """
+    first_needed = since + 1
+    if frames:
+        truncated = frames[0][0] > first_needed
+    else:
+        truncated = last_seq >= first_needed
+    return [frame for _, frame in frames], truncated
+
+
+# KEYS: seq counter, stream. ARGV: frame (JSON object), maxlen, ttl seconds.
+# Prepends "seq" to the frame so the stored and broadcast frames are identical.
+APPEND_SCRIPT = """
+local seq = redis.call('INCR', KEYS[1])
+local frame = '{"seq":' .. seq .. ',' .. string.sub(ARGV[1], 2)
+redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[2], seq .. '-0', 'frame', frame)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return {seq, frame}
+"""
+
+
+class RedisReplayBuffer(BaseReplayBuffer):
+    """
+    Replay buffer stored in Redis: a counter and a capped stream per room.
+
+    CONFIG keys:
+        urls    Redis URLs to shard rooms over, like ROOM_REGISTRY (settings.REDIS_SHARDS)
+        url     a single Redis URL instead (defaults to REDIS_URL, then the first CHANNEL_LAYERS host)
+        prefix  key prefix (default 'grego:')
+        maxlen  approximate number of frames kept per room (default 200)
+        ttl     seconds an idle room's buffer is kept (default one day)
+    """
+
+    def __init__(self, url=None, urls=None, prefix='grego:', maxlen=200, ttl=86400, **config):
+        super().__init__(maxlen=maxlen, **config)
+        self.urls = list(urls or [url])
+        self.ring = HashRing(self.urls)
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def seq_key(self, group_name):
+        return f'{self.prefix}room:{group_name}:seq'
+
+    def stream_key(self, group_name):
+        return f'{self.prefix}room:{group_name}:replay'
+
+    def room_keys(self, group_name):
+        return [self.seq_key(group_name), self.stream_key(group_name)]
+
+    def shard(self, group_name):
+        return self.ring.node(group_name)
+
+    def _client(self, group_name):
+        return get_redis(self.shard(group_name))
+
+    def _async_client(self, group_name):
+        return get_async_redis(self.shard(group_name))
+
+    async def aappend(self, group_name, frame):
+        seq, stamped = await self._async_client(group_name).eval(
+            APPEND_SCRIPT, 2, self.seq_key(group_name), self.stream_key(group_name),
+            frame, self.maxlen, self.ttl,
+        )
+        return int(seq), stamped
+
+    async def asince(self, group_name, since):
+        pipe = self._async_client(group_name).pipeline(transaction=False)
+        pipe.get(self.seq_key(group_name))
+        pipe.xrange(self.stream_key(group_name), min=f'{since + 1}-0', max='+')
+        last_seq, entries = await pipe.execute()
+        last_seq = int(last_seq or 0)
+        reset = since > last_seq
+        if reset: # Rare: a second round trip for the whole stream
+            since = 0
+            entries = await self._async_client(group_name).xrange(self.stream_key(group_name), min='-', max='+')
+        frames = [(int(entry_id.split('-', 1)[0]), fields['frame']) for entry_id, fields in entries]
+        return (*missing_frames(frames, since, last_seq), reset)
+
+    def clear(self, group_name):
+        self._client(group_name).delete(self.seq_key(group_name), self.stream_key(group_name))
+
+    async def aclear(self, group_name):
+        await self._async_client(group_name).delete(self.seq_key(group_name), self.stream_key(group_name))
+
+
+_replay_buffer = None
+
+
+def get_replay_buffer():
+    """
+    Returns the process-wide replay buffer configured by settings.REPLAY_BUFFER.
+    """
+    global _replay_buffer
+    if _replay_buffer is None:
+        buffer_settings = getattr(settings, 'REPLAY_BUFFER', DEFAULT_REPLAY_BUFFER)
+        backend_class = import_string(buffer_settings['BACKEND'])
+        _replay_buffer = backend_class(**buffer_settings.get('CONFIG', {}))
+    return _replay_buffer
+
+
+@receiver(setting_changed)
+def reset_replay_buffer(*, setting, **kwargs):
+    global _replay_buffer
+    if setting in ('REPLAY_BUFFER', 'CHANNEL_LAYERS'):
+        _replay_buffer = None
@@ -0,0 +1,628 @@
+"""
+Room registry backends.
+
+The registry is the shared record of which rooms are active, who created them
+and which secret phrase closes them. ChatConsumer and the views both go through
+``get_room_registry()`` so every daphne worker (and every Fly machine) sees the
+same rooms.
+
+Backends are configured like CHANNEL_LAYERS:
+
+    ROOM_REGISTRY = {
+        'BACKEND': 'chat.room_registry.RedisRoomRegistry',
+        'CONFIG': {'urls': ['redis://localhost:6379', 'redis://localhost:6380']},
+    }
+
+RedisRoomRegistry spreads rooms over the given Redis URLs (chat.sharding) and
+stores one hash per room plus a sorted set (scored by creation time) indexing
+the active rooms, so every lookup is a single O(1) command on one shard.
+Occupancy is tracked incrementally by the consumers: each room has a sorted
+set of connected channel names (scored by when their worker last vouched for
+them, see chat.heartbeat) and an occupancy sorted set (scored by member count)
+holds every room with at least one member, so listing occupied rooms is a
+single ZRANGEBYSCORE instead of a keyspace SCAN. Members whose worker stopped
+renewing them are removed with ``aprune_members``. InMemoryRoomRegistry keeps
+the old module-level dict behaviour and is only meant for tests and
+single-process development.
+"""
+import heapq
+import operator
+import threading
+import time
+
+from channels.layers import BaseChannelLayer
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .redis_pool import get_async_redis, get_redis
+from .sharding import HashRing, afan_out, fan_out
+
+DEFAULT_ROOM_REGISTRY = {
+    'BACKEND': 'chat.room_registry.InMemoryRoomRegistry',
+    'CONFIG': {},
+}
+
+ACTIVE_ROOMS_CACHE_KEY = 'chat:active_rooms'
+
+
+class BaseRoomRegistry:
+    """
+    Interface shared by all registry backends.
+
+    Room records are plain dicts with 'secret', 'creator_username' and
+    'created_at' keys, plus 'emptied_at' once the last member has left. Sync
+    methods are for views and management commands, the 'a'-prefixed
+    coroutines are for consumers.
+    """
+
+    def __init__(self, **config):
+        self.config = config
+
+    def create(self, group_name, secret, creator_username):
+        """Registers a room. Returns False if the room already exists."""
+        raise NotImplementedError
+
+    def get(self, group_name):
+        """Returns the room record, or None if the room is not active."""
+        raise NotImplementedError
+
+    def delete(self, group_name):
+        raise NotImplementedError
+
+    def active_rooms(self):
+        """Returns the group names of all active rooms, oldest first."""
+        raise NotImplementedError
+
+    def occupied_rooms(self):
+        """Returns {group_name: member_count} for active rooms with at least one member."""
+        raise NotImplementedError
+
+    def idle_rooms(self, cutoff):
+        """
+        Returns the active rooms that have had no members since before `cutoff`
+        (a time.time() value), counting from creation if nobody ever left.
+        """
+        raise NotImplementedError
+
+    def exists(self, group_name):
+        return self.get(group_name) is not None
+
+    async def acreate(self, group_name, secret, creator_username):
+        raise NotImplementedError
+
+    async def aget(self, group_name):
+        raise NotImplementedError
+
+    async def adelete(self, group_name):
+        raise NotImplementedError
+
+    async def aactive_rooms(self):
+        raise NotImplementedError
+
+    async def aoccupied_rooms(self):
+        raise NotImplementedError
+
+    async def aidle_rooms(self, cutoff):
+        raise NotImplementedError
+
+    async def aadd_member(self, group_name, channel_name):
+        """
+        Records channel_name as connected to the room and returns the new member
+        count, or -1 if the room is not active (it was deleted concurrently).
+        """
+        raise NotImplementedError
+
+    async def aremove_member(self, group_name, channel_name):
+        """Forgets channel_name and returns the remaining member count."""
+        raise NotImplementedError
+
+    async def atouch_members(self, group_name, channel_names):
+        """
+        Marks the given members as alive now. Returns the ones that are no longer
+        members (pruned by another worker or removed with the room).
+        """
+        raise NotImplementedError
+
+    async def aprune_members(self, group_name, cutoff):
+        """
+        Removes members last marked alive before `cutoff` (a time.time() value),
+        updates occupancy and returns the removed channel names.
+        """
+        raise NotImplementedError
+
+    async def aexists(self, group_name):
+        return await self.aget(group_name) is not None
+
+
+class InMemoryRoomRegistry(BaseRoomRegistry):
+    """
+    Process-local registry backed by a dict (NOT SUITABLE FOR MULTI-SERVER PRODUCTION).
+    """
+
+    def __init__(self, **config):
+        super().__init__(**config)
+        self.rooms = {}
+        self.members = {}
+        self._lock = threading.Lock()
+
+    def create(self, group_name, secret, creator_username):
+        with self._lock:
+            if group_name in self.rooms:
+                return False
+            self.rooms[group_name] = {
+                'secret': secret,
+                'creator_username': creator_username,
+                'created_at': time.time(),
+            }
+            return True
+
+    def get(self, group_name):
+        room_data = self.rooms.get(group_name)
+        return dict(room_data) if room_data is not None else None
+
+    def delete(self, group_name):
+        with self._lock:
+            self.rooms.pop(group_name, None)
+            self.members.pop(group_name, None)
+
+    def active_rooms(self):
+        with self._lock:
+            items = list(self.rooms.items())
+        return [name for name, data in sorted(items, key=lambda item: item[1]['created_at'])]
+
+    def occupied_rooms(self):
+        with self._lock:
+            return {name: len(channels) for name, channels in self.members.items() if channels}
+
+    def idle_rooms(self, cutoff):
+        with self._lock:
+            return [
+                name for name, data in self.rooms.items()
+                if not self.members.get(name) and data.get('emptied_at', data['created_at']) < cutoff
+            ]
+
+    def _mark_empty(self, group_name):
+        del self.members[group_name]
+        if group_name in self.rooms:
+            self.rooms[group_name]['emptied_at'] = time.time()
+
+    def add_member(self, group_name, channel_name):
+        with self._lock:
+            if group_name not in self.rooms:
+                return -1
+            channels = self.members.setdefault(group_name, {}) # channel name -> last marked alive
+            channels[channel_name] = time.time()
+            return len(channels)
+
+    def remove_member(self, group_name, channel_name):
+        with self._lock:
+            channels = self.members.get(group_name)
+            if channels is None:
+                return 0
+            channels.pop(channel_name, None)
+            if not channels:
+                self._mark_empty(group_name)
+            return len(channels)
+
+    def touch_members(self, group_name, channel_names):
+        now = time.time()
+        with self._lock:
+            channels = self.members.get(group_name, {})
+            missing = [name for name in channel_names if name not in channels]
+            for name in channel_names:
+                if name in channels:
+                    channels[name] = now
+            return missing
+
+    def prune_members(self, group_name, cutoff):
+        with self._lock:
+            channels = self.members.get(group_name)
+            if channels is None:
+                return []
+            stale = [name for name, seen in channels.items() if seen < cutoff]
+            for name in stale:
+                del channels[name]
+            if not channels:
+                self._mark_empty(group_name)
+            return stale
+
+    # Nothing here does I/O, so the async variants can call straight through.
+    async def acreate(self, group_name, secret, creator_username):
+        return self.create(group_name, secret, creator_username)
+
+    async def aget(self, group_name):
+        return self.get(group_name)
+
+    async def adelete(self, group_name):
+        self.delete(group_name)
+
+    async def aactive_rooms(self):
+        return self.active_rooms()
+
+    async def aoccupied_rooms(self):
+        return self.occupied_rooms()
+
+    async def aidle_rooms(self, cutoff):
+        return self.idle_rooms(cutoff)
+
+    async def aadd_member(self, group_name, channel_name):
+        return self.add_member(group_name, channel_name)
+
+    async def aremove_member(self, group_name, channel_name):
+        return self.remove_member(group_name, channel_name)
+
+    async def atouch_members(self, group_name, channel_names):
+        return self.touch_members(group_name, channel_names)
+
+    async def aprune_members(self, group_name, cutoff):
+        return self.prune_members(group_name, cutoff)
+
+
+# Creates the room hash and adds it to the index only if it does not exist yet,
+# so two creators racing on different workers cannot overwrite each other.
+CREATE_ROOM_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'secret', ARGV[1], 'creator_username', ARGV[2], 'created_at', ARGV[3])
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[4])
+return 1
+"""
+
+# KEYS: room hash, room members zset, occupancy zset. ARGV: channel name, group name, now.
+ADD_MEMBER_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+local count = redis.call('ZCARD', KEYS[2])
+redis.call('ZADD', KEYS[3], count, ARGV[2])
+return count
+"""
+
+# Recording when a room emptied lets the sweeper (chat.teardown) close it after a while.
+# The EXISTS check keeps a deleted room from being recreated as a bare hash.
+MARK_EMPTY_LUA = """
+    redis.call('ZREM', KEYS[2], ARGV[2])
+    if redis.call('EXISTS', KEYS[3]) == 1 then
+        redis.call('HSET', KEYS[3], 'emptied_at', ARGV[3])
+    end
+"""
+
+# KEYS: room members zset, occupancy zset, room hash. ARGV: channel name, group name, now.
+REMOVE_MEMBER_SCRIPT = """
+redis.call('ZREM', KEYS[1], ARGV[1])
+local count = redis.call('ZCARD', KEYS[1])
+if count == 0 then""" + MARK_EMPTY_LUA + """else
+    redis.call('ZADD', KEYS[2], count, ARGV[2])
+end
+return count
+"""
+
+# KEYS: room members zset. ARGV: now, channel names. Returns the names that are not members.
+TOUCH_MEMBERS_SCRIPT = """
+local missing = {}
+for i = 2, #ARGV do
+    if redis.call('ZSCORE', KEYS[1], ARGV[i]) then
+        redis.call('ZADD', KEYS[1], ARGV[1], ARGV[i])
+    else
+        missing[#missing + 1] = ARGV[i]
+    end
+end
+return missing
+"""
+
+# KEYS: room members zset, occupancy zset, room hash. ARGV: cutoff, group name, now.
+# Returns the removed names.
+PRUNE_MEMBERS_SCRIPT = """
+local stale = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[1])
+if #stale == 0 then
+    return stale
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[1])
+local count = redis.call('ZCARD', KEYS[1])
+if count == 0 then""" + MARK_EMPTY_LUA + """else
+    redis.call('ZADD', KEYS[2], count, ARGV[2])
+end
+return stale
+"""
+
+
+class RedisRoomRegistry(BaseRoomRegistry):
+    """
+    Registry stored in Redis: a hash per room and a sorted set of active rooms.
+
+    With several URLs each room lives on the one chosen by chat.sharding, and
+    every shard keeps the active-room index and occupancy of its own rooms, so
+    the scripts below never leave one server. Listings query all shards at once.
+
+    CONFIG keys:
+        urls    Redis URLs to shard rooms over (settings.REDIS_SHARDS)
+        url     a single Redis URL instead (defaults to REDIS_URL, then the first CHANNEL_LAYERS host)
+        prefix  key prefix (default 'grego:')
+    """
+
+    def __init__(self, url=None, urls=None, prefix='grego:', **config):
+        super().__init__(url=url, urls=urls, prefix=prefix, **config)
+        self.urls = list(urls or [url])
+        self.ring = HashRing(self.urls)
+        self.prefix = prefix
+        self.index_key = f'{prefix}rooms:active'
+        self.occupancy_key = f'{prefix}rooms:occupancy'
+
+    def room_key(self, group_name):
+        return f'{self.prefix}room:{group_name}'
+
+    def members_key(self, group_name):
+        # A sorted set since heartbeats; ':members' was a plain set and is only ever deleted.
+        return f'{self.prefix}room:{group_name}:live'
+
+    def legacy_members_key(self, group_name):
+        return f'{self.prefix}room:{group_name}:members'
+
+    def shard(self, group_name):
+        """The URL of the Redis holding the room."""
+        return self.ring.node(group_name)
+
+    def _client(self, url):
+        return get_redis(url)
+
+    def _async_client(self, url):
+        return get_async_redis(url)
+
+    @staticmethod
+    def _decode(room_data):
+        if not room_data:
+            return None
+        room_data['created_at'] = float(room_data.get('created_at', 0))
+        if 'emptied_at' in room_data:
+            room_data['emptied_at'] = float(room_data['emptied_at'])
+        return room_data
+
+    def create(self, group_name, secret, creator_username):
+        created = self._client(self.shard(group_name)).eval(
+            CREATE_ROOM_SCRIPT, 2, self.room_key(group_name), self.index_key,
+            secret, creator_username, time.time(), group_name,
+        )
+        return bool(created)
+
+    def get(self, group_name):
+        return self._decode(self._client(self.shard(group_name)).hgetall(self.room_key(group_name)))
+
+    def exists(self, group_name):
+        return bool(self._client(self.shard(group_name)).exists(self.room_key(group_name)))
+
+    def delete(self, group_name):
+        pipe = self._client(self.shard(group_name)).pipeline()
+        pipe.delete(self.room_key(group_name), self.members_key(group_name), self.legacy_members_key(group_name))
+        pipe.zrem(self.index_key, group_name)
+        pipe.zrem(self.occupancy_key, group_name)
+        pipe.execute()
+
+    def active_rooms(self):
+        return self._by_creation(fan_out(self._shard_active_rooms, self.urls))
+
+    def _shard_active_rooms(self, url):
+        return self._client(url).zrange(self.index_key, 0, -1, withscores=True)
+
+    @staticmethod
+    def _by_creation(shard_rows):
+        # Each shard's index is already sorted by creation time; merge them.
+        return [name for name, created_at in heapq.merge(*shard_rows, key=operator.itemgetter(1))]
+
+    def occupied_rooms(self):
+        # Occupancy only ever holds registered rooms with members, so this is one command per shard.
+        return self._counts(fan_out(self._shard_occupied_rooms, self.urls))
+
+    def _shard_occupied_rooms(self, url):
+        return self._client(url).zrangebyscore(self.occupancy_key, 1, '+inf', withscores=True)
+
+    @staticmethod
+    def _counts(shard_rows):
+        return {name: int(count) for rows in shard_rows for name, count in rows}
+
+    def idle_rooms(self, cutoff):
+        return [name for idle in fan_out(lambda url: self._shard_idle_rooms(url, cutoff), self.urls) for name in idle]
+
+    def _shard_idle_rooms(self, url, cutoff):
+        client = self._client(url)
+        pipe = client.pipeline(transaction=False)
+        pipe.zrange(self.index_key, 0, -1)
+        pipe.zrange(self.occupancy_key, 0, -1)
+        active, occupied = pipe.execute()
+        occupied = set(occupied)
+        candidates = [name for name in active if name not in occupied]
+        pipe = client.pipeline(transaction=False)
+        for group_name in candidates:
+            pipe.hmget(self.room_key(group_name), 'emptied_at', 'created_at')
+        return self._idle(candidates, pipe.execute() if candidates else [], cutoff)
+
+    @staticmethod
+    def _idle(candidates, timestamps, cutoff):
+        idle = []
+        for group_name, (emptied_at, created_at) in zip(candidates, timestamps):
+            since = emptied_at or created_at
+            if since is None or float(since) < cutoff: # No hash: a stale index entry, also reclaimed
+                idle.append(group_name)
+        return idle
+
+    def shard_rooms(self, url):
+        """The rooms in the index of one shard, for reshard_rooms."""
+        return self._client(url).zrange(self.index_key, 0, -1)
+
+    def move_room(self, group_name, source, target, extra_keys=()):
+        """
+        Moves a room (plus `extra_keys`, e.g. its replay buffer) from shard `source`
+        to `target` with DUMP/RESTORE, keeping TTLs and its index and occupancy
+        entries. Returns the number of keys moved.
+        """
+        keys = [self.room_key(group_name), self.members_key(group_name), self.legacy_members_key(group_name), *extra_keys]
+        pipe = self._client(source).pipeline(transaction=False)
+        for key in keys:
+            pipe.dump(key)
+            pipe.pttl(key)
+        pipe.zscore(self.index_key, group_name)
+        pipe.zscore(self.occupancy_key, group_name)
+        *dumped, created_at, occupancy = pipe.execute()
+
+        pipe = self._client(target).pipeline()
+        moved = 0
+        for key, payload, ttl in zip(keys, dumped[0::2], dumped[1::2]):
+            if payload is not None:
+                pipe.restore(key, max(ttl, 0), payload, replace=True) # 0: no expiry
+                moved += 1
+        if created_at is not None:
+            pipe.zadd(self.index_key, {group_name: created_at})
+        if occupancy is not None:
+            pipe.zadd(self.occupancy_key, {group_name: occupancy})
+        pipe.execute()
+
+        pipe = self._client(source).pipeline()
+        pipe.delete(*keys)
+        pipe.zrem(self.index_key, group_name)
+        pipe.zrem(self.occupancy_key, group_name)
+        pipe.execute()
+        return moved
+
+    async def acreate(self, group_name, secret, creator_username):
+        created = await self._async_client(self.shard(group_name)).eval(
+            CREATE_ROOM_SCRIPT, 2, self.room_key(group_name), self.index_key,
+            secret, creator_username, time.time(), group_name,
+        )
+        return bool(created)
+
+    async def aget(self, group_name):
+        return self._decode(await self._async_client(self.shard(group_name)).hgetall(self.room_key(group_name)))
+
+    async def aexists(self, group_name):
+        return bool(await self._async_client(self.shard(group_name)).exists(self.room_key(group_name)))
+
+    async def adelete(self, group_name):
+        pipe = self._async_client(self.shard(group_name)).pipeline()
+        pipe.delete(self.room_key(group_name), self.members_key(group_name), self.legacy_members_key(group_name))
+        pipe.zrem(self.index_key, group_name)
+        pipe.zrem(self.occupancy_key, group_name)
+        await pipe.execute()
+
+    async def aactive_rooms(self):
+        return self._by_creation(await afan_out(self._ashard_active_rooms, self.urls))
+
+    async def _ashard_active_rooms(self, url):
+        return await self._async_client(url).zrange(self.index_key, 0, -1, withscores=True)
+
+    async def aoccupied_rooms(self):
+        return self._counts(await afan_out(self._ashard_occupied_rooms, self.urls))
+
+    async def _ashard_occupied_rooms(self, url):
+        return await self._async_client(url).zrangebyscore(self.occupancy_key, 1, '+inf', withscores=True)
+
+    async def aidle_rooms(self, cutoff):
+        shard_idle = await afan_out(lambda url: self._ashard_idle_rooms(url, cutoff), self.urls)
+        return [name for idle in shard_idle for name in idle]
+
+    async def _ashard_idle_rooms(self, url, cutoff):
+        client = self._async_client(url)
+        pipe = client.pipeline(transaction=False)
+        pipe.zrange(self.index_key, 0, -1)
+        pipe.zrange(self.occupancy_key, 0, -1)
+        active, occupied = await pipe.execute()
+        occupied = set(occupied)
+        candidates = [name for name in active if name not in occupied]
+        pipe = client.pipeline(transaction=False)
+        for group_name in candidates:
+            pipe.hmget(self.room_key(group_name), 'emptied_at', 'created_at')
+        return self._idle(candidates, await pipe.execute() if candidates else [], cutoff)
+
+    async def aadd_member(self, group_name, channel_name):
+        return int(await self._async_client(self.shard(group_name)).eval(
+            ADD_MEMBER_SCRIPT, 3,
+            self.room_key(group_name), self.members_key(group_name), self.occupancy_key,
+            channel_name, group_name, time.time(),
+        ))
+
+    async def aremove_member(self, group_name, channel_name):
+        return int(await self._async_client(self.shard(group_name)).eval(
+            REMOVE_MEMBER_SCRIPT, 3,
+            self.members_key(group_name), self.occupancy_key, self.room_key(group_name),
+            channel_name, group_name, time.time(),
+        ))
+
+    async def atouch_members(self, group_name, channel_names):
+        if not channel_names:
+            return []
+        return await self._async_client(self.shard(group_name)).eval(
+            TOUCH_MEMBERS_SCRIPT, 1, self.members_key(group_name), time.time(), *channel_names,
+        )
+
+    async def aprune_members(self, group_name, cutoff):
+        return await self._async_client(self.shard(group_name)).eval(
+            PRUNE_MEMBERS_SCRIPT, 3, self.members_key(group_name), self.occupancy_key, self.room_key(group_name),
+            cutoff, group_name, time.time(),
+        )
+
+
+_room_registry = None
+
+
+def get_room_registry():
+    """
+    Returns the process-wide registry configured by settings.ROOM_REGISTRY.
+    """
+    global _room_registry
+    if _room_registry is None:
+        registry_settings = getattr(settings, 'ROOM_REGISTRY', DEFAULT_ROOM_REGISTRY)
+        backend_class = import_string(registry_settings['BACKEND'])
+        _room_registry = backend_class(**registry_settings.get('CONFIG', {}))
+    return _room_registry
+
+
+def get_active_rooms():
+    """
+    Returns the sorted display names of occupied rooms for the room list page.
+
+    The result is cached for settings.ACTIVE_ROOMS_CACHE_TIMEOUT seconds and
+    dropped by invalidate_active_rooms() whenever a room is created, deleted,
+    gains its first member or loses its last one.
+    """
+    active_rooms = cache.get(ACTIVE_ROOMS_CACHE_KEY)
+    if active_rooms is None:
+        occupied = get_room_registry().occupied_rooms()
+        active_rooms = sorted(room_display_name(group_name) for group_name in occupied)
+        cache.set(ACTIVE_ROOMS_CACHE_KEY, active_rooms, getattr(settings, 'ACTIVE_ROOMS_CACHE_TIMEOUT', 2))
+    return active_rooms
+
+
+async def invalidate_active_rooms():
+    await cache.adelete(ACTIVE_ROOMS_CACHE_KEY)
+
+
+def room_group_name(room_name):
+    # 'table 20' -> 'chat_table_20'
+    return f'chat_{room_name.replace(" ", "_")}'
+
+
+def is_valid_room_name(room_name):
+    # Only names whose group the channel layer accepts can ever be opened.
+    group_name = room_group_name(room_name)
+    return (
+        len(group_name) < BaseChannelLayer.MAX_NAME_LENGTH
+        and BaseChannelLayer.group_name_regex.match(group_name) is not None
+    )
+
+
+def room_display_name(group_name):
+    # 'chat_table_20' -> 'table 20'
+    if group_name.startswith('chat_'):
+        group_name = group_name[len('chat_'):]
+    return group_name.replace('_', ' ')
+
+
+@receiver(setting_changed)
+def reset_room_registry(*, setting, **kwargs):
+    # Lets tests swap backends with override_settings(ROOM_REGISTRY=...).
+    global _room_registry
+    if setting in ('ROOM_REGISTRY', 'CHANNEL_LAYERS'):
+        _room_registry = None
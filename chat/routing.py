@@ -4,5 +4,7 @@ from . import consumers
 
 websocket_urlpatterns = [
     re_path(r'ws/chat/(?P<room_name>[^/]+)/$', consumers.ChatConsumer.as_asgi()),
+    re_path(r'ws/lobby/$', consumers.LobbyConsumer.as_asgi()), # Live room list
+    re_path(r'ws/staff/$', consumers.StaffMonitorConsumer.as_asgi()), # Staff only; many rooms on one socket
 
 ]
\ No newline at end of file
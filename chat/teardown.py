@@ -0,0 +1,80 @@
+"""
+Server-side room teardown.
+
+``close_room()`` shuts a room down for everyone, wherever their sockets are:
+it broadcasts a final System frame (each consumer sends it and closes with
+1000), deletes the channel layer group in one command so nothing more is
+fanned out to it, and frees the room's registry record, members, replay
+buffer, rate-limit bucket and cached room list entry. It is used by the
+creator's secret phrase, the staff "Close" button on /rooms/ and
+``manage.py close_rooms``.
+
+Rooms nobody has been in for CHAT_EMPTY_ROOM_TTL seconds are closed by
+``sweeper``, which every worker runs every CHAT_ROOM_SWEEP_INTERVAL seconds
+once it has accepted a chat socket. Closing a room twice is harmless, so
+workers do not coordinate.
+"""
+import logging
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import codec, lifecycle, limits, lobby, metrics
+from .replay import get_replay_buffer
+from .room_registry import get_room_registry, invalidate_active_rooms
+
+logger = logging.getLogger(__name__)
+
+
+def empty_room_ttl():
+    return getattr(settings, 'CHAT_EMPTY_ROOM_TTL', 1800)
+
+
+def sweep_interval():
+    if empty_room_ttl() <= 0:
+        return 0
+    return getattr(settings, 'CHAT_ROOM_SWEEP_INTERVAL', 60)
+
+
+def shutdown_frame(notice):
+    # 'closed' tells the page not to reconnect, whatever the notice says.
+    return codec.dumps({'message': notice, 'username': 'System', 'closed': True})
+
+
+async def close_room(group_name, notice, reason='creator'):
+    """
+    Closes every socket in the room and deletes all of its state.
+    """
+    layer = get_channel_layer()
+    await layer.group_send(group_name, {'type': 'chat.room_shutdown', 'frame': shutdown_frame(notice), 'group': group_name})
+    await delete_group(layer, group_name)
+    await get_room_registry().adelete(group_name)
+    await get_replay_buffer().aclear(group_name)
+    limits.discard_room_bucket(group_name)
+    await invalidate_active_rooms()
+    lobby.room_changed(group_name, 0)
+    metrics.ROOMS_CLOSED.labels(reason).inc()
+    logger.info(f"Closed room '{group_name}' ({reason})")
+
+
+async def delete_group(layer, group_name):
+    if hasattr(layer, 'group_delete'):
+        await layer.group_delete(group_name)
+    else: # InMemoryChannelLayer
+        layer.groups.pop(group_name, None)
+
+
+async def sweep_idle_rooms():
+    """
+    Closes the rooms that have been empty for longer than CHAT_EMPTY_ROOM_TTL and
+    drops this process's rate-limit buckets for rooms it no longer serves.
+    """
+    idle = await get_room_registry().aidle_rooms(time.time() - empty_room_ttl())
+    for group_name in idle:
+        await close_room(group_name, "This room was closed after being empty for a while.", reason='idle')
+    limits.retain_room_buckets({consumer.room_group_name for consumer in lifecycle.live_consumers})
+    return idle
+
+
+sweeper = lifecycle.Periodic(sweep_idle_rooms, sweep_interval)
@@ -0,0 +1,30 @@
+// Which message sequence numbers the page has shown (included by room.html).
+// Two senders on different workers each take a seq and then race to broadcast,
+// so seq N+1 can arrive before N: a seq is checked against the ones seen, not
+// against the highest. Reconnects ask for everything after `contiguous`, and
+// whatever arrives twice is dropped here.
+class SeqTracker {
+    constructor(window) {
+        this.window = window; // Seqs held beyond a gap before giving up on it (its seq was never sent)
+        this.reset();
+    }
+
+    reset() {
+        this.contiguous = 0; // Every seq up to this one has been shown or given up on
+        this.ahead = new Set(); // Shown seqs above it
+    }
+
+    accept(seq) {
+        if (seq <= this.contiguous || this.ahead.has(seq)) {
+            return false;
+        }
+        this.ahead.add(seq);
+        if (this.ahead.size > this.window) {
+            this.contiguous = Math.min(...this.ahead) - 1;
+        }
+        while (this.ahead.delete(this.contiguous + 1)) {
+            this.contiguous += 1;
+        }
+        return true;
+    }
+}
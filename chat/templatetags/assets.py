@@ -0,0 +1,27 @@
+"""
+Template tags for the assets built by "manage.py build_assets".
+"""
+from django import template
+from django.contrib.staticfiles import finders
+from django.templatetags.static import static
+from django.utils.html import format_html
+
+register = template.Library()
+
+STYLESHEET = 'css/app.css'
+PLAY_CDN = 'https://cdn.tailwindcss.com'
+
+
+@register.simple_tag
+def site_stylesheet():
+    """
+    Links the compiled stylesheet. A checkout that has not run build_assets (and
+    collectstatic, with DEBUG off) falls back to Tailwind's in-browser compiler.
+    """
+    try:
+        href = static(STYLESHEET) if finders.find(STYLESHEET) else None
+    except ValueError: # Built but not collected: no manifest entry
+        href = None
+    if href is None:
+        return format_html('<script src="{}"></script>', PLAY_CDN)
+    return format_html('<link rel="stylesheet" href="{}">', href)
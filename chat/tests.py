@@ -1,3 +1,1351 @@
-from django.test import TestCase
+import asyncio
+import collections
+import io
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import skipUnless
 
-# Create your tests here.
+import fakeredis
+import msgpack
+from asgiref.sync import async_to_sync
+from channels.auth import AuthMiddlewareStack
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.template.loader import render_to_string
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from prometheus_client import REGISTRY
+
+from accounts.backends import get_user_cache
+
+from . import codec, heartbeat, lifecycle, limits, lobby, logs, presence, qr, redis_pool, routing, sharding, teardown
+from .archive import HISTORY_FRAME, MessageArchive, get_message_archive, history_token
+from .consumers import event_frame
+from .diagnostics import LoopMonitor
+from .management.commands.build_assets import render_blocking
+from .management.commands.serve import accept_permessage_deflate, unsent_bytes
+from .models import Message
+from .replay import RESET_FRAME, RedisReplayBuffer, get_replay_buffer
+from .room_registry import InMemoryRoomRegistry, RedisRoomRegistry, get_active_rooms, get_room_registry
+from .templatetags.assets import site_stylesheet
+
+IN_MEMORY_SETTINGS = {
+    'CHANNEL_LAYERS': {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    'ROOM_REGISTRY': {'BACKEND': 'chat.room_registry.InMemoryRoomRegistry'},
+    'REPLAY_BUFFER': {'BACKEND': 'chat.replay.InMemoryReplayBuffer', 'CONFIG': {'maxlen': 3}},
+}
+
+
+def flush_message_archive():
+    # Writes the batches a test left pending while its database is still there.
+    get_message_archive().flush_sync()
+
+
+def connect_to_room(room_name, user, query_string=''):
+    """
+    Builds a communicator for ws/chat/<room_name>/ with the user already in scope.
+    """
+    application = URLRouter(routing.websocket_urlpatterns)
+    path = f'/ws/chat/{room_name}/'
+    if query_string:
+        path += f'?{query_string}'
+    communicator = WebsocketCommunicator(application, path)
+    communicator.scope['user'] = user
+    return communicator
+
+
+async def receive_presence(communicator, predicate=lambda presence: True):
+    """
+    Returns the first presence snapshot matching `predicate`, skipping earlier ones.
+    """
+    while True:
+        frame = await communicator.receive_json_from()
+        if 'presence' in frame and predicate(frame['presence']):
+            return frame['presence']
+
+
+async def receive_conversation(communicator):
+    """
+    Returns the next frame that is not a presence snapshot, which may arrive at any point.
+    """
+    while True:
+        frame = await communicator.receive_json_from()
+        if 'presence' not in frame:
+            return frame
+
+
+def connect_to_monitor(user, path='/ws/staff/'):
+    communicator = WebsocketCommunicator(URLRouter(routing.websocket_urlpatterns), path)
+    communicator.scope['user'] = user
+    return communicator
+
+
+class InMemoryRoomRegistryTests(TestCase):
+    def test_create_is_first_writer_wins(self):
+        registry = InMemoryRoomRegistry()
+        self.assertTrue(registry.create('chat_table_1', 'close-it', 'alice'))
+        self.assertFalse(registry.create('chat_table_1', 'other', 'bob'))
+        self.assertEqual(registry.get('chat_table_1')['creator_username'], 'alice')
+
+    def test_active_rooms_oldest_first_and_delete(self):
+        registry = InMemoryRoomRegistry()
+        registry.create('chat_b', 's', 'alice')
+        registry.create('chat_a', 's', 'alice')
+        self.assertEqual(registry.active_rooms(), ['chat_b', 'chat_a'])
+        registry.delete('chat_b')
+        self.assertFalse(registry.exists('chat_b'))
+        self.assertEqual(registry.active_rooms(), ['chat_a'])
+
+    def test_occupancy_tracks_members_of_active_rooms(self):
+        registry = InMemoryRoomRegistry()
+        self.assertEqual(registry.add_member('chat_gone', 'c1'), -1)
+        registry.create('chat_a', 's', 'alice')
+        self.assertEqual(registry.add_member('chat_a', 'c1'), 1)
+        self.assertEqual(registry.add_member('chat_a', 'c2'), 2)
+        self.assertEqual(registry.occupied_rooms(), {'chat_a': 2})
+        registry.remove_member('chat_a', 'c1')
+        self.assertEqual(registry.remove_member('chat_a', 'c2'), 0)
+        self.assertEqual(registry.occupied_rooms(), {})
+
+    def test_members_not_renewed_are_pruned(self):
+        registry = InMemoryRoomRegistry()
+        registry.create('chat_a', 's', 'alice')
+        registry.add_member('chat_a', 'c1')
+        registry.add_member('chat_a', 'c2')
+        cutoff = time.time() + 1
+        self.assertEqual(registry.touch_members('chat_a', ['c1', 'c3']), ['c3'])
+        registry.members['chat_a']['c1'] = cutoff + 1
+        self.assertEqual(registry.prune_members('chat_a', cutoff), ['c2'])
+        self.assertEqual(registry.occupied_rooms(), {'chat_a': 1})
+
+    def test_idle_rooms_count_from_when_the_last_member_left(self):
+        registry = InMemoryRoomRegistry()
+        registry.create('chat_never_joined', 's', 'alice')
+        registry.create('chat_emptied', 's', 'alice')
+        registry.create('chat_busy', 's', 'alice')
+        registry.add_member('chat_emptied', 'c1')
+        registry.add_member('chat_busy', 'c2')
+        registry.rooms['chat_never_joined']['created_at'] -= 120
+        registry.rooms['chat_emptied']['created_at'] -= 120
+        registry.remove_member('chat_emptied', 'c1')
+        self.assertEqual(registry.idle_rooms(time.time() - 60), ['chat_never_joined'])
+        self.assertEqual(registry.idle_rooms(time.time() + 1), ['chat_never_joined', 'chat_emptied'])
+
+
+class LobbyDeltaTests(TestCase):
+    def test_delta_reports_only_what_changed(self):
+        known = {'table 1': 2, 'table 2': 1}
+        changes = lobby.delta(known, {'table 1': 3, 'table 2': 0, 'table 3': 1, 'table 4': 0})
+        self.assertEqual(changes, {'added': {'table 3': 1}, 'changed': {'table 1': 3}, 'removed': ['table 2']})
+        self.assertEqual(known, {'table 1': 3, 'table 3': 1})
+        self.assertEqual(lobby.delta(known, {'table 1': 3}), {})
+
+
+class PresenceTests(TestCase):
+    def update(self, origin, at, here=(), typing=(), count=None, group='chat_presence'):
+        return {
+            'type': 'presence.update', 'group': group, 'origin': origin, 'at': at,
+            'presence': {'here': list(here), 'typing': list(typing), 'count': len(here) if count is None else count},
+        }
+
+    def test_snapshots_from_each_process_are_merged(self):
+        now = time.time()
+        presence.received(self.update('a', now, here=['Ana', 'Bob'], typing=['Ana']))
+        frame, packed = presence.received(self.update('b', now, here=['Ana', 'Cy'], count=3))
+        self.assertEqual(codec.loads(frame), {'presence': {'here': ['Ana', 'Bob', 'Cy'], 'typing': ['Ana'], 'count': 5}})
+        self.assertEqual(codec.unpack(packed), codec.loads(frame))
+
+        self.assertIsNone(presence.received(self.update('a', now - 1, here=['Old']))) # Superseded
+        self.assertEqual(presence.received(self.update('b', now, here=['Ana', 'Cy'], count=3))[0], frame) # Other members here
+        frame, packed = presence.received(self.update('a', now + 1)) # Its last member left
+        self.assertEqual(codec.loads(frame), {'presence': {'here': ['Ana', 'Cy'], 'typing': [], 'count': 3}})
+
+    def test_snapshots_of_a_dead_process_expire(self):
+        now = time.time()
+        presence.received(self.update('gone', now - heartbeat.timeout() - 1, here=['Ghost'], group='chat_expiry'))
+        frame, packed = presence.received(self.update('alive', now, here=['Ana'], group='chat_expiry'))
+        self.assertEqual(codec.loads(frame)['presence']['here'], ['Ana'])
+
+    @override_settings(CHAT_SLOW_CONSUMER_QUEUE_SIZE=8, CHAT_SLOW_CONSUMER_BUFFER_BYTES=1000)
+    def test_presence_backs_off_before_messages(self):
+        queued = SlowConsumer(queued=5)
+        self.assertFalse(limits.is_slow_consumer(queued))
+        self.assertTrue(limits.is_slow_consumer(queued, presence.BACKLOG_SHARE))
+        unsent = SlowConsumer(unsent=600)
+        self.assertFalse(limits.is_slow_consumer(unsent))
+        self.assertTrue(limits.is_slow_consumer(unsent, presence.BACKLOG_SHARE))
+
+
+@skipUnless(shutil.which('node'), "Needs node")
+class SeqTrackerTests(TestCase):
+    def accept(self, window, seqs):
+        """Runs room.html's SeqTracker over `seqs`; returns what it showed and its final `contiguous`."""
+        script = render_to_string('chat/seq_tracker.js') + f"""
+            const tracker = new SeqTracker({window});
+            const shown = {json.dumps(seqs)}.filter(seq => tracker.accept(seq));
+            console.log(JSON.stringify([shown, tracker.contiguous]));
+        """
+        result = subprocess.run(['node', '-e', script], capture_output=True, text=True, check=True)
+        return json.loads(result.stdout)
+
+    def test_frame_arriving_out_of_order_is_shown(self):
+        # 3 was broadcast before 2; the replay after a reconnect repeats 2 to 4.
+        self.assertEqual(self.accept(10, [1, 3, 2, 2, 3, 4]), [[1, 3, 2, 4], 4])
+
+    def test_reconnect_resumes_from_the_first_gap(self):
+        self.assertEqual(self.accept(10, [1, 2, 4, 5]), [[1, 2, 4, 5], 2])
+
+    def test_gap_is_given_up_on_past_the_window(self):
+        self.assertEqual(self.accept(3, [1, 3, 4, 5, 6, 2, 7]), [[1, 3, 4, 5, 6, 7], 7])
+
+
+class EventFrameTests(TestCase):
+    def test_frame_is_passed_through(self):
+        self.assertEqual(event_frame({'type': 'chat.message', 'frame': '{"a":1}'}), '{"a":1}')
+
+    def test_events_from_older_workers_are_encoded(self):
+        frame = event_frame({'type': 'chat.room_shutdown', 'message': 'bye'}, default_username='System')
+        self.assertEqual(frame, '{"message":"bye","username":"System"}')
+
+
+class SlowReceiverTests(TestCase):
+    # Twisted runs in a child process, so this one never has a reactor installed.
+    FLOOD = """
+import socket
+from twisted.internet import protocol, reactor
+from chat.management.commands.serve import unsent_bytes
+
+class Flood(protocol.Protocol):
+    def connectionMade(self):
+        self.transport.write(b'x' * 16_000_000) # Far beyond what the kernel buffers
+        reactor.callLater(0.5, self.report)
+
+    def report(self):
+        print(unsent_bytes(self))
+        reactor.stop()
+
+port = reactor.listenTCP(0, protocol.Factory.forProtocol(Flood), interface='127.0.0.1')
+client = socket.create_connection(('127.0.0.1', port.getHost().port)) # Never reads
+reactor.run()
+"""
+
+    def test_client_that_does_not_read_leaves_bytes_unsent(self):
+        result = subprocess.run(
+            [sys.executable, '-c', self.FLOOD], cwd=settings.BASE_DIR, capture_output=True, text=True, timeout=30,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertGreater(int(result.stdout), settings.CHAT_SLOW_CONSUMER_BUFFER_BYTES)
+        self.assertEqual(unsent_bytes(object()), 0) # No TCP transport to measure
+
+
+class WireFormatTests(TestCase):
+    def test_chat_lines_pack_as_arrays_and_other_frames_as_maps(self):
+        frame = codec.with_seq(codec.encode_chat_frame('hola', 'Ana'), 7)
+        self.assertEqual(codec.pack(frame), codec.pack_chat_frame('hola', 'Ana', 7))
+        self.assertEqual(codec.unpack(codec.pack(frame)), [7, 'Ana', 'hola'])
+        self.assertLess(len(codec.pack(frame)), len(frame))
+        closed = codec.dumps({'message': 'bye', 'username': 'System', 'closed': True})
+        self.assertEqual(codec.unpack(codec.pack(closed)), {'message': 'bye', 'username': 'System', 'closed': True})
+
+    @override_settings(CHAT_WS_COMPRESSION_WINDOW_BITS=11)
+    def test_permessage_deflate_is_accepted_with_a_small_window(self):
+        from autobahn.websocket.compress import PerMessageDeflateOffer
+
+        accept = accept_permessage_deflate([PerMessageDeflateOffer(accept_max_window_bits=True)])
+        self.assertEqual((accept.window_bits, accept.request_max_window_bits, accept.mem_level), (11, 11, 4))
+        self.assertIn('client_max_window_bits=11', accept.get_extension_string())
+        accept = accept_permessage_deflate([PerMessageDeflateOffer(accept_max_window_bits=False, request_max_window_bits=9)])
+        self.assertEqual((accept.window_bits, accept.request_max_window_bits), (9, 0))
+        self.assertIsNone(accept_permessage_deflate([]))
+
+
+class TokenBucketTests(TestCase):
+    def test_burst_then_refill(self):
+        bucket = limits.TokenBucket(rate=10, capacity=2)
+        self.assertTrue(bucket.consume())
+        self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+        bucket.updated -= 0.1 # 100 ms later one token is back
+        self.assertTrue(bucket.consume())
+
+
+class StubConnection:
+    """Stands in for a redis-py connection so pool bookkeeping can be tested without Redis."""
+
+    def __init__(self, **kwargs):
+        self.pid = os.getpid()
+
+    def connect(self):
+        pass
+
+    def can_read(self):
+        return False
+
+    def disconnect(self):
+        pass
+
+
+class RedisPoolTests(TestCase):
+    def test_clients_are_shared_per_url(self):
+        with override_settings(REDIS_URL='redis://pool-test:6379/1'):
+            client = redis_pool.get_redis()
+            self.assertIs(redis_pool.get_redis('redis://pool-test:6379/1'), client)
+            self.assertIsNot(redis_pool.get_redis('redis://pool-test:6379/2'), client)
+        with override_settings(REDIS_URL='redis://pool-test:6379/1'):
+            self.assertIsNot(redis_pool.get_redis(), client)
+
+    def test_connections_are_reused(self):
+        import redis
+
+        pool_class = redis_pool.instrumented_pool_class(redis.BlockingConnectionPool)
+        pool = pool_class(connection_class=StubConnection, max_connections=2, timeout=0)
+        created = REGISTRY.get_sample_value('chat_redis_pool_connections_created_total', {'pool': 'sync'}) or 0
+        waits = REGISTRY.get_sample_value('chat_redis_pool_wait_seconds_count', {'pool': 'sync'}) or 0
+        for _ in range(20):
+            pool.release(pool.get_connection('GET'))
+        first, second = pool.get_connection('GET'), pool.get_connection('GET')
+        self.assertEqual(REGISTRY.get_sample_value('chat_redis_pool_in_use', {'pool': 'sync'}), 2)
+        with self.assertRaises(redis.ConnectionError): # Pool exhausted
+            pool.get_connection('GET')
+        pool.release(first)
+        pool.release(second)
+
+        self.assertEqual(REGISTRY.get_sample_value('chat_redis_pool_connections_created_total', {'pool': 'sync'}) - created, 2)
+        self.assertEqual(REGISTRY.get_sample_value('chat_redis_pool_wait_seconds_count', {'pool': 'sync'}) - waits, 22)
+        self.assertEqual(REGISTRY.get_sample_value('chat_redis_pool_in_use', {'pool': 'sync'}), 0)
+
+
+class ForkedChannelLayerTests(TestCase):
+    def test_forked_worker_gets_its_own_client_prefix(self):
+        from .channel_layers import HybridRedisChannelLayer
+
+        layer = HybridRedisChannelLayer(hosts=['redis://localhost:6379/0'])
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.write(write_end, layer.client_prefix.encode())
+            os._exit(0)
+        os.close(write_end)
+        child_prefix = os.read(read_end, 100).decode()
+        os.close(read_end)
+        os.waitpid(pid, 0)
+        self.assertEqual(len(child_prefix), 32)
+        self.assertNotEqual(child_prefix, layer.client_prefix)
+
+
+@skipUnless(os.environ.get('TEST_REDIS_URL'), "Needs TEST_REDIS_URL")
+class HybridRedisChannelLayerTests(TestCase):
+    def test_local_group_send_reaches_a_waiting_receiver(self):
+        from .channel_layers import HybridRedisChannelLayer
+
+        async def scenario():
+            layer = HybridRedisChannelLayer(hosts=[os.environ['TEST_REDIS_URL']])
+            try:
+                channel = await layer.new_channel()
+                await layer.group_add('hybrid-test', channel)
+                receive = asyncio.ensure_future(layer.receive(channel))
+                await asyncio.sleep(0.1) # Let the reader block on Redis first
+                started = time.monotonic()
+                await layer.group_send('hybrid-test', {'type': 'x'})
+                self.assertEqual(await asyncio.wait_for(receive, 2), {'type': 'x'})
+                # Well inside the 5s Redis read timeout it used to wait for.
+                self.assertLess(time.monotonic() - started, 1)
+                await layer.group_discard('hybrid-test', channel)
+            finally:
+                await layer.flush()
+                await layer.close_pools()
+
+        async_to_sync(scenario)()
+
+
+class HashRingTests(TestCase):
+    urls = [f'redis://shard{i}:6379/0' for i in range(4)]
+    rooms = [f'chat_table_{i}' for i in range(2000)]
+
+    def test_rooms_spread_evenly(self):
+        ring = sharding.HashRing(self.urls)
+        counts = collections.Counter(ring.node(room) for room in self.rooms)
+        self.assertEqual(set(counts), set(self.urls))
+        self.assertLess(max(counts.values()) / min(counts.values()), 1.5)
+
+    def test_adding_a_shard_moves_only_rooms_onto_it(self):
+        before = sharding.HashRing(self.urls[:3])
+        after = sharding.HashRing(self.urls)
+        moved = [room for room in self.rooms if before.node(room) != after.node(room)]
+        self.assertTrue(all(after.node(room) == self.urls[3] for room in moved))
+        self.assertLess(len(moved), len(self.rooms) * 0.35) # About a quarter
+
+    def test_removing_a_shard_moves_only_its_rooms(self):
+        before = sharding.HashRing(self.urls)
+        after = sharding.HashRing(self.urls[:2] + self.urls[3:])
+        moved = [room for room in self.rooms if before.node(room) != after.node(room)]
+        self.assertTrue(all(before.node(room) == self.urls[2] for room in moved))
+
+    def test_placement_ignores_order_and_credentials(self):
+        ring = sharding.HashRing(self.urls)
+        other = sharding.HashRing(['redis://:secret@shard3:6379'] + self.urls[:3])
+        self.assertEqual(sharding.shard_name('redis://:secret@shard3:6379'), 'shard3:6379/0')
+        for room in self.rooms[:200]:
+            self.assertEqual(sharding.shard_name(ring.node(room)), sharding.shard_name(other.node(room)))
+
+    def test_channel_layer_puts_a_group_on_its_room_shard(self):
+        from .channel_layers import HybridRedisChannelLayer
+
+        layer = HybridRedisChannelLayer(hosts=self.urls)
+        ring = sharding.HashRing(self.urls)
+        for room in self.rooms[:200]:
+            self.assertEqual(self.urls[layer.consistent_hash(room)], ring.node(room))
+
+    def test_channel_layer_sends_where_the_process_reads(self):
+        from .channel_layers import HybridRedisChannelLayer
+
+        layer = HybridRedisChannelLayer(hosts=self.urls)
+        for i in range(50):
+            process = f'specific.{i:032x}!'
+            self.assertEqual(layer.consistent_hash(f'{process}{i:032x}'), layer.consistent_hash(process))
+
+
+def redis_test_shards(count):
+    # Separate databases of TEST_REDIS_URL stand in for separate servers.
+    base = os.environ['TEST_REDIS_URL'].rsplit('/', 1)[0]
+    return [f'{base}/{10 + i}' for i in range(count)]
+
+
+@skipUnless(os.environ.get('TEST_REDIS_URL'), "Needs TEST_REDIS_URL")
+class ShardedRoomsTests(TestCase):
+    prefix = 'test-shards:'
+
+    def setUp(self):
+        for url in redis_test_shards(4):
+            redis_pool.get_redis(url).flushdb()
+
+    def run_async(self, coroutine):
+        async def scenario():
+            try:
+                return await coroutine
+            finally:
+                await redis_pool.aclose_loop_clients()
+        return async_to_sync(scenario)()
+
+    def sharded_settings(self, count):
+        urls = redis_test_shards(count)
+        return override_settings(
+            ROOM_REGISTRY={'BACKEND': 'chat.room_registry.RedisRoomRegistry', 'CONFIG': {'urls': urls, 'prefix': self.prefix}},
+            REPLAY_BUFFER={'BACKEND': 'chat.replay.RedisReplayBuffer', 'CONFIG': {'urls': urls, 'prefix': self.prefix}},
+        )
+
+    def test_rooms_live_on_one_shard_and_listings_cover_all(self):
+        rooms = [f'chat_table_{i}' for i in range(30)]
+        with self.sharded_settings(3):
+            registry = get_room_registry()
+            for room in rooms:
+                registry.create(room, 'secret', 'alice')
+            self.run_async(registry.aadd_member(rooms[0], 'specific.a!1'))
+            self.run_async(get_replay_buffer().aappend(rooms[0], '{"message":"hi"}'))
+
+            self.assertEqual(registry.active_rooms(), rooms)
+            self.assertEqual(self.run_async(registry.aactive_rooms()), rooms)
+            self.assertEqual(registry.occupied_rooms(), {rooms[0]: 1})
+            self.assertEqual(set(registry.idle_rooms(time.time() + 1)), set(rooms[1:]))
+            self.assertEqual(len({registry.shard(room) for room in rooms}), 3)
+            for room in rooms:
+                for url in registry.urls:
+                    self.assertEqual(bool(redis_pool.get_redis(url).exists(registry.room_key(room))), url == registry.shard(room))
+            replay = get_replay_buffer()
+            self.assertEqual(redis_pool.get_redis(registry.shard(rooms[0])).exists(*replay.room_keys(rooms[0])), 2)
+
+    def test_reshard_moves_only_the_rooms_whose_shard_changed(self):
+        rooms = [f'chat_table_{i}' for i in range(60)]
+        with self.sharded_settings(3):
+            old = get_room_registry()
+            for room in rooms:
+                old.create(room, 'secret', 'alice')
+            self.run_async(old.aadd_member(rooms[0], 'specific.a!1'))
+            self.run_async(get_replay_buffer().aappend(rooms[0], '{"message":"hi"}'))
+            before = {room: old.shard(room) for room in rooms}
+
+        with self.sharded_settings(4):
+            out = io.StringIO()
+            call_command('reshard_rooms', stdout=out)
+            registry = get_room_registry()
+            moved = [room for room in rooms if registry.shard(room) != before[room]]
+            self.assertIn(f"{len(moved)} of 60 rooms moved", out.getvalue())
+            self.assertTrue(0 < len(moved) < 30)
+            self.assertEqual(registry.active_rooms(), rooms)
+            self.assertEqual(registry.occupied_rooms(), {rooms[0]: 1})
+            self.assertEqual(registry.get(rooms[0])['creator_username'], 'alice')
+            frames, truncated, reset = self.run_async(get_replay_buffer().asince(rooms[0], 0))
+            self.assertEqual((len(frames), truncated, reset), (1, False, False))
+
+        # Dropping the fourth shard again moves its rooms back where they were.
+        with self.sharded_settings(3):
+            call_command('reshard_rooms', '--from', redis_test_shards(4)[3], stdout=io.StringIO())
+            registry = get_room_registry()
+            self.assertEqual(registry.active_rooms(), rooms)
+            self.assertFalse(redis_pool.get_redis(redis_test_shards(4)[3]).keys(f'{self.prefix}*'))
+
+
+class FakeRedisRoomRegistry(RedisRoomRegistry):
+    """RedisRoomRegistry on in-process fakeredis servers, one per URL; lupa runs the Lua scripts."""
+
+    def __init__(self, **config):
+        super().__init__(**config)
+        self.servers = collections.defaultdict(fakeredis.FakeServer)
+
+    def _client(self, url):
+        return fakeredis.FakeRedis(server=self.servers[url], decode_responses=True)
+
+    def _async_client(self, url):
+        return fakeredis.FakeAsyncRedis(server=self.servers[url], decode_responses=True)
+
+
+class FakeRedisReplayBuffer(RedisReplayBuffer):
+    def __init__(self, **config):
+        super().__init__(**config)
+        self.servers = collections.defaultdict(fakeredis.FakeServer)
+
+    def _client(self, group_name):
+        return fakeredis.FakeRedis(server=self.servers[self.shard(group_name)], decode_responses=True)
+
+    def _async_client(self, group_name):
+        return fakeredis.FakeAsyncRedis(server=self.servers[self.shard(group_name)], decode_responses=True)
+
+
+class RedisRoomRegistryScriptTests(TestCase):
+    """The registry's Lua scripts, on fakeredis so they run without TEST_REDIS_URL."""
+
+    def setUp(self):
+        self.registry = FakeRedisRoomRegistry(urls=['redis://shard0/0', 'redis://shard1/0'], prefix='test:')
+
+    def test_create_is_atomic_and_listings_cover_every_shard(self):
+        rooms = [f'chat_table_{i}' for i in range(10)]
+        for room in rooms:
+            self.assertTrue(self.registry.create(room, 's', 'alice'))
+        self.assertFalse(self.registry.create(rooms[0], 'other', 'mallory'))
+        self.assertEqual(self.registry.get(rooms[0])['creator_username'], 'alice')
+        self.assertEqual({self.registry.shard(room) for room in rooms}, set(self.registry.urls))
+        self.assertEqual(self.registry.active_rooms(), rooms)
+
+    async def test_join_leave_and_close(self):
+        self.registry.create('chat_table_1', 's', 'alice')
+        self.assertEqual(await self.registry.aadd_member('chat_table_1', 'specific.a!1'), 1)
+        self.assertEqual(await self.registry.aadd_member('chat_table_1', 'specific.a!2'), 2)
+        self.assertEqual(await self.registry.aadd_member('chat_table_2', 'specific.a!3'), -1) # Not open
+        self.assertEqual(await self.registry.aoccupied_rooms(), {'chat_table_1': 2})
+        self.assertEqual(await self.registry.atouch_members('chat_table_1', ['specific.a!1', 'specific.gone!1']), ['specific.gone!1'])
+
+        self.assertEqual(await self.registry.aremove_member('chat_table_1', 'specific.a!2'), 1)
+        self.assertEqual(await self.registry.aprune_members('chat_table_1', time.time() + 1), ['specific.a!1'])
+        self.assertEqual(self.registry.occupied_rooms(), {})
+        self.assertIn('emptied_at', await self.registry.aget('chat_table_1'))
+        self.assertEqual(await self.registry.aidle_rooms(time.time() + 1), ['chat_table_1'])
+        self.assertEqual(self.registry.idle_rooms(time.time() - 60), [])
+
+        await self.registry.adelete('chat_table_1')
+        # A member leaving after the close must not bring the room back.
+        self.assertEqual(await self.registry.aremove_member('chat_table_1', 'specific.a!1'), 0)
+        self.assertFalse(await self.registry.aexists('chat_table_1'))
+        self.assertEqual(await self.registry.aactive_rooms(), [])
+
+
+class RedisReplayBufferScriptTests(TestCase):
+    def setUp(self):
+        self.buffer = FakeRedisReplayBuffer(urls=['redis://shard0/0'], prefix='test:')
+
+    async def test_append_and_since(self):
+        appended = [await self.buffer.aappend('chat_table_1', codec.encode_chat_frame(text, 'Bob')) for text in ('a', 'b', 'c')]
+        self.assertEqual([seq for seq, _ in appended], [1, 2, 3])
+        self.assertEqual(json.loads(appended[0][1]), {'seq': 1, 'message': 'a', 'username': 'Bob'})
+
+        self.assertEqual(await self.buffer.asince('chat_table_1', 1), ([frame for _, frame in appended[1:]], False, False))
+        self.assertEqual(await self.buffer.asince('chat_table_1', 3), ([], False, False))
+        # A since from an earlier opening of the room gets everything, and a reset.
+        self.assertEqual(await self.buffer.asince('chat_table_1', 7), ([frame for _, frame in appended], False, True))
+
+        await self.buffer.aclear('chat_table_1')
+        self.assertEqual(await self.buffer.asince('chat_table_1', 0), ([], False, False))
+        self.assertEqual((await self.buffer.aappend('chat_table_1', codec.encode_chat_frame('d', 'Bob')))[0], 1)
+
+
+@override_settings(**IN_MEMORY_SETTINGS)
+class RoomHistoryTests(TestCase):
+    def setUp(self):
+        registry = get_room_registry()
+        registry.create('chat_table_1', 's', 'alice')
+        self.opened_at = registry.get('chat_table_1')['created_at']
+        self.token = history_token('chat_table_1', self.opened_at)
+        Message.objects.bulk_create(
+            Message(room='chat_table_1', opened_at=self.opened_at, seq=i, username='Bob', content=f'line {i}')
+            for i in range(1, 6)
+        )
+        Message.objects.create(room='chat_table_1', opened_at=self.opened_at - 3600, seq=9, username='Eve', content='last party')
+        Message.objects.create(room='chat_table_2', opened_at=self.opened_at, seq=1, username='Eve', content='other room')
+        self.url = reverse('chat:room_history', kwargs={'room_name': 'table 1'})
+
+    def test_keyset_pages_walk_back_through_history(self):
+        first = self.client.get(self.url, {'limit': 2, 'token': self.token}).json()
+        self.assertEqual([m['seq'] for m in first['messages']], [4, 5])
+
+        second = self.client.get(self.url, {'limit': 2, 'before': first['next_cursor'], 'token': self.token}).json()
+        self.assertEqual([m['seq'] for m in second['messages']], [2, 3])
+
+        last = self.client.get(self.url, {'limit': 2, 'before': second['next_cursor'], 'token': self.token}).json()
+        self.assertEqual([m['message'] for m in last['messages']], ['line 1']) # Not the earlier party's
+        self.assertIsNone(last['next_cursor'])
+
+    def test_bad_cursor_is_rejected(self):
+        self.assertEqual(self.client.get(self.url, {'before': 'abc', 'token': self.token}).status_code, 400)
+
+    def test_needs_a_token_for_this_room(self):
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+        self.assertEqual(self.client.get(self.url, {'token': 'forged'}).status_code, 403)
+        other = history_token('chat_table_2', self.opened_at)
+        self.assertEqual(self.client.get(self.url, {'token': other}).status_code, 403)
+
+    def test_closed_or_reopened_room_is_not_served(self):
+        stale = history_token('chat_table_1', self.opened_at - 3600) # From the earlier party
+        self.assertEqual(self.client.get(self.url, {'token': stale}).status_code, 404)
+        get_room_registry().delete('chat_table_1')
+        self.assertEqual(self.client.get(self.url, {'token': self.token}).status_code, 404)
+
+
+@override_settings(CHAT_QR_CODES={'menu': 'https://example.com/menu'}, CHAT_QR_CACHE_SIZE=2, **IN_MEMORY_SETTINGS)
+class QRCodeTests(TestCase):
+    def test_page_needs_no_external_script(self):
+        response = self.client.get(reverse('chat:menu_qr'))
+        self.assertNotContains(response, 'qrcode.min.js')
+        self.assertContains(response, f"/chat/qr/menu.svg?v={qr.version('https://example.com/menu')}")
+
+    def test_versioned_image_is_immutable_and_revalidates(self):
+        url = reverse('chat:qr_image', kwargs={'name': 'menu', 'kind': 'svg'})
+        response = self.client.get(url, {'v': qr.version('https://example.com/menu')})
+        self.assertEqual(response['Content-Type'], 'image/svg+xml')
+        self.assertTrue(response.content.startswith(b'<svg'))
+        self.assertIn('immutable', response['Cache-Control'])
+
+        unversioned = self.client.get(url)
+        self.assertEqual(unversioned['Cache-Control'], 'public, no-cache')
+        not_modified = self.client.get(url, headers={'If-None-Match': response['ETag']})
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified['ETag'], response['ETag'])
+
+    def test_images_are_encoded_once_per_key(self):
+        renders = REGISTRY.get_sample_value('chat_qr_renders_total', {'kind': 'png'}) or 0
+        first = qr.render('https://example.com/a', 'png')
+        self.assertIs(qr.render('https://example.com/a', 'png'), first)
+        self.assertTrue(first.body.startswith(b'\x89PNG'))
+        qr.render('https://example.com/b', 'png')
+        qr.render('https://example.com/c', 'png') # Evicts /a, the least recently used
+        self.assertIsNot(qr.render('https://example.com/a', 'png'), first)
+        self.assertEqual(REGISTRY.get_sample_value('chat_qr_renders_total', {'kind': 'png'}) - renders, 4)
+
+    def test_room_code_and_bad_requests(self):
+        get_room_registry().create('chat_table_1', 's', 'alice')
+        response = self.client.get(reverse('chat:room_qr', kwargs={'room_name': 'table 1', 'kind': 'png'}))
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertIs(qr.get_image_cache().get(('http://testserver/chat/table%201/', 'png', 8)).body, response.content)
+        self.assertEqual(self.client.get(reverse('chat:qr_image', kwargs={'name': 'nope', 'kind': 'svg'})).status_code, 404)
+        self.assertEqual(self.client.get(reverse('chat:qr_image', kwargs={'name': 'menu', 'kind': 'gif'})).status_code, 400)
+        url = reverse('chat:qr_image', kwargs={'name': 'menu', 'kind': 'svg'})
+        self.assertEqual(self.client.get(url, {'scale': '500'}).status_code, 400)
+
+    def test_room_codes_are_only_made_for_rooms_that_can_open(self):
+        url = reverse('chat:room_qr', kwargs={'room_name': 'table 2', 'kind': 'svg'})
+        self.assertEqual(self.client.get(url).status_code, 404) # Not open, and no one is about to open it
+        self.client.force_login(User.objects.create_user('alice'))
+        self.assertEqual(self.client.get(url).status_code, 200) # Its creator, from the create room page
+        too_long = reverse('chat:room_qr', kwargs={'room_name': 'x' * 2000, 'kind': 'svg'})
+        self.assertEqual(self.client.get(too_long).status_code, 400)
+        self.assertIsNone(qr.get_image_cache().get((f'http://testserver/chat/{"x" * 2000}/', 'svg', 8)))
+
+    @override_settings(ALLOWED_HOSTS=['*'])
+    def test_links_too_long_for_a_code_are_a_bad_request(self):
+        get_room_registry().create('chat_table_1', 's', 'alice')
+        url = reverse('chat:room_qr', kwargs={'room_name': 'table 1', 'kind': 'svg'})
+        self.assertEqual(self.client.get(url, headers={'host': 'a' * 4000 + '.example.com'}).status_code, 400)
+
+
+class LoggingTests(TestCase):
+    def make_logger(self, handler):
+        logger = logging.getLogger('chat.tests.logs')
+        logger.handlers, logger.propagate = [handler], False
+        self.addCleanup(setattr, logger, 'handlers', [])
+        return logger
+
+    def test_records_are_formatted_and_written_off_the_calling_thread(self):
+        formatted_on = []
+
+        class Arg:
+            def __str__(self):
+                formatted_on.append(threading.current_thread())
+                return 'arg'
+
+        stream = io.StringIO()
+        handler = logs.BackgroundHandler(stream)
+        handler.setFormatter(logs.JSONFormatter())
+        self.addCleanup(handler.close)
+        logger = self.make_logger(handler)
+        logger.warning("value %s", Arg(), extra={'event': 'test', 'room': 'chat_a'})
+        handler.flush()
+        entry = json.loads(stream.getvalue())
+        self.assertEqual((entry['message'], entry['event'], entry['room']), ('value arg', 'test', 'chat_a'))
+        self.assertNotEqual(formatted_on, [threading.current_thread()])
+
+    def test_full_queue_drops_and_counts(self):
+        handler = logs.BackgroundHandler(io.StringIO(), max_queue=1)
+        self.addCleanup(handler.close)
+        handler.writer.stop() # Nothing drains the queue
+        dropped = REGISTRY.get_sample_value('chat_log_records_dropped_total') or 0
+        logger = self.make_logger(handler)
+        for _ in range(3):
+            logger.warning("x")
+        self.assertEqual(REGISTRY.get_sample_value('chat_log_records_dropped_total') - dropped, 2)
+        handler.writer.start()
+
+    def test_sampler_caps_each_event_per_second(self):
+        sampler = logs.EventSampler(rates={'never': 0}, max_per_second={'capped': 2})
+        self.addCleanup(setattr, logs.EventSampler, 'installed', logs.EventSampler.installed)
+        self.assertIsNone(logs.sample('never'))
+        kept = [logs.sample('capped') for _ in range(5)]
+        self.assertEqual(sum(extra is not None for extra in kept), 2)
+        self.assertEqual(logs.sample('other'), {'event': 'other', 'sampled': True})
+
+        sampler.windows['capped'][0] -= 1 # The next second
+        self.assertEqual(logs.sample('capped')['suppressed'], 3)
+        record = logging.makeLogRecord({'msg': 'x', 'event': 'never'})
+        self.assertFalse(sampler.filter(record))
+        self.assertTrue(sampler.filter(logging.makeLogRecord({'msg': 'no event'})))
+
+
+class SiteStylesheetTests(TestCase):
+    def test_links_the_built_stylesheet_or_falls_back_to_the_play_cdn(self):
+        with tempfile.TemporaryDirectory() as build_dir:
+            storages = {**settings.STORAGES, 'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'}}
+            with override_settings(STATICFILES_DIRS=[build_dir], STORAGES=storages):
+                self.assertEqual(site_stylesheet(), '<script src="https://cdn.tailwindcss.com"></script>')
+                os.mkdir(os.path.join(build_dir, 'css'))
+                open(os.path.join(build_dir, 'css', 'app.css'), 'w').close()
+                self.assertEqual(site_stylesheet(), '<link rel="stylesheet" href="/static/css/app.css">')
+
+    def test_render_blocking_files_in_head(self):
+        html = (
+            '<html><head><link rel="stylesheet" href="/static/app.css"><link rel="stylesheet" href="p.css" media="print">'
+            '<script src="https://cdn.example.com/x.js"></script><script src="/d.js" defer></script></head>'
+            '<body><script src="/late.js"></script></body></html>'
+        )
+        self.assertEqual(render_blocking(html), ['/static/app.css', 'https://cdn.example.com/x.js'])
+
+
+@override_settings(**IN_MEMORY_SETTINGS)
+class MetricsViewTests(TestCase):
+    def test_exposes_chat_metrics(self):
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'chat_messages_total', response.content)
+
+    def test_room_connections_only_cover_occupied_rooms(self):
+        registry = get_room_registry()
+        registry.create('chat_table_1', 's', 'alice')
+        registry.add_member('chat_table_1', 'c1')
+        registry.add_member('chat_table_1', 'c2')
+        self.assertContains(self.client.get('/metrics'), 'chat_room_connections{room="chat_table_1"} 2.0')
+        registry.remove_member('chat_table_1', 'c1')
+        registry.remove_member('chat_table_1', 'c2')
+        self.assertNotContains(self.client.get('/metrics'), 'chat_table_1') # No series left behind
+
+    @override_settings(METRICS_TOKEN='scrape-me')
+    def test_token_is_required_when_configured(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer scrape-me')
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(**IN_MEMORY_SETTINGS)
+class ReadinessTests(TestCase):
+    def test_ready_after_warm_up_and_not_while_draining(self):
+        lifecycle.warm_up()
+        response = self.client.get('/ready')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['ready'])
+
+        lifecycle.draining = True
+        try:
+            self.assertEqual(self.client.get('/ready').status_code, 503)
+        finally:
+            lifecycle.draining = False
+
+
+class DiagnosticsTests(TestCase):
+    async def test_watchdog_reports_a_blocked_loop(self):
+        before = REGISTRY.get_sample_value('chat_event_loop_stalls_total') or 0
+        monitor = LoopMonitor(interval=0.01, warn_after=0.05)
+        monitor.start(asyncio.get_running_loop())
+        await asyncio.sleep(0.02)
+        with self.assertLogs('chat.diagnostics', 'WARNING') as logs:
+            time.sleep(0.2) # Blocks the loop, as a synchronous query in a consumer would
+            await asyncio.sleep(0.02)
+        monitor._task.cancel()
+        self.assertEqual(REGISTRY.get_sample_value('chat_event_loop_stalls_total'), before + 1)
+        self.assertIn('test_watchdog_reports_a_blocked_loop', '\n'.join(logs.output))
+
+    def test_profile_is_staff_only(self):
+        url = reverse('debug_profile')
+        self.client.force_login(User.objects.create_user('bob'))
+        self.assertEqual(self.client.get(url, {'seconds': 0.05}).status_code, 302)
+
+        self.client.force_login(User.objects.create_user('carol', is_staff=True))
+        response = self.client.get(url, {'seconds': 0.05})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content.startswith(b'# '))
+        self.assertEqual(self.client.get(url, {'kind': 'memory', 'seconds': 0.05}).status_code, 200)
+
+
+@override_settings(**IN_MEMORY_SETTINGS)
+class ChatConsumerTests(TransactionTestCase):
+    def setUp(self):
+        self.creator = User.objects.create_user('alice', password='pw-for-tests')
+        cache.clear()
+        self.addCleanup(flush_message_archive)
+
+    async def test_drain_closes_members_and_refuses_new_sockets(self):
+        creator = connect_to_room('table_8', self.creator, 'secret=s')
+        await creator.connect()
+        try:
+            await lifecycle.drain(window=0.01)
+            self.assertEqual(await creator.receive_output(), {'type': 'websocket.close', 'code': lifecycle.SERVICE_RESTART})
+            await creator.disconnect()
+            connected, code = await connect_to_room('table_8', AnonymousUser()).connect()
+            self.assertFalse(connected)
+            self.assertEqual(code, lifecycle.SERVICE_RESTART)
+        finally:
+            lifecycle.draining = False
+
+    async def test_unknown_room_is_rejected(self):
+        before = REGISTRY.get_sample_value('chat_rejected_connects_total', {'code': '4004'}) or 0
+        communicator = connect_to_room('table_9', AnonymousUser())
+        connected, code = await communicator.connect()
+        self.assertFalse(connected)
+        self.assertEqual(code, 4004)
+        self.assertEqual(REGISTRY.get_sample_value('chat_rejected_connects_total', {'code': '4004'}), before + 1)
+
+    async def test_creator_registers_room_and_guests_can_chat(self):
+        creator = connect_to_room('table_1', self.creator, 'secret=close-it')
+        connected, _ = await creator.connect()
+        self.assertTrue(connected)
+        self.assertTrue(get_room_registry().exists('chat_table_1'))
+        self.assertEqual(get_active_rooms(), ['table 1'])
+
+        guest = connect_to_room('table_1', AnonymousUser())
+        connected, _ = await guest.connect()
+        self.assertTrue(connected)
+
+        await guest.send_json_to({'message': 'hello', 'username': 'Bob'})
+        self.assertEqual(await creator.receive_json_from(), {'seq': 1, 'message': 'hello', 'username': 'Bob'})
+        self.assertEqual(await guest.receive_json_from(), {'seq': 1, 'message': 'hello', 'username': 'Bob'})
+
+        await creator.send_json_to({'message': 'close-it'})
+        shutdown = await guest.receive_json_from()
+        self.assertEqual(shutdown['username'], 'System')
+        self.assertTrue(shutdown['closed'])
+        self.assertEqual(await guest.receive_output(), {'type': 'websocket.close', 'code': 1000})
+        self.assertFalse(get_room_registry().exists('chat_table_1'))
+        self.assertNotIn('chat_table_1', get_channel_layer().groups)
+        self.assertEqual(get_room_registry().occupied_rooms(), {})
+
+        await guest.disconnect()
+        await creator.disconnect()
+
+    async def test_secret_phrase_and_messages_are_not_logged(self):
+        with self.assertLogs('chat.consumers', 'DEBUG') as logs:
+            creator = connect_to_room('table_18', self.creator, 'secret=close-it')
+            await creator.connect()
+            guest = connect_to_room('table_18', AnonymousUser())
+            await guest.connect()
+            await guest.send_json_to({'message': 'my card is 4111'})
+            await creator.receive_json_from()
+            await creator.send_json_to({'message': 'close-it'})
+            await guest.receive_json_from()
+            await guest.disconnect()
+            await creator.disconnect()
+        output = '\n'.join(logs.output)
+        self.assertIn("Room 'table_18' CREATED by 'alice'", output)
+        self.assertIn('Initiating shutdown', output)
+        self.assertNotIn('close-it', output)
+        self.assertNotIn('4111', output)
+
+    async def test_members_get_a_history_token_for_this_opening(self):
+        creator = connect_to_room('history_1', self.creator, 'secret=s')
+        await creator.connect()
+        await creator.send_json_to({'message': 'hello', 'username': 'alice'})
+        await creator.receive_json_from()
+        await creator.send_to(text_data=HISTORY_FRAME)
+        token = (await creator.receive_json_from())['history_token']
+        await get_message_archive().flush()
+
+        url = reverse('chat:room_history', kwargs={'room_name': 'history 1'})
+        response = await self.async_client.get(url, {'token': token})
+        self.assertEqual([m['message'] for m in response.json()['messages']], ['hello'])
+        await creator.disconnect()
+
+    async def test_room_leaves_list_when_last_member_disconnects(self):
+        creator = connect_to_room('table_2', self.creator, 'secret=close-it')
+        await creator.connect()
+        self.assertEqual(get_active_rooms(), ['table 2'])
+        await creator.disconnect()
+        self.assertEqual(get_active_rooms(), [])
+        self.assertTrue(get_room_registry().exists('chat_table_2'))
+
+    async def test_reconnect_replays_only_missed_frames(self):
+        creator = connect_to_room('table_3', self.creator, 'secret=close-it')
+        await creator.connect()
+        for text in ('one', 'two', 'three'):
+            await creator.send_json_to({'message': text})
+            await creator.receive_json_from()
+
+        guest = connect_to_room('table_3', AnonymousUser(), 'since=1')
+        await guest.connect()
+        self.assertEqual([(await guest.receive_json_from())['seq'] for _ in range(2)], [2, 3])
+        self.assertTrue(await guest.receive_nothing())
+
+        # maxlen is 3, so after two more messages seq 2 is gone and the client is told so.
+        for text in ('four', 'five'):
+            await creator.send_json_to({'message': text})
+            await creator.receive_json_from()
+        late_guest = connect_to_room('table_3', AnonymousUser(), 'since=1')
+        await late_guest.connect()
+        self.assertEqual((await late_guest.receive_json_from())['username'], 'System')
+        self.assertEqual([(await late_guest.receive_json_from())['seq'] for _ in range(3)], [3, 4, 5])
+
+        for communicator in (guest, late_guest, creator):
+            await communicator.disconnect()
+
+    async def test_resuming_past_the_last_seq_resets_the_client(self):
+        # The client saw seq 1..5 of an earlier opening; this one has only reached 2.
+        creator = connect_to_room('table_19', self.creator, 'secret=s')
+        await creator.connect()
+        for text in ('one', 'two'):
+            await creator.send_json_to({'message': text})
+            await creator.receive_json_from()
+
+        guest = connect_to_room('table_19', AnonymousUser(), 'since=5')
+        await guest.connect()
+        self.assertEqual(await guest.receive_from(), RESET_FRAME)
+        self.assertEqual([(await guest.receive_json_from())['message'] for _ in range(2)], ['one', 'two'])
+        self.assertTrue(await guest.receive_nothing())
+
+        for communicator in (guest, creator):
+            await communicator.disconnect()
+
+    def test_batches_are_not_written_to_another_database_at_exit(self):
+        archive = MessageArchive()
+        archive.database = 'torn-down-test-database'
+        archive.pending.append(Message(room='chat_table_1', opened_at=0, seq=1, username='Bob', content='hi'))
+        with self.assertLogs('chat.archive', 'WARNING'):
+            archive.flush_sync()
+        self.assertEqual((archive.pending, Message.objects.count()), ([], 0))
+
+    @override_settings(MESSAGE_ARCHIVE_BATCH_SIZE=2, MESSAGE_ARCHIVE_FLUSH_INTERVAL_MS=60000)
+    async def test_messages_are_archived_in_batches(self):
+        creator = connect_to_room('table_4', self.creator, 'secret=close-it')
+        await creator.connect()
+        await creator.send_json_to({'message': 'first'})
+        await creator.receive_json_from()
+        self.assertEqual(await database_sync_to_async(Message.objects.count)(), 0)
+
+        await creator.send_json_to({'message': 'second'})
+        await creator.receive_json_from()
+        await get_message_archive().flush() # Waits for the batch the second message triggered
+        rows = await database_sync_to_async(list)(Message.objects.order_by('seq').values_list('seq', 'content'))
+        self.assertEqual(rows, [(1, 'first'), (2, 'second')])
+        await creator.disconnect()
+
+    @override_settings(CHAT_MAX_FRAME_BYTES=64)
+    async def test_oversized_frames_are_rejected_before_parsing(self):
+        creator = connect_to_room('table_5', self.creator, 'secret=close-it')
+        await creator.connect()
+        before = limits.counters['frame_rejected']
+        await creator.send_to(text_data='{"message": "' + 'x' * 100 + '"}')
+        self.assertEqual(await creator.receive_json_from(), {'error': 'Message too large.'})
+        self.assertEqual(limits.counters['frame_rejected'], before + 1)
+        await creator.disconnect()
+
+    @override_settings(CHAT_CONNECTION_RATE=0.001, CHAT_CONNECTION_BURST=1)
+    async def test_connection_rate_limit(self):
+        creator = connect_to_room('table_6', self.creator, 'secret=close-it')
+        await creator.connect()
+        await creator.send_json_to({'message': 'one'})
+        self.assertEqual((await creator.receive_json_from())['message'], 'one')
+        await creator.send_json_to({'message': 'two'})
+        self.assertIn('error', await creator.receive_json_from())
+        await creator.disconnect()
+
+    async def test_heartbeat_pings_and_closes_silent_sockets(self):
+        creator = connect_to_room('table_10', self.creator, 'secret=s&heartbeat=1')
+        await creator.connect()
+        guest = connect_to_room('table_10', AnonymousUser(), 'heartbeat=1')
+        await guest.connect()
+        creator_consumer = next(c for c in lifecycle.live_consumers if c.scope['user'].is_authenticated)
+        guest_consumer = next(c for c in lifecycle.live_consumers if not c.scope['user'].is_authenticated)
+
+        await heartbeat.beat()
+        self.assertEqual(await creator.receive_json_from(), {'type': 'ping'})
+        self.assertEqual(await guest.receive_json_from(), {'type': 'ping'})
+        await creator.send_to(text_data=heartbeat.PONG_FRAME)
+        self.assertTrue(await creator.receive_nothing()) # A pong is not a chat message
+
+        guest_consumer.last_seen -= 60 # Went quiet for longer than CHAT_HEARTBEAT_TIMEOUT
+        before = REGISTRY.get_sample_value('chat_heartbeat_pruned_total', {'reason': 'silent'}) or 0
+        await heartbeat.beat()
+        self.assertEqual(await guest.receive_output(), {'type': 'websocket.close', 'code': heartbeat.STALE})
+        self.assertEqual(get_room_registry().occupied_rooms(), {'chat_table_10': 1})
+        self.assertEqual(list(get_channel_layer().groups['chat_table_10']), [creator_consumer.channel_name])
+        self.assertEqual(REGISTRY.get_sample_value('chat_heartbeat_pruned_total', {'reason': 'silent'}), before + 1)
+
+        await guest.disconnect()
+        await creator.disconnect()
+
+    async def test_heartbeat_prunes_members_no_worker_renews(self):
+        creator = connect_to_room('table_11', self.creator, 'secret=s')
+        await creator.connect()
+        # A member whose worker crashed: still in the group and occupancy, but never renewed.
+        registry, layer = get_room_registry(), get_channel_layer()
+        await registry.aadd_member('chat_table_11', 'specific.dead!1')
+        await layer.group_add('chat_table_11', 'specific.dead!1')
+        registry.members['chat_table_11']['specific.dead!1'] -= 60
+        self.assertEqual(get_active_rooms(), ['table 11'])
+        self.assertEqual(registry.occupied_rooms(), {'chat_table_11': 2})
+
+        await heartbeat.beat()
+        self.assertEqual(registry.occupied_rooms(), {'chat_table_11': 1})
+        self.assertNotIn('specific.dead!1', layer.groups['chat_table_11'])
+        self.assertTrue(await creator.receive_nothing()) # Didn't ask for pings, isn't pinged
+        await creator.disconnect()
+
+    @override_settings(CHAT_EMPTY_ROOM_TTL=60)
+    async def test_sweeper_closes_rooms_empty_past_the_ttl(self):
+        creator = connect_to_room('table_12', self.creator, 'secret=s')
+        await creator.connect()
+        await creator.disconnect()
+        registry = get_room_registry()
+        self.assertEqual(await teardown.sweep_idle_rooms(), []) # Emptied just now
+        registry.rooms['chat_table_12']['emptied_at'] -= 120
+
+        self.assertEqual(await teardown.sweep_idle_rooms(), ['chat_table_12'])
+        self.assertFalse(registry.exists('chat_table_12'))
+        connected, code = await connect_to_room('table_12', AnonymousUser()).connect()
+        self.assertFalse(connected)
+        self.assertEqual(code, 4004)
+
+    async def test_staff_can_close_a_room(self):
+        creator = connect_to_room('table_13', self.creator, 'secret=s')
+        await creator.connect()
+        url = reverse('close_room', args=['table 13'])
+        await database_sync_to_async(User.objects.create_user)('staff', password='pw-for-tests', is_staff=True)
+        await self.async_client.alogin(username='staff', password='pw-for-tests')
+        self.assertEqual((await self.async_client.get(url)).status_code, 405)
+
+        response = await self.async_client.post(url)
+        self.assertRedirects(response, reverse('list_active_rooms'), fetch_redirect_response=False)
+        self.assertEqual(await receive_conversation(creator), {
+            'message': "Room 'table 13' was closed by staff.", 'username': 'System', 'closed': True,
+        })
+        self.assertFalse(get_room_registry().exists('chat_table_13'))
+        await creator.disconnect()
+
+    @override_settings(CHAT_MONITOR_BATCH_SIZE=2, CHAT_MONITOR_BATCH_MS=10)
+    async def test_staff_monitor_watches_many_rooms_on_one_socket(self):
+        connected, code = await connect_to_monitor(self.creator).connect()
+        self.assertFalse(connected)
+        self.assertEqual(code, 4003)
+
+        rooms = [connect_to_room(f'table_{i}', self.creator, 'secret=s') for i in (14, 15)]
+        for room in rooms:
+            await room.connect()
+        staff = await database_sync_to_async(User.objects.create_user)('staff', is_staff=True)
+        monitor = connect_to_monitor(staff)
+        connected, _ = await monitor.connect()
+        self.assertTrue(connected)
+        await monitor.send_json_to({'subscribe': ['table 14', 'table 15', 'table 99']})
+        self.assertEqual(await monitor.receive_json_from(), {'watching': ['table 14', 'table 15'], 'unknown': ['table 99']})
+        self.assertEqual(get_room_registry().occupied_rooms(), {'chat_table_14': 1, 'chat_table_15': 1})
+        await heartbeat.beat() # Renews the monitor's groups without counting it as a member
+        self.assertEqual(get_room_registry().occupied_rooms(), {'chat_table_14': 1, 'chat_table_15': 1})
+
+        for room, text in zip(rooms, ('one', 'two')):
+            await room.send_json_to({'message': text})
+        self.assertEqual(await monitor.receive_json_from(), {'batch': [
+            {'room': 'table 14', 'seq': 1, 'message': 'one', 'username': 'alice'},
+            {'room': 'table 15', 'seq': 1, 'message': 'two', 'username': 'alice'},
+        ]})
+
+        await monitor.send_json_to({'unsubscribe': ['table 15']})
+        self.assertEqual(await monitor.receive_json_from(), {'watching': ['table 14']})
+        await rooms[1].send_json_to({'message': 'unseen'})
+        await rooms[0].send_json_to({'message': 's'}) # The secret: closes table 14
+        batch = (await monitor.receive_json_from())['batch'] # Sent after CHAT_MONITOR_BATCH_MS
+        self.assertEqual([(frame['room'], frame.get('closed')) for frame in batch], [('table 14', True)])
+        await monitor.send_json_to({'subscribe': '*'})
+        watching = (await monitor.receive_json_from())['watching'] # Rooms left by other tests too
+        self.assertIn('table 15', watching)
+        self.assertNotIn('table 14', watching)
+
+        await monitor.disconnect()
+        for room in rooms:
+            await room.disconnect()
+
+    @override_settings(CHAT_LOBBY_WINDOW_MS=20)
+    async def test_lobby_gets_the_list_then_coalesced_deltas(self):
+        connected, code = await connect_to_monitor(AnonymousUser(), '/ws/lobby/').connect()
+        self.assertFalse(connected)
+        self.assertEqual(code, 4003)
+
+        creator = connect_to_room('table_16', self.creator, 'secret=s')
+        await creator.connect()
+        await asyncio.sleep(0.05) # Let the creator's own update go out before the lobby joins
+        feed = connect_to_monitor(self.creator, '/ws/lobby/')
+        await feed.connect()
+        self.assertEqual((await feed.receive_json_from())['rooms']['table 16'], 1)
+
+        guests = [connect_to_room('table_16', AnonymousUser()) for _ in range(3)]
+        for guest in guests:
+            await guest.connect()
+        self.assertEqual(await feed.receive_json_from(), {'changed': {'table 16': 4}}) # One frame for three joins
+        self.assertTrue(await feed.receive_nothing(0.1))
+
+        await creator.send_json_to({'message': 's'}) # Closes the room
+        self.assertEqual(await feed.receive_json_from(), {'removed': ['table 16']})
+
+        await feed.disconnect()
+        for communicator in (creator, *guests):
+            await communicator.disconnect()
+
+    async def test_msgpack_subprotocol(self):
+        creator = connect_to_room('table_17', self.creator, 'secret=s')
+        await creator.connect()
+        application = URLRouter(routing.websocket_urlpatterns)
+        guest = WebsocketCommunicator(application, '/ws/chat/table_17/', subprotocols=['grego.msgpack.v1', 'grego.json.v1'])
+        guest.scope['user'] = AnonymousUser()
+        self.assertEqual(await guest.connect(), (True, 'grego.msgpack.v1'))
+
+        await guest.send_to(bytes_data=msgpack.packb({'message': 'hola', 'username': 'Ana'}))
+        self.assertEqual(codec.unpack((await guest.receive_output())['bytes']), [1, 'Ana', 'hola'])
+        self.assertEqual(await creator.receive_json_from(), {'seq': 1, 'message': 'hola', 'username': 'Ana'})
+        await creator.send_json_to({'message': 'text still works'})
+        self.assertEqual(codec.unpack((await guest.receive_output())['bytes']), [2, 'alice', 'text still works'])
+        await creator.receive_json_from()
+
+        await guest.send_to(bytes_data=b'\xc1') # Never valid MessagePack
+        self.assertEqual(codec.unpack((await guest.receive_output())['bytes']), {'error': 'Invalid message format.'})
+        await creator.send_to(bytes_data=b'\x00') # Binary from a JSON client is refused as before
+        self.assertEqual(await creator.receive_json_from(), {'error': 'Message too large.'})
+
+        for communicator in (guest, creator):
+            await communicator.disconnect()
+
+    @override_settings(CHAT_SLOW_CONSUMER_QUEUE_SIZE=1)
+    async def test_slow_consumer_frames_are_dropped(self):
+        creator = connect_to_room('table_7', self.creator, 'secret=close-it')
+        await creator.connect()
+        layer = get_channel_layer()
+        channel_name = next(iter(layer.groups['chat_table_7']))
+        layer.receive_buffer = {channel_name: BacklogQueue(5)} # Looks like five broadcasts queued up
+        before = limits.counters['slow_consumer_dropped']
+        try:
+            await creator.send_json_to({'message': 'lost'})
+            self.assertTrue(await creator.receive_nothing())
+            self.assertEqual(limits.counters['slow_consumer_dropped'], before + 1)
+        finally:
+            del layer.receive_buffer
+        await creator.disconnect()
+
+    @override_settings(CHAT_SLOW_CONSUMER_BUFFER_BYTES=1000)
+    async def test_frames_for_a_client_that_is_not_reading_are_dropped(self):
+        creator = connect_to_room('table_7', self.creator, 'secret=close-it')
+        unsent = 0
+        creator.scope['write_buffer_size'] = lambda: unsent # As manage.py serve reports its socket
+        await creator.connect()
+        await creator.send_json_to({'message': 'first'})
+        self.assertEqual((await creator.receive_json_from())['message'], 'first')
+        unsent = 5000
+        before = limits.counters['slow_consumer_dropped']
+        await creator.send_json_to({'message': 'lost'})
+        self.assertTrue(await creator.receive_nothing())
+        self.assertEqual(limits.counters['slow_consumer_dropped'], before + 1)
+        await creator.disconnect()
+
+    @override_settings(CHAT_PRESENCE_INTERVAL_MS=20)
+    async def test_typing_is_coalesced_into_presence_snapshots(self):
+        creator = connect_to_room('presence_1', self.creator, 'secret=close-it')
+        await creator.connect()
+        self.assertEqual(await receive_presence(creator), {'here': ['alice'], 'typing': [], 'count': 1})
+        guest = connect_to_room('presence_1', AnonymousUser(), 'name=Ana%20B')
+        await guest.connect()
+        await receive_presence(creator, lambda presence: presence['count'] == 2)
+
+        snapshots = REGISTRY.get_sample_value('chat_presence_snapshots_total')
+        for _ in range(50): # Keystrokes: far past the message rate limit, yet nothing is refused
+            await guest.send_to(text_data='{"typing":true}')
+        typing = await receive_presence(creator, lambda presence: presence['typing'])
+        self.assertEqual(typing, {'here': ['Ana B', 'alice'], 'typing': ['Ana B'], 'count': 2})
+        self.assertEqual(REGISTRY.get_sample_value('chat_presence_snapshots_total') - snapshots, 1)
+
+        # Sending a message ends typing; presence never takes a seq or enters the replay buffer.
+        await guest.send_json_to({'message': 'hi', 'username': 'Ana B'})
+        self.assertEqual(await creator.receive_json_from(), {'seq': 1, 'message': 'hi', 'username': 'Ana B'})
+        await receive_presence(creator, lambda presence: not presence['typing'])
+        frames, _, _ = await get_replay_buffer().asince('chat_presence_1', 0)
+        self.assertEqual(len(frames), 1)
+
+        await guest.disconnect()
+        left = await receive_presence(creator, lambda presence: presence['count'] == 1)
+        self.assertEqual(left['here'], ['alice'])
+        await creator.disconnect()
+
+    @override_settings(CHAT_PRESENCE_INTERVAL_MS=20, CHAT_SLOW_CONSUMER_QUEUE_SIZE=8)
+    async def test_presence_is_dropped_before_messages(self):
+        creator = connect_to_room('presence_2', self.creator, 'secret=close-it')
+        await creator.connect()
+        await receive_presence(creator)
+        layer = get_channel_layer()
+        channel_name = next(iter(layer.groups['chat_presence_2']))
+        layer.receive_buffer = {channel_name: BacklogQueue(5)} # Behind, but not yet a slow consumer
+        before = limits.counters['presence_dropped']
+        try:
+            guest = connect_to_room('presence_2', AnonymousUser(), 'name=Bob')
+            await guest.connect()
+            self.assertTrue(await creator.receive_nothing(0.2))
+            self.assertGreater(limits.counters['presence_dropped'], before)
+            await guest.send_json_to({'message': 'still delivered', 'username': 'Bob'})
+            self.assertEqual((await creator.receive_json_from())['message'], 'still delivered')
+        finally:
+            del layer.receive_buffer
+        await guest.disconnect()
+        await creator.disconnect()
+
+
+@override_settings(**IN_MEMORY_SETTINGS, MESSAGE_ARCHIVE_FLUSH_INTERVAL_MS=60000)
+class DatabaseConnectionTests(TransactionTestCase):
+    """
+    Concurrent sockets and requests must not each hold a database connection.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='pw-for-tests')
+        self.client.force_login(self.user)
+        self.cookie = f'{settings.SESSION_COOKIE_NAME}={self.client.cookies[settings.SESSION_COOKIE_NAME].value}'
+        # Every handshake has to read its session and user from the database.
+        cache.clear()
+        get_user_cache().clear()
+        self.addCleanup(flush_message_archive)
+
+    async def load(self, sockets, requests):
+        application = AuthMiddlewareStack(URLRouter(routing.websocket_urlpatterns))
+        headers = [(b'cookie', self.cookie.encode())]
+        creator = WebsocketCommunicator(application, '/ws/chat/load/?secret=s', headers=headers)
+        await creator.connect()
+        members = [WebsocketCommunicator(application, '/ws/chat/load/', headers=headers) for _ in range(sockets)]
+        await asyncio.gather(*(member.connect() for member in members))
+        for i, member in enumerate(members):
+            await member.send_json_to({'message': f'line {i}'})
+        for _ in members:
+            await creator.receive_json_from()
+        token = history_token('chat_load', (await get_room_registry().aget('chat_load'))['created_at'])
+        responses = await asyncio.gather(*(
+            self.async_client.get(reverse('chat:room_history', args=['load']), {'token': token}) for _ in range(requests)
+        ))
+        await get_message_archive().flush()
+        for communicator in (*members, creator):
+            await communicator.disconnect()
+        return responses
+
+    def test_consumers_share_one_connection(self):
+        # Run from this thread, database_sync_to_async work lands back on it (in a worker it
+        # is one shared thread instead), so every query shows up on this connection.
+        with CaptureQueriesContext(connection) as queries:
+            async_to_sync(self.load)(sockets=20, requests=0)
+        statements = [query['sql'] for query in queries]
+        self.assertTrue(any('"django_session"' in sql for sql in statements))
+        self.assertTrue(any(sql.startswith('INSERT INTO "chat_message"') for sql in statements))
+        self.assertEqual(Message.objects.filter(room='chat_load').count(), 20)
+
+    @skipUnless(connection.settings_dict['OPTIONS'].get('pool'), "Needs DATABASE_POOL=1 with Postgres")
+    def test_pool_bounds_connections_under_load(self):
+        responses = async_to_sync(self.load)(sockets=30, requests=30)
+        self.assertEqual({response.status_code for response in responses}, {200})
+        # connections_num counts every connection the pool has ever opened.
+        self.assertLessEqual(connection.pool.get_stats()['connections_num'], connection.pool.max_size)
+
+
+class BacklogQueue:
+    def __init__(self, size):
+        self.size = size
+
+    def qsize(self):
+        return self.size
+
+
+class SlowConsumer:
+    """Just what limits.is_slow_consumer looks at: `queued` broadcasts and `unsent` socket bytes."""
+
+    channel_name = 'c'
+
+    def __init__(self, queued=0, unsent=0):
+        self.channel_layer = type('Layer', (), {'receive_buffer': {'c': BacklogQueue(queued)}})()
+        self.scope = {'write_buffer_size': lambda: unsent}
+
+
+class LoadTestCommandTests(TransactionTestCase):
+    def setUp(self):
+        self.addCleanup(flush_message_archive)
+
+    def test_reports_and_checks_baseline(self):
+        out = io.StringIO()
+        options = {'clients': 4, 'rooms': 2, 'rate': 20, 'duration': 0.2, 'current_db': True}
+        call_command('loadtest', json=True, stdout=out, **options)
+        results = json.loads(out.getvalue())
+        self.assertEqual(results['deliveries'], results['deliveries_expected'])
+        self.assertGreater(results['p99_ms'], 0)
+
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as baseline:
+            json.dump(dict(results, p99_ms=results['p99_ms'] / 100), baseline)
+            baseline.flush()
+            with self.assertRaisesMessage(CommandError, 'p99_ms'):
+                call_command('loadtest', baseline=baseline.name, stdout=io.StringIO(), **options)
+
+
+class BenchFanoutCommandTests(TestCase):
+    def test_runs(self):
+        out = io.StringIO()
+        call_command('bench_fanout', recipients=3, messages=5, logging=True, stdout=out)
+        self.assertIn('5 messages x 3 recipients', out.getvalue())
+        self.assertIn('saved', out.getvalue())
+
+
+@override_settings(**IN_MEMORY_SETTINGS, CHAT_EMPTY_ROOM_TTL=60)
+class CloseRoomsCommandTests(TestCase):
+    def test_closes_named_and_idle_rooms(self):
+        registry = get_room_registry()
+        for group_name in ('chat_named', 'chat_idle', 'chat_recent'):
+            registry.create(group_name, 's', 'alice')
+        registry.rooms['chat_idle']['created_at'] -= 120
+        out = io.StringIO()
+        call_command('close_rooms', 'named', idle=True, stdout=out)
+        self.assertIn('2 rooms closed', out.getvalue())
+        self.assertEqual(registry.active_rooms(), ['chat_recent'])
+        with self.assertRaises(CommandError):
+            call_command('close_rooms')
@@ -6,6 +6,9 @@ app_name = 'chat' # Optional: add app namespace
 urlpatterns = [
     path('', views.home_view, name='home'),
     path('<str:room_name>/', views.room, name='room'),
+    path('<str:room_name>/history/', views.room_history, name='room_history'),
+    path('<str:room_name>/qr.<slug:kind>', views.room_qr_view, name='room_qr'),
     path('qr/review/', views.review_qr_view, name='review_qr'),
     path('qr/menu/', views.menu_qr_view, name='menu_qr'),
+    path('qr/<slug:name>.<slug:kind>', views.qr_image_view, name='qr_image'),
 ]
\ No newline at end of file
@@ -1,17 +1,27 @@
 from django.shortcuts import render, redirect
+from django.http import Http404, HttpResponse, JsonResponse
 from django.conf import settings
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.forms import UserCreationForm, AuthenticationForm
-import redis
-import re # Import the re module for regular expressions
 from django.contrib.auth.decorators import login_required
 import logging # Import the logging module
-
-# Import the shared dictionary from consumers. See caveats below.
-from .consumers import room_secrets_and_creators
+import asyncio
+from django.contrib.admin.views.decorators import staff_member_required
+from django.views.decorators.http import require_POST
+from django.urls import reverse
+from django.utils.cache import get_conditional_response
+
+from . import diagnostics, lifecycle, qr, teardown
+from .archive import read_history_token
+from .metrics import render_latest
+from .models import Message
+from .room_registry import get_active_rooms, get_room_registry, is_valid_room_name, room_group_name
 
 logger = logging.getLogger(__name__) # Get a logger for this module
 
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+
 @login_required 
 def create_room_view(request):
     """
@@ -28,61 +38,22 @@ def home_view(request):
 def list_active_rooms(request): # Consider if this view also needs @login_required
     active_rooms = []
     try:
-        
-        redis_connection_url = settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0]
-        r = redis.from_url(redis_connection_url, decode_responses=True)
-
-        for group_key in r.scan_iter(match='asgi:group:chat_*'):
-            key_type = r.type(group_key)
-
-            # Extract the 'chat_actualroomname' part (e.g., "chat_table_20")
-            # This is the format used as keys in room_secrets_and_creators
-            match = re.match(r'asgi:group:(chat_.+)', group_key)
-            if not match:
-                logger.warning(f"Key '{group_key}' matched Redis pattern but could not extract 'chat_...' suffix.")
-                continue
-            
-            consumer_side_group_name = match.group(1) # e.g., "chat_table_20"
-
-            # Derive display name (e.g., "table 20")
-            # Assumes consumer_side_group_name starts with "chat_"
-            if consumer_side_group_name.startswith("chat_"):
-                slugified_room_name = consumer_side_group_name[len("chat_"):]
-                display_room_name = slugified_room_name.replace('_', ' ')
-            else:
-                # Should not happen with the regex match, but as a fallback
-                display_room_name = consumer_side_group_name.replace('_', ' ')
-
-            # Check 1: Is the room considered "active" by the consumer's secret logic?
-            if consumer_side_group_name not in room_secrets_and_creators:
-                logger.info(f"Room '{display_room_name}' (key: {group_key}, consumer_group: {consumer_side_group_name}) found in Redis but not in consumer's room_secrets_and_creators. Skipping.")
-                continue
-
-            # Check 2: Does the Redis group actually have members?
-            is_redis_group_populated = False
-            if key_type == 'set':
-                if r.scard(group_key) > 0:
-                    is_redis_group_populated = True
-            elif key_type == 'zset':
-                logger.info(f"Found key '{group_key}' as a ZSET. Checking ZCARD.")
-                if r.zcard(group_key) > 0:
-                    is_redis_group_populated = True
-            else:
-                logger.warning(f"Key '{group_key}' (for room '{display_room_name}') has unexpected type '{key_type}'. Skipping.")
-                continue
-
-            if is_redis_group_populated:
-                active_rooms.append(display_room_name)
-            else:
-                logger.info(f"Room '{display_room_name}' (key: {group_key}) is in room_secrets_and_creators but Redis group is empty. Not listing as active.")
-
-    except redis.exceptions.RedisError as e: 
-        logger.error(f"RedisError connecting to Redis or fetching rooms: {e}")
-        
-    except Exception as e: 
+        # Rooms and their occupancy are indexed by the consumers as members connect and
+        # disconnect, so this is a single cached read instead of a scan of the Redis keyspace.
+        active_rooms = get_active_rooms()
+    except Exception as e: # Includes Redis being unreachable
         logger.error(f"An unexpected error occurred while listing active rooms: {e}", exc_info=True)
-    # Remove duplicates just in case and sort
-    return render(request, 'chat/list_rooms.html', {'active_rooms': sorted(list(set(active_rooms)))}) 
+    return render(request, 'chat/list_rooms.html', {'active_rooms': active_rooms}) 
+
+@staff_member_required
+@require_POST
+async def close_room_view(request, room_name):
+    """
+    Closes a room for everyone in it and frees its state (see chat.teardown).
+    """
+    await teardown.close_room(room_group_name(room_name), f"Room '{room_name}' was closed by staff.", reason='staff')
+    logger.info(f"{await request.auser()} closed room '{room_name}'")
+    return redirect('list_active_rooms')
 
 def room(request, room_name):
     secret_phrase = request.GET.get('secret', None) # Get secret phrase from query params
@@ -92,6 +63,103 @@ def room(request, room_name):
         'secret_phrase_for_creator': secret_phrase if request.user.is_authenticated else None
     })
 
+def room_history(request, room_name):
+    """
+    Returns archived messages for a room, newest page first, as JSON.
+
+    Only members get it, and only for the room as it is open now: pass the
+    ?token= a member's WebSocket got for HISTORY_FRAME (see chat.archive).
+    Earlier parties at a reused room name, and closed rooms, are not served.
+
+    Pages are keyset-paginated on the message id: pass the returned
+    'next_cursor' back as ?before=<id> to get the next (older) page. Every
+    page is one index range scan on (room, opened_at, id), however long the
+    history is.
+    """
+    group_name = room_group_name(room_name)
+    issued = read_history_token(request.GET.get('token', ''))
+    if issued is None or issued[0] != group_name:
+        return JsonResponse({'error': 'Not a member of this room.'}, status=403)
+    room_data = get_room_registry().get(group_name)
+    if room_data is None or room_data['created_at'] != issued[1]:
+        return JsonResponse({'error': 'This room is closed.'}, status=404)
+
+    try:
+        limit = min(int(request.GET.get('limit', HISTORY_PAGE_SIZE)), HISTORY_MAX_PAGE_SIZE)
+        before = request.GET.get('before')
+        before = int(before) if before else None
+    except ValueError:
+        return JsonResponse({'error': 'Invalid pagination parameters.'}, status=400)
+    if limit < 1:
+        return JsonResponse({'error': 'Invalid pagination parameters.'}, status=400)
+
+    messages = Message.objects.filter(room=group_name, opened_at=issued[1])
+    if before is not None:
+        messages = messages.filter(id__lt=before)
+    # Fetch one extra row to learn whether an older page exists without a COUNT.
+    page = list(
+        messages.order_by('-id').values('id', 'seq', 'username', 'content', 'created_at')[:limit + 1]
+    )
+    has_more = len(page) > limit
+    page = page[:limit]
+
+    return JsonResponse({
+        'messages': [
+            {
+                'id': row['id'],
+                'seq': row['seq'],
+                'username': row['username'],
+                'message': row['content'],
+                'created_at': row['created_at'].isoformat(),
+            }
+            for row in reversed(page) # Oldest first within the page, like the chat log
+        ],
+        'next_cursor': page[-1]['id'] if has_more else None,
+    })
+
+def ready_view(request):
+    """
+    Readiness probe: 200 once this worker can serve requests, 503 while it is draining.
+    """
+    if lifecycle.is_draining():
+        return JsonResponse({'ready': False, 'draining': True}, status=503)
+    return JsonResponse({'ready': True, 'warm_up_ms': round((lifecycle.warm_up_seconds or 0) * 1000)})
+
+def metrics_view(request):
+    """
+    Prometheus exposition. If METRICS_TOKEN is set, scrapers must send it as a Bearer token.
+    """
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return HttpResponse(status=401)
+    body, content_type = render_latest()
+    return HttpResponse(body, content_type=content_type)
+
+@staff_member_required
+async def profile_view(request):
+    """
+    Profiles this ASGI process for ?seconds=N (default 5) while it keeps serving.
+    ?kind=cpu returns collapsed stacks of the event loop thread; ?kind=memory
+    returns the top tracemalloc allocation sites. Plain text.
+    """
+    kind = request.GET.get('kind', 'cpu')
+    try:
+        seconds = float(request.GET.get('seconds', 5))
+    except ValueError:
+        return HttpResponse('Invalid seconds.', status=400, content_type='text/plain')
+    if kind not in ('cpu', 'memory') or not 0 < seconds <= settings.PROFILE_MAX_SECONDS:
+        return HttpResponse('Invalid profile request.', status=400, content_type='text/plain')
+    if not diagnostics.profile_lock.acquire(blocking=False):
+        return HttpResponse('A profile is already running.', status=409, content_type='text/plain')
+    try:
+        profiler = diagnostics.profile_cpu if kind == 'cpu' else diagnostics.snapshot_memory
+        # A plain thread, not sync_to_async: the loop must stay free to do the work being profiled.
+        report = await asyncio.to_thread(profiler, seconds)
+    finally:
+        diagnostics.profile_lock.release()
+    logger.info(f"{await request.auser()} ran a {seconds}s {kind} profile")
+    return HttpResponse(report, content_type='text/plain')
+
 def signup_view(request):
     if request.method == 'POST':
         form = UserCreationForm(request.POST)
@@ -118,24 +186,69 @@ def logout_view(request):
     logout(request)
     return redirect('login')
 
+def qr_page_context(name, page_title):
+    data = qr.destinations()[name]
+    return {
+        'qr_data_url': data,
+        'qr_src': f"{reverse('chat:qr_image', kwargs={'name': name, 'kind': 'svg'})}?v={qr.version(data)}",
+        'qr_png': f"{reverse('chat:qr_image', kwargs={'name': name, 'kind': 'png'})}?v={qr.version(data, 'png')}",
+        'page_title': page_title,
+    }
+
 def review_qr_view(request):
     """
     Serves a page that displays a QR code for the Google Review link.
     """
-    google_review_url = "https://search.google.com/local/writereview?placeid=ChIJX42RYQ2k2YgR8qb2wqVMbVk"
-    context = {
-        'qr_data_url': google_review_url,
-        'page_title': "Google Review QR Code"
-    }
-    return render(request, 'chat/review_qr.html', context)
+    return render(request, 'chat/review_qr.html', qr_page_context('review', "Google Review QR Code"))
 
 def menu_qr_view(request):
     """
     Serves a page that displays a QR code for the Menu link.
     """
-    menu_url = "https://www.benihana.com/menus/"
-    context = {
-        'qr_data_url': menu_url,
-        'page_title': "Restaurant Menu QR Code"
-    }
-    return render(request, 'chat/menu_qr.html', context)
\ No newline at end of file
+    return render(request, 'chat/menu_qr.html', qr_page_context('menu', "Restaurant Menu QR Code"))
+
+def qr_response(request, data, kind, immutable):
+    """
+    Serves `data` as a QR image (see chat.qr) with its ETag; a matching If-None-Match gets a 304.
+    ?scale=N sets the pixels per module.
+    """
+    try:
+        scale = int(request.GET.get('scale', 0)) or None
+    except ValueError:
+        scale = -1
+    if kind not in qr.CONTENT_TYPES or (scale is not None and not 1 <= scale <= qr.MAX_SCALE):
+        return HttpResponse('Invalid QR image request.', status=400, content_type='text/plain')
+    try:
+        image = qr.render(data, kind, scale)
+    except qr.DataOverflowError: # More data than the largest QR code holds
+        return HttpResponse('Too much data for a QR code.', status=400, content_type='text/plain')
+    response = HttpResponse(image.body, content_type=image.content_type)
+    response['ETag'] = image.etag
+    if immutable:
+        response['Cache-Control'] = f'public, max-age={settings.CHAT_QR_MAX_AGE}, immutable'
+    else:
+        response['Cache-Control'] = 'public, no-cache' # Revalidate; usually a 304
+    return get_conditional_response(request, etag=image.etag, response=response)
+
+def qr_image_view(request, name, kind):
+    """
+    One of the CHAT_QR_CODES. Only the URL with the current ?v= is immutable.
+    """
+    data = qr.destinations().get(name)
+    if data is None:
+        raise Http404("Unknown QR code.")
+    current = kind in qr.CONTENT_TYPES and request.GET.get('v') == qr.version(data, kind)
+    return qr_response(request, data, kind, immutable=current)
+
+def room_qr_view(request, room_name, kind):
+    """
+    The QR code of a room's link, for sharing it from the create room page.
+    Anyone may get an open room's code; a room that is not open yet only for
+    a logged-in user, who is about to open it.
+    """
+    if not is_valid_room_name(room_name):
+        return HttpResponse('Invalid room name.', status=400, content_type='text/plain')
+    if not request.user.is_authenticated and not get_room_registry().exists(room_group_name(room_name)):
+        raise Http404("No such room.")
+    data = request.build_absolute_uri(reverse('chat:room', kwargs={'room_name': room_name}))
+    return qr_response(request, data, kind, immutable=True) # The image only depends on this URL
\ No newline at end of file
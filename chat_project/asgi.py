@@ -14,19 +14,24 @@ from channels.security.websocket import AllowedHostsOriginValidator # For securi
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chat_project.settings')
-from chat.consumers import ChatConsumer
-# Import routing for our chat app AFTER os.environ.setdefault
-import chat.routing
-
+# Sets up Django; must run before anything that imports models (the consumers do).
 django_asgi_app = get_asgi_application()
 
-application = ProtocolTypeRouter({
+from chat.diagnostics import LoopMonitorMiddleware
+from chat.metrics import HandshakeTimerMiddleware
+import chat.routing
+
+# LoopMonitorMiddleware samples event-loop lag and logs the stack of anything that blocks
+# the loop; staff can profile this process on demand at /debug/profile/.
+application = LoopMonitorMiddleware(ProtocolTypeRouter({
     "http": django_asgi_app,
-    "websocket": AllowedHostsOriginValidator( # Important for production
-        AuthMiddlewareStack( # Handles authentication for WebSockets
-            URLRouter(
-                chat.routing.websocket_urlpatterns
+    "websocket": HandshakeTimerMiddleware( # Starts the chat_handshake_seconds clock
+        AllowedHostsOriginValidator( # Important for production
+            AuthMiddlewareStack( # Handles authentication for WebSockets
+                URLRouter(
+                    chat.routing.websocket_urlpatterns
+                )
             )
         )
     ),
-})
\ No newline at end of file
+}))
@@ -11,6 +11,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 import os
+import sys
 import dj_database_url
 from pathlib import Path
 
@@ -38,7 +39,6 @@ CSRF_TRUSTED_ORIGINS = os.environ.get('DJANGO_CSRF_TRUSTED_ORIGINS', 'http://loc
 # Application definition
 
 INSTALLED_APPS = [
-    'daphne', # ASGI server, should be early
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -49,6 +49,11 @@ INSTALLED_APPS = [
     'chat',
     'accounts',
 ]
+if sys.argv[1:2] == ['runserver']:
+    # daphne's app only replaces runserver with an ASGI one. Importing it loads Twisted (~0.5s)
+    # and installs its reactor, which every other manage.py process (and the workers that
+    # "manage.py serve" forks) must not inherit, so only add it where it is used.
+    INSTALLED_APPS.insert(0, 'daphne') # ASGI server, should be early
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
@@ -89,13 +94,50 @@ WSGI_APPLICATION = 'chat_project.wsgi.application'
 # Fly.io will set DATABASE_URL for your PostgreSQL instance
 
 
+# Under ASGI every HTTP request runs its ORM calls in a thread of its own, so a persistent
+# connection (CONN_MAX_AGE) is never reused by the next request; it just stays open until
+# the thread is garbage collected. Connections are therefore closed after each request
+# (and after each database_sync_to_async call in the consumers) unless
+# DATABASE_CONN_MAX_AGE says otherwise.
+# With DATABASE_POOL=1 and Postgres, each worker process instead keeps a psycopg pool of
+# DATABASE_POOL_MIN_SIZE to DATABASE_POOL_MAX_SIZE connections, and "closing" returns the
+# connection to it; a request waits up to DATABASE_POOL_TIMEOUT seconds for a free one.
+# Keep DATABASE_POOL_MAX_SIZE x worker processes x machines below Postgres' max_connections.
+DATABASE_POOL = os.environ.get('DATABASE_POOL', '') in ('1', 'true', 'True')
 DATABASES = {
     'default': dj_database_url.config(
         # Default to SQLite if DATABASE_URL is not set
         default=f'sqlite:///{BASE_DIR / "db.sqlite3"}',
-        conn_max_age=600
+        conn_max_age=0 if DATABASE_POOL else int(os.environ.get('DATABASE_CONN_MAX_AGE', '0')),
+        conn_health_checks=True,
     )
 }
+if DATABASE_POOL and DATABASES['default']['ENGINE'] == 'django.db.backends.postgresql':
+    DATABASES['default'].setdefault('OPTIONS', {})['pool'] = {
+        'min_size': int(os.environ.get('DATABASE_POOL_MIN_SIZE', '2')),
+        'max_size': int(os.environ.get('DATABASE_POOL_MAX_SIZE', '10')),
+        'timeout': float(os.environ.get('DATABASE_POOL_TIMEOUT', '10')),
+    }
+# Sessions are read from the cache and only fall back to the database on a miss, and
+# resolved users are kept in process memory (accounts/backends.py), so a WebSocket
+# handshake or page view normally needs no queries at all. With REDIS_URL set the cache
+# is shared by every worker; otherwise it is per process.
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        },
+    }
+# cached_db, moving sessions from before CachedModelBackend onto it (accounts/sessions.py).
+SESSION_ENGINE = 'accounts.sessions'
+
+AUTHENTICATION_BACKENDS = ['accounts.backends.CachedModelBackend']
+# Seconds a resolved user is reused before being re-read, and how many users each
+# process keeps. Logout and saving the user evict it at once in the current process.
+USER_CACHE_TIMEOUT = int(os.environ.get('USER_CACHE_TIMEOUT', '60'))
+USER_CACHE_MAX_SIZE = int(os.environ.get('USER_CACHE_MAX_SIZE', '1000'))
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -138,34 +180,212 @@ STATIC_URL = '/static/' # URL to use when referring to static files located in S
 # from all your apps (and any other locations you specify)
 STATIC_ROOT = BASE_DIR / 'staticfiles' # <--- THIS IS THE KEY FIX
 
-STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
+# The stylesheet is compiled from the Tailwind classes the templates use by
+# "manage.py build_assets" (assets/app.css -> assets/build/css/app.css). collectstatic
+# then gives every file a content-hashed name and gzip and brotli copies, and WhiteNoise
+# serves the hashed names with a far-future, immutable Cache-Control.
+STATICFILES_DIRS = [BASE_DIR / 'assets' / 'build']
+
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'whitenoise.storage.CompressedManifestStaticFilesStorage'},
+}
+
+# build_assets fails if the render-blocking CSS is larger than this once compressed with
+# brotli (about one TCP initial congestion window, so the first paint needs no extra round
+# trip), or if the <head> of base.html loads more than ASSET_RENDER_BLOCKING_MAX blocking
+# files or any from another origin.
+ASSET_CSS_BUDGET_BYTES = int(os.environ.get('ASSET_CSS_BUDGET_BYTES', str(14 * 1024)))
+ASSET_RENDER_BLOCKING_MAX = int(os.environ.get('ASSET_RENDER_BLOCKING_MAX', '1'))
 
 # ASGI application
 ASGI_APPLICATION = 'chat_project.asgi.application'
 
+# Redis used by the room registry, replay buffer and views (chat/redis_pool.py). Each
+# process shares one pool per URL; a request borrows an open connection instead of
+# connecting, and waits up to REDIS_POOL_TIMEOUT seconds when all
+# REDIS_POOL_MAX_CONNECTIONS are busy.
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379')
+REDIS_POOL_MAX_CONNECTIONS = int(os.environ.get('REDIS_POOL_MAX_CONNECTIONS', '50'))
+REDIS_POOL_TIMEOUT = float(os.environ.get('REDIS_POOL_TIMEOUT', '5'))
+
+# Rooms are spread over REDIS_SHARD_URLS (comma-separated; default just REDIS_URL) by a
+# consistent hash of their group name (chat/sharding.py). The registry, replay buffer and
+# channel layer all keep a room on the same shard, and room listings query every shard at
+# once. After adding or removing shards, stop the workers and run "manage.py reshard_rooms"
+# (with --from for each removed shard); it moves only the rooms whose shard changed.
+REDIS_SHARDS = [url.strip() for url in os.environ.get('REDIS_SHARD_URLS', REDIS_URL).split(',') if url.strip()]
+
+# Server-driven heartbeats (chat/heartbeat.py). Every CHAT_HEARTBEAT_INTERVAL seconds each
+# worker pings its chat sockets and renews their room membership. A socket that sends
+# nothing for CHAT_HEARTBEAT_TIMEOUT seconds is closed, and members no worker has renewed
+# for that long (their worker crashed) are pruned from the group and from occupancy.
+# 0 disables heartbeats.
+CHAT_HEARTBEAT_INTERVAL = float(os.environ.get('CHAT_HEARTBEAT_INTERVAL', '20'))
+CHAT_HEARTBEAT_TIMEOUT = float(os.environ.get('CHAT_HEARTBEAT_TIMEOUT', '45'))
+
 # Channel layer settings (using Redis)
 # For Fly.io, this will use the REDIS_URL environment variable.
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        # RedisChannelLayer plus in-memory delivery to group members in this process
+        'BACKEND': 'chat.channel_layers.HybridRedisChannelLayer',
         'CONFIG': {
-            # Get Redis URL from environment variable set by Fly.io or default to local
-            "hosts": [os.environ.get('REDIS_URL', 'redis://localhost:6379')],
+            # The Redis shards (REDIS_SHARD_URLS), or just REDIS_URL set by Fly.io or local
+            "hosts": REDIS_SHARDS,
+            # Group members are renewed by the heartbeat; one that isn't gets no more broadcasts.
+            "group_expiry": int(CHAT_HEARTBEAT_TIMEOUT) if CHAT_HEARTBEAT_INTERVAL > 0 else 86400,
         },
     },
 }
 
+# Shared registry of active rooms (secrets, creators and the active-room index).
+# Must live in Redis so every worker process and Fly machine sees the same rooms;
+# use chat.room_registry.InMemoryRoomRegistry only for tests or single-process dev.
+ROOM_REGISTRY = {
+    'BACKEND': 'chat.room_registry.RedisRoomRegistry',
+    'CONFIG': {
+        'urls': REDIS_SHARDS,
+    },
+}
+
+# Bounded per-room buffer of recent chat frames. Clients reconnecting with ?since=<seq>
+# are sent only the frames they missed.
+REPLAY_BUFFER = {
+    'BACKEND': 'chat.replay.RedisReplayBuffer',
+    'CONFIG': {
+        'urls': REDIS_SHARDS,
+        'maxlen': int(os.environ.get('CHAT_REPLAY_MAXLEN', '200')),
+    },
+}
+
+# Chat messages are archived in batches: one bulk INSERT per MESSAGE_ARCHIVE_BATCH_SIZE
+# messages or every MESSAGE_ARCHIVE_FLUSH_INTERVAL_MS, whichever comes first.
+MESSAGE_ARCHIVE_BATCH_SIZE = int(os.environ.get('MESSAGE_ARCHIVE_BATCH_SIZE', '50'))
+MESSAGE_ARCHIVE_FLUSH_INTERVAL_MS = int(os.environ.get('MESSAGE_ARCHIVE_FLUSH_INTERVAL_MS', '500'))
+
+# Per-connection and per-room (per process) broadcast limits: sustained messages per
+# second and burst size. 0 disables a limit.
+CHAT_CONNECTION_RATE = float(os.environ.get('CHAT_CONNECTION_RATE', '2'))
+CHAT_CONNECTION_BURST = int(os.environ.get('CHAT_CONNECTION_BURST', '10'))
+CHAT_ROOM_RATE = float(os.environ.get('CHAT_ROOM_RATE', '20'))
+CHAT_ROOM_BURST = int(os.environ.get('CHAT_ROOM_BURST', '60'))
+
+# Incoming frames longer than this are rejected before JSON parsing.
+CHAT_MAX_FRAME_BYTES = int(os.environ.get('CHAT_MAX_FRAME_BYTES', '4096'))
+
+# A member with more than this many broadcasts queued, or (under manage.py serve) with
+# more than this many bytes its socket has not been able to send, is a slow consumer.
+# 'drop' skips its frames until it catches up; 'disconnect' closes it with 1013 so it
+# reconnects and resumes from the replay buffer.
+CHAT_SLOW_CONSUMER_QUEUE_SIZE = int(os.environ.get('CHAT_SLOW_CONSUMER_QUEUE_SIZE', '50'))
+CHAT_SLOW_CONSUMER_BUFFER_BYTES = int(os.environ.get('CHAT_SLOW_CONSUMER_BUFFER_BYTES', str(256 * 1024)))
+CHAT_SLOW_CONSUMER_POLICY = os.environ.get('CHAT_SLOW_CONSUMER_POLICY', 'drop')
+
+# Typing and "who is here" indicators (chat/presence.py). Each worker sends a room at most
+# one presence snapshot per CHAT_PRESENCE_INTERVAL_MS, however many people type, and never
+# stores or replays them. A member counts as typing for CHAT_TYPING_TIMEOUT seconds after
+# their last typing frame.
+CHAT_PRESENCE_INTERVAL_MS = float(os.environ.get('CHAT_PRESENCE_INTERVAL_MS', '1000'))
+CHAT_TYPING_TIMEOUT = float(os.environ.get('CHAT_TYPING_TIMEOUT', '6'))
+
+# Seconds the room list page may serve a cached room list. The consumers invalidate
+# it whenever a room opens, closes, fills or empties; without a shared (Redis) cache
+# this also bounds how stale another worker's list can get.
+ACTIVE_ROOMS_CACHE_TIMEOUT = int(os.environ.get('ACTIVE_ROOMS_CACHE_TIMEOUT', '2'))
+
+# Prometheus metrics are served at /metrics (see chat/metrics.py). Set METRICS_TOKEN to
+# require "Authorization: Bearer <token>" from the scraper. When running several worker
+# processes, also export PROMETHEUS_MULTIPROC_DIR (an empty directory shared by all of
+# them) so each scrape reports every worker, not just the one that answered.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# Staff monitor sockets (ws/staff/, chat.consumers.StaffMonitorConsumer) watch up to
+# CHAT_MONITOR_MAX_ROOMS rooms each. Their frames are sent in batches, at most
+# CHAT_MONITOR_BATCH_MS after the first one or once CHAT_MONITOR_BATCH_SIZE are waiting.
+CHAT_MONITOR_MAX_ROOMS = int(os.environ.get('CHAT_MONITOR_MAX_ROOMS', '500'))
+CHAT_MONITOR_BATCH_MS = float(os.environ.get('CHAT_MONITOR_BATCH_MS', '100'))
+CHAT_MONITOR_BATCH_SIZE = int(os.environ.get('CHAT_MONITOR_BATCH_SIZE', '50'))
+
+# Chat sockets may negotiate the "grego.msgpack.v1" subprotocol for binary MessagePack
+# frames (chat/codec.py); JSON text stays the default. "manage.py serve" accepts
+# permessage-deflate with a 2**CHAT_WS_COMPRESSION_WINDOW_BITS byte window (9-15).
+CHAT_MSGPACK_ENABLED = os.environ.get('CHAT_MSGPACK_ENABLED', '1') in ('1', 'true', 'True')
+CHAT_WS_COMPRESSION = os.environ.get('CHAT_WS_COMPRESSION', '1') in ('1', 'true', 'True')
+CHAT_WS_COMPRESSION_WINDOW_BITS = int(os.environ.get('CHAT_WS_COMPRESSION_WINDOW_BITS', '11'))
+
+# QR codes are rendered on the server (chat/qr.py). CHAT_QR_CODES names the fixed codes
+# served at /chat/qr/<name>.svg|.png; each is rendered when the workers start. Pages
+# link to versioned URLs, which are cached for CHAT_QR_MAX_AGE seconds as immutable.
+CHAT_QR_CODES = {
+    'review': os.environ.get('CHAT_QR_REVIEW_URL', 'https://search.google.com/local/writereview?placeid=ChIJX42RYQ2k2YgR8qb2wqVMbVk'),
+    'menu': os.environ.get('CHAT_QR_MENU_URL', 'https://www.benihana.com/menus/'),
+}
+CHAT_QR_SCALE = int(os.environ.get('CHAT_QR_SCALE', '8'))
+CHAT_QR_CACHE_SIZE = int(os.environ.get('CHAT_QR_CACHE_SIZE', '256'))
+CHAT_QR_MAX_AGE = int(os.environ.get('CHAT_QR_MAX_AGE', str(365 * 24 * 3600)))
+
+# The live room list (ws/lobby/, chat/lobby.py) sends room changes at most once per
+# CHAT_LOBBY_WINDOW_MS, so a burst of joins is one frame.
+CHAT_LOBBY_WINDOW_MS = float(os.environ.get('CHAT_LOBBY_WINDOW_MS', '500'))
+
+# Rooms nobody has been in for CHAT_EMPTY_ROOM_TTL seconds are closed and their state
+# freed (chat/teardown.py); each worker looks for them every CHAT_ROOM_SWEEP_INTERVAL
+# seconds. 0 keeps empty rooms until their creator or staff close them.
+CHAT_EMPTY_ROOM_TTL = float(os.environ.get('CHAT_EMPTY_ROOM_TTL', '1800'))
+CHAT_ROOM_SWEEP_INTERVAL = float(os.environ.get('CHAT_ROOM_SWEEP_INTERVAL', '60'))
+
+# Event-loop health (chat/diagnostics.py): how often the loop-lag sampler wakes up, and
+# the stall length after which the blocked loop thread's stack is logged (0 disables
+# both). Staff can take a CPU or tracemalloc profile of a live worker at
+# /debug/profile/?kind=cpu|memory&seconds=N, capped at PROFILE_MAX_SECONDS.
+LOOP_LAG_SAMPLE_INTERVAL_MS = int(os.environ.get('LOOP_LAG_SAMPLE_INTERVAL_MS', '500'))
+LOOP_LAG_WARN_MS = int(os.environ.get('LOOP_LAG_WARN_MS', '100'))
+PROFILE_MAX_SECONDS = 30
+
+# Seconds a worker started by "manage.py serve" spends closing its WebSockets after SIGTERM.
+# Each socket is closed at a random moment in this window and the page reconnects with
+# jittered backoff; keep it below fly.toml's kill_timeout.
+CHAT_DRAIN_SECONDS = float(os.environ.get('CHAT_DRAIN_SECONDS', '10'))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Logs are written to stderr from a background thread (chat/logs.py), as JSON lines
+# unless LOG_FORMAT=text (the default with DEBUG on). Per-message and per-recipient
+# records ("event" in their extra) are sampled: each is kept with probability
+# LOG_SAMPLE_RATES[event], and at most LOG_MAX_PER_SECOND[event] a second per process.
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text' if DEBUG else 'json')
+LOG_SAMPLE_RATES = {
+    'chat.message': float(os.environ.get('LOG_SAMPLE_MESSAGES', '1')),
+    'chat.delivery': float(os.environ.get('LOG_SAMPLE_DELIVERIES', '0.01')), # DEBUG only
+}
+LOG_MAX_PER_SECOND = {
+    'chat.message': int(os.environ.get('LOG_MAX_MESSAGES_PER_SECOND', '20')),
+    'chat.delivery': int(os.environ.get('LOG_MAX_DELIVERIES_PER_SECOND', '20')),
+    'chat.connect': int(os.environ.get('LOG_MAX_CONNECTS_PER_SECOND', '20')), # Handshakes
+    'chat.room': int(os.environ.get('LOG_MAX_ROOM_EVENTS_PER_SECOND', '20')), # Rooms opened and closed
+    'chat.anonymous': int(os.environ.get('LOG_MAX_ANONYMOUS_PER_SECOND', '5')), # Guests sending no name
+    'chat.shutdown': int(os.environ.get('LOG_MAX_SHUTDOWNS_PER_SECOND', '5')), # One per member of a closing room
+}
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
+    'formatters': {
+        'text': {'format': '{levelname} {name}: {message}', 'style': '{'},
+        'json': {'()': 'chat.logs.JSONFormatter'},
+    },
+    'filters': {
+        'sample': {'()': 'chat.logs.EventSampler', 'rates': LOG_SAMPLE_RATES, 'max_per_second': LOG_MAX_PER_SECOND},
+    },
     'handlers': {
         'console': {
-            'class': 'logging.StreamHandler',
+            'class': 'chat.logs.BackgroundHandler',
+            'formatter': LOG_FORMAT,
+            'filters': ['sample'],
         },
     },
     'root': {
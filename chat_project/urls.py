@@ -28,6 +28,10 @@ urlpatterns = [
     path('', chat_views.home_view, name='home_page'), # Assuming home_view serves a general landing page
     path('create_room/', chat_views.create_room_view, name='create_room'),  # New URL for creating/entering a room
     path('rooms/', chat_views.list_active_rooms, name='list_active_rooms'), # New route for listing rooms
+    path('rooms/<str:room_name>/close/', chat_views.close_room_view, name='close_room'), # Staff only, POST
     path('chat/', include('chat.urls')),
     path('accounts/', include('accounts.urls')),
+    path('ready', chat_views.ready_view, name='ready'), # Readiness probe ([[http_service.checks]] in fly.toml)
+    path('metrics', chat_views.metrics_view, name='metrics'), # Prometheus scrape target
+    path('debug/profile/', chat_views.profile_view, name='debug_profile'), # Staff only
 ]